@@ -0,0 +1,187 @@
+"""Retention and archival of finished jobs.
+
+Jobs that reach a terminal status are given an expiry time, and dynamodb's
+time to live deletes them from the table once it passes. Those deletions
+show up in the table stream, where archiveHandler picks them up and writes
+them to the archive as gzipped, newline delimited JSON, partitioned by site
+and by the day the job was created:
+
+    jobs/site=saf/date=2020-03-26/01E4C33S9Z...-01E4C3ZZ0A....ndjson.gz
+
+The archive is an S3 bucket when ARCHIVE_BUCKET is set, and a local
+directory (ARCHIVE_PATH) otherwise.
+"""
+import datetime
+import gzip
+import json
+import os
+import time
+
+import ulid
+
+from src.helpers import to_json
+
+# Jobs are kept in the table for this long after they finish.
+JOB_RETENTION_DAYS = int(os.getenv('JOB_RETENTION_DAYS', '30'))
+
+# Attribute read by the table's time to live setting, in epoch seconds.
+EXPIRY_ATTRIBUTE = 'expiresAt'
+
+# Statuses after which the observatory won't update a job again.
+TERMINAL_STATUSES = {'COMPLETE', 'COMPLETED', 'FAILED', 'CANCELED', 'CANCELLED'}
+
+ARCHIVE_PREFIX = 'jobs'
+
+# Stream records for deletions made by time to live carry this identity.
+TTL_PRINCIPAL = 'dynamodb.amazonaws.com'
+
+_archive = None
+
+
+def is_terminal_status(status):
+    return status.upper() in TERMINAL_STATUSES
+
+
+def job_expiry(now=None):
+    """ Epoch seconds after which a job that just finished can be removed. """
+    now = time.time() if now is None else now
+    return int(now) + JOB_RETENTION_DAYS * 24 * 60 * 60
+
+
+def is_expiry_record(record):
+    """ Whether a stream record is a job being deleted by time to live. """
+    identity = record.get('userIdentity') or {}
+    return (record.get('eventName') == 'REMOVE'
+            and identity.get('type') == 'Service'
+            and identity.get('principalId') == TTL_PRINCIPAL)
+
+
+def created_ms(job):
+    """Creation time of a job in epoch ms.
+
+    Falls back to the time in the job's ulid for items without timestamp_ms,
+    such as the status-only items that status updates for already deleted
+    jobs used to create.
+    """
+    if 'timestamp_ms' in job:
+        return job['timestamp_ms']
+    return ulid.parse(job['ulid']).timestamp().int
+
+
+def partition_key(job):
+    """ The archive partition for a job: its site and creation date (UTC). """
+    created = datetime.datetime.utcfromtimestamp(created_ms(job) / 1000)
+    return f"{ARCHIVE_PREFIX}/site={job['site']}/date={created:%Y-%m-%d}"
+
+
+def encode_jobs(jobs):
+    """ Gzipped NDJSON for a list of jobs. """
+    lines = "".join(to_json(job) + "\n" for job in jobs)
+    return gzip.compress(lines.encode())
+
+
+def decode_jobs(data):
+    """ The jobs stored in a gzipped NDJSON archive object. """
+    lines = gzip.decompress(data).decode().splitlines()
+    return [json.loads(line) for line in lines if line]
+
+
+def archive_jobs(jobs, archive=None):
+    """Writes jobs to the archive, one object per site and creation date.
+
+    Objects are named after the first and last ulid they contain, so writing
+    the same batch again replaces the earlier copy instead of duplicating it.
+
+    Args:
+        jobs (list): Jobs as stored in the table.
+        archive: Where to write, defaulting to get_archive().
+
+    Returns:
+        list: Keys of the objects that were written.
+    """
+    archive = archive or get_archive()
+    partitions = {}
+    for job in jobs:
+        partitions.setdefault(partition_key(job), []).append(job)
+
+    keys = []
+    for partition, partition_jobs in sorted(partitions.items()):
+        partition_jobs.sort(key=lambda job: job['ulid'])
+        first, last = partition_jobs[0]['ulid'], partition_jobs[-1]['ulid']
+        key = f"{partition}/{first}-{last}.ndjson.gz"
+        archive.put(key, encode_jobs(partition_jobs))
+        keys.append(key)
+    return keys
+
+
+class LocalArchive:
+    """Archive objects stored as files under a local directory."""
+
+    def __init__(self, root):
+        self.root = root
+
+    def put(self, key, data):
+        path = os.path.join(self.root, key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as f:
+            f.write(data)
+
+    def get(self, key):
+        with open(os.path.join(self.root, key), 'rb') as f:
+            return f.read()
+
+    def keys(self, prefix=ARCHIVE_PREFIX):
+        """ Keys of the objects under the prefix, in sorted order. """
+        keys = []
+        for directory, _, files in os.walk(os.path.join(self.root, prefix)):
+            for name in files:
+                path = os.path.join(directory, name)
+                keys.append(os.path.relpath(path, self.root).replace(os.sep, '/'))
+        return sorted(keys)
+
+
+class S3Archive:
+    """Archive objects stored in an S3 bucket."""
+
+    def __init__(self, bucket):
+        import boto3
+        self.bucket = bucket
+        self.client = boto3.client('s3')
+
+    def put(self, key, data):
+        self.client.put_object(
+            Bucket=self.bucket,
+            Key=key,
+            Body=data,
+            ContentType='application/x-ndjson',
+            ContentEncoding='gzip',
+        )
+
+    def get(self, key):
+        return self.client.get_object(Bucket=self.bucket, Key=key)['Body'].read()
+
+    def keys(self, prefix=ARCHIVE_PREFIX):
+        """ Keys of the objects under the prefix, in sorted order. """
+        keys = []
+        paginator = self.client.get_paginator('list_objects_v2')
+        for page in paginator.paginate(Bucket=self.bucket, Prefix=f"{prefix}/"):
+            keys.extend(obj['Key'] for obj in page.get('Contents', []))
+        return keys
+
+
+def get_archive():
+    """Returns the configured archive, creating it on first use."""
+    global _archive
+    if _archive is None:
+        bucket = os.getenv('ARCHIVE_BUCKET')
+        if bucket:
+            _archive = S3Archive(bucket)
+        else:
+            _archive = LocalArchive(os.getenv('ARCHIVE_PATH', 'archive'))
+    return _archive
+
+
+def set_archive(archive):
+    """Use the given archive, or None to go back to the configured one."""
+    global _archive
+    _archive = archive
@@ -1,19 +1,32 @@
 import json
 import os
-import http.client
-import requests
-import datetime
+import hashlib
+import logging
+import time
+from collections import OrderedDict
 
-import jwt
-from cryptography.hazmat.backends import default_backend
-from cryptography.x509 import load_pem_x509_certificate
+from src.helpers import get_current_reservations, get_http_session, LOG_LEVEL
+from src.metrics import instrumented, phase
 
-from src.helpers import get_current_reservations
+logger = logging.getLogger("authorizer_logger")
+logger.setLevel(LOG_LEVEL)
 
 # Set by serverless.yml
 AUTH0_CLIENT_ID = os.getenv('AUTH0_CLIENT_ID')
 AUTH0_CLIENT_PUBLIC_KEY = os.getenv('AUTH0_CLIENT_PUBLIC_KEY')
 
+# How long a user's roles are reused before asking auth0 again. An entry never
+# outlives the token it was fetched with.
+USER_ROLES_CACHE_TTL = 300  # seconds
+USER_ROLES_CACHE_SIZE = 1024
+
+# (connect, read) timeouts for calls to the auth0 userinfo api, in seconds.
+USERINFO_TIMEOUT = (3.05, 5)
+
+# These persist across invocations while the lambda container stays warm.
+_verification_keys = {}
+_user_roles_cache = OrderedDict()  # token hash -> (expires_at, roles)
+
 
 def calendar_blocks_user_commands(user_id, site):
     """Checks whether user commands should be blocked due to a reservation.
@@ -49,6 +62,7 @@ def calendar_blocks_user_commands(user_id, site):
     return conflict_exists
 
 
+@instrumented
 def auth(event, context):
     """Returns authorization policy for the user based on their identity role.
 
@@ -56,32 +70,32 @@ def auth(event, context):
     such as scheduled time or site ownership.
     """
 
-    print(f"auth event: {event}")
+    # Tokens are credentials, so they are never logged.
     whole_auth_token = event.get('authorizationToken')
     if not whole_auth_token:
         raise Exception('Unauthorized')
 
-    print('Client token: ' + whole_auth_token)
-    print('Method ARN: ' + event['methodArn'])
+    logger.debug('Method ARN: ' + event['methodArn'])
 
     token_parts = whole_auth_token.split(' ')
     auth_token = token_parts[1]
     token_method = token_parts[0]
 
     if not (token_method.lower() == 'bearer' and auth_token):
-        print("Failing due to invalid token_method or missing auth_token")
+        logger.info("Failing due to invalid token_method or missing auth_token")
         raise Exception('Unauthorized')
 
     try:
-        principal_id = jwt_verify(auth_token, AUTH0_CLIENT_PUBLIC_KEY)
-        userInfo = getUserInfo(auth_token)
-        userRoles = getUserRoles(userInfo)
+        with phase('auth'):
+            payload = jwt_decode(auth_token, AUTH0_CLIENT_PUBLIC_KEY)
+            principal_id = payload['sub']
+        with phase('userinfo'):
+            userRoles = get_cached_user_roles(auth_token, payload.get('exp'))
         policy = generate_policy(principal_id, 'Allow', event['methodArn'], userRoles)
-        print('policy (the thing being returned): ')
-        print(policy)
+        logger.debug(f"policy (the thing being returned): {policy}")
         return policy
     except Exception as e:
-        print(f'Exception encountered: {e}')
+        logger.info(f'Exception encountered: {e}')
         raise Exception('Unauthorized')
 
 
@@ -89,7 +103,7 @@ def getUserInfo(auth_token):
     # Call the auth0 user management api to get user info
     headers = { 'Authorization': f"Bearer {auth_token}", }
     url = "https://photonranch.auth0.com/userinfo"
-    response = requests.get(url, headers=headers)
+    response = get_http_session().get(url, headers=headers, timeout=USERINFO_TIMEOUT)
 
     # The object with the user info
     user_info = json.loads(response.content)
@@ -101,11 +115,61 @@ def getUserRoles(userInfo):
     return userRoles
 
 
-def jwt_verify(auth_token, public_key):
-    public_key = format_public_key(public_key)
-    pub_key = convert_certificate_to_pem(public_key)
+def get_cached_user_roles(auth_token, token_expiry=None):
+    """Returns the user's roles, only calling auth0 if they aren't cached.
+
+    Entries are keyed by a hash of the token so the token itself isn't kept
+    in memory, and expire after USER_ROLES_CACHE_TTL seconds or when the
+    token expires, whichever comes first.
+
+    Args:
+        auth_token (str): A verified access token.
+        token_expiry (int): The token's 'exp' claim (unix time), if any.
+    Returns:
+        list: The user's roles (e.g. ['admin']).
+    """
+    now = time.time()
+    token_hash = hashlib.sha256(auth_token.encode()).hexdigest()
+
+    cached = _user_roles_cache.get(token_hash)
+    if cached is not None:
+        expires_at, roles = cached
+        if now < expires_at:
+            _user_roles_cache.move_to_end(token_hash)
+            return roles
+        del _user_roles_cache[token_hash]
+
+    roles = getUserRoles(getUserInfo(auth_token))
+
+    expires_at = now + USER_ROLES_CACHE_TTL
+    if token_expiry is not None:
+        expires_at = min(expires_at, token_expiry)
+    _user_roles_cache[token_hash] = (expires_at, roles)
+    while len(_user_roles_cache) > USER_ROLES_CACHE_SIZE:
+        _user_roles_cache.popitem(last=False)
+    return roles
+
+
+def get_verification_key(public_key):
+    """Returns the key used to verify tokens, parsing the certificate once."""
+    if public_key not in _verification_keys:
+        formatted_key = format_public_key(public_key)
+        _verification_keys[public_key] = convert_certificate_to_pem(formatted_key)
+    return _verification_keys[public_key]
+
+
+def jwt_decode(auth_token, public_key):
+    # jwt and cryptography are imported on first use: the api handlers import
+    # this module for calendar_blocks_user_commands and never verify tokens.
+    import jwt
+    pub_key = get_verification_key(public_key)
     payload = jwt.decode(auth_token, pub_key, algorithms=['RS256'], audience=AUTH0_CLIENT_ID)
-    print(f"jwt payload: {payload}")
+    logger.debug(f"jwt payload: {payload}")
+    return payload
+
+
+def jwt_verify(auth_token, public_key):
+    payload = jwt_decode(auth_token, public_key)
     return payload['sub']
 
 
@@ -130,6 +194,8 @@ def generate_policy(principal_id, effect, resource, userRoles):
 
 
 def convert_certificate_to_pem(public_key):
+    from cryptography.hazmat.backends import default_backend
+    from cryptography.x509 import load_pem_x509_certificate
     cert_str = public_key.encode()
     cert_obj = load_pem_x509_certificate(cert_str, default_backend())
     pub_key = cert_obj.public_key()
@@ -0,0 +1,113 @@
+"""Adds pending keys to jobs created before the pending indexes existed.
+
+Jobs are only found by getNewJobs and cancel_all_commands once they have a
+pending key for their queue, and by device workers once they have a device
+pending key. New jobs get them when they're created; this copies them onto
+older jobs that are still UNREAD or RECEIVED, along with the priority the
+keys are ordered by, and rewrites keys written before jobs had priorities.
+Every job is also given the siteShard that partitions the indexes, and
+moved to its new shard if its site's entry in SITE_SHARDS has changed.
+It is safe to run more than once, and to run while the api is in use.
+
+Example:
+    $ DYNAMODB_JOBS=photonranch-jobs-dev python -m src.backfill_pending --dry-run
+"""
+import argparse
+
+from boto3.dynamodb.conditions import Attr
+from botocore.exceptions import ClientError
+
+from src.dynamodb import PENDING_KEYS, PENDING_STATUSES, pending_id
+from src.dynamodb import DEVICE_PENDING_KEY, device_pending_id
+from src.helpers import get_priority
+from src.sharding import SHARD_KEY, job_shard
+from src.storage import get_table
+
+
+def missing_pending_keys(job):
+    """Pending keys the job should have but doesn't, or has with a value that
+    is out of date. The job's shard and priority are included, since the
+    keys depend on them; jobs without a priority are given the one newJob
+    would give them.
+
+    Returns:
+        list: (status_key, status, attribute, value) tuples. The value is
+            only valid while the job's status_key still equals status.
+    """
+    missing = []
+    shard = job_shard(job["site"], job.get("deviceType"), job.get("deviceInstance"))
+    if job.get(SHARD_KEY) != shard and "statusId" in job:
+        missing.append(("statusId", job["statusId"], SHARD_KEY, shard))
+
+    priority = job.get("priority")
+    if priority is None:
+        priority = get_priority({"action": job.get("action")})
+        status = job.get("statusId", "")
+        if status.split("#", 1)[0] in PENDING_STATUSES:
+            missing.append(("statusId", status, "priority", priority))
+
+    for status_key, pending_key in PENDING_KEYS.items():
+        status = job.get(status_key, "")
+        state = status.split("#", 1)[0]
+        if state in PENDING_STATUSES:
+            value = pending_id(state, job["ulid"], priority)
+            if job.get(pending_key) != value:
+                missing.append((status_key, status, pending_key, value))
+
+    status = job.get("statusId", "")
+    if status.startswith("UNREAD#") and "deviceType" in job and "deviceInstance" in job:
+        value = device_pending_id(job["ulid"], job["deviceType"],
+                                  job["deviceInstance"], priority)
+        if job.get(DEVICE_PENDING_KEY) != value:
+            missing.append(("statusId", status, DEVICE_PENDING_KEY, value))
+    return missing
+
+
+def backfill_pending_keys(dry_run=False):
+    """Scans the jobs table and adds any missing pending keys.
+
+    Each write is conditional on the job's status being unchanged since the
+    scan, so a job claimed or started in the meantime isn't put back in the
+    queue.
+
+    Returns:
+        int: Number of keys added or fixed (or that would be, for a dry run).
+    """
+    table = get_table()
+    projection = ", ".join(["site", "ulid", "deviceType", "deviceInstance", "#action", "priority", SHARD_KEY,
+                            *PENDING_KEYS, *PENDING_KEYS.values(), DEVICE_PENDING_KEY])
+    # "action" is a dynamodb reserved word.
+    scan_kwargs = {"ProjectionExpression": projection,
+                   "ExpressionAttributeNames": {"#action": "action"}}
+    added = 0
+    while True:
+        response = table.scan(**scan_kwargs)
+        for job in response["Items"]:
+            for status_key, status, pending_key, value in missing_pending_keys(job):
+                added += 1
+                if dry_run:
+                    continue
+                try:
+                    table.update_item(
+                        Key={"site": job["site"], "ulid": job["ulid"]},
+                        UpdateExpression=f"set {pending_key} = :value",
+                        ConditionExpression=Attr(status_key).eq(status),
+                        ExpressionAttributeValues={":value": value},
+                    )
+                except ClientError as e:
+                    if e.response["Error"]["Code"] != "ConditionalCheckFailedException":
+                        raise
+                    added -= 1
+        if "LastEvaluatedKey" not in response:
+            return added
+        scan_kwargs["ExclusiveStartKey"] = response["LastEvaluatedKey"]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--dry-run", action="store_true",
+                        help="count the keys that need fixing without changing them")
+    args = parser.parse_args()
+
+    added = backfill_pending_keys(args.dry_run)
+    print(f"{'Found' if args.dry_run else 'Fixed'} {added} missing or outdated pending keys")
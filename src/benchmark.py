@@ -0,0 +1,160 @@
+"""Offline load benchmark for the jobs endpoints.
+
+Replays a synthetic but realistic mix of traffic against the in-memory table:
+observatories polling getNewJobs and reporting progress, bursts of newJob from
+the UI, dashboards calling getRecentJobs, and the table stream feeding
+streamHandler. Reports latency percentiles and dynamodb requests per endpoint.
+
+Example:
+    $ python -m src.benchmark --sites 20 --rounds 50 --latency-ms 5
+"""
+import argparse
+import contextlib
+import io
+import json
+import random
+import time
+from collections import Counter, defaultdict
+from unittest import mock
+
+from src import handler
+from src.memory_table import InMemoryTable
+from src.storage import set_table
+
+
+def percentile(values, fraction):
+    """ Nearest-rank percentile of a list of numbers. """
+    ordered = sorted(values)
+    index = max(0, int(round(fraction * len(ordered))) - 1)
+    return ordered[index]
+
+
+def api_event(body):
+    return {
+        "body": json.dumps(body),
+        "requestContext": {"authorizer": {"userRoles": json.dumps([])}},
+    }
+
+
+def new_job_body(site, rng):
+    device, action = rng.choice([
+        ("camera", "expose"),
+        ("mount", "go"),
+        ("focuser", "move_relative"),
+        ("filter_wheel", "set_name"),
+    ])
+    return {
+        "site": site,
+        "device": device,
+        "instance": f"{device}1",
+        "action": action,
+        "user_name": "Benchmark User",
+        "user_id": "benchmark-user",
+        "optional_params": {"count": "1", "filter": rng.choice("LRGB")},
+        "required_params": {"time": str(rng.randint(1, 300))},
+    }
+
+
+class Benchmark:
+    """Calls handlers against a table, recording latency and dynamodb usage."""
+
+    def __init__(self, table):
+        self.table = table
+        self.latencies = defaultdict(list)
+        self.calls = defaultdict(Counter)
+
+    def invoke(self, name, endpoint, event):
+        calls_before = Counter(self.table.calls)
+        start = time.perf_counter()
+        response = endpoint(event, None)
+        self.latencies[name].append(time.perf_counter() - start)
+        self.calls[name].update(self.table.calls - calls_before)
+        return response
+
+    def report(self):
+        """ Summary per endpoint: request count, p50/p99 in ms, calls/request """
+        results = {}
+        for name, latencies in self.latencies.items():
+            requests = len(latencies)
+            results[name] = {
+                "requests": requests,
+                "p50_ms": percentile(latencies, 0.50) * 1000,
+                "p99_ms": percentile(latencies, 0.99) * 1000,
+                "dynamodb_calls_per_request": {
+                    op: count / requests for op, count in sorted(self.calls[name].items())
+                },
+            }
+        return results
+
+
+def run_benchmark(sites=20, rounds=50, burst_size=10, latency=0, seed=0):
+    """Runs the traffic mix and returns the per-endpoint report."""
+    rng = random.Random(seed)
+    table = InMemoryTable(latency=latency)
+    benchmark = Benchmark(table)
+    site_codes = [f"s{n:03d}" for n in range(sites)]
+
+    set_table(table)
+    try:
+        with mock.patch('src.handler.calendar_blocks_user_commands', return_value=False), \
+                mock.patch('src.handler.send_batch_to_datastream', return_value=[]), \
+                contextlib.redirect_stdout(io.StringIO()):
+            for _ in range(rounds):
+
+                # Users queue up commands at a few of the sites.
+                for site in rng.sample(site_codes, max(1, sites // 5)):
+                    for _ in range(rng.randint(1, burst_size)):
+                        benchmark.invoke('newJob', handler.newJob,
+                                         api_event(new_job_body(site, rng)))
+
+                # Every observatory polls, then reports progress on its jobs.
+                for site in site_codes:
+                    response = benchmark.invoke('getNewJobs', handler.getNewJobs,
+                                                api_event({"site": site}))
+                    for job in json.loads(response['body']):
+                        job_key = {"site": site, "ulid": job["ulid"]}
+                        benchmark.invoke('startJob', handler.startJob, api_event({
+                            **job_key, "secondsUntilComplete": 10,
+                        }))
+                        benchmark.invoke('updateJobStatus', handler.updateJobStatus, api_event({
+                            **job_key, "newStatus": "COMPLETE", "secondsUntilComplete": 0,
+                        }))
+
+                # A few dashboards refresh.
+                for site in rng.sample(site_codes, max(1, sites // 4)):
+                    benchmark.invoke('getRecentJobs', handler.getRecentJobs,
+                                     api_event({"site": site}))
+
+                benchmark.invoke('streamHandler', handler.streamHandler,
+                                 {"Records": table.drain_stream()})
+    finally:
+        set_table(None)
+
+    return benchmark.report()
+
+
+def format_report(results):
+    lines = [f"{'endpoint':<16}{'requests':>9}{'p50 ms':>9}{'p99 ms':>9}  dynamodb calls/request"]
+    for name, result in results.items():
+        calls = ", ".join(f"{op} {n:.2f}" for op, n in
+                          result["dynamodb_calls_per_request"].items())
+        lines.append(f"{name:<16}{result['requests']:>9}{result['p50_ms']:>9.2f}"
+                     f"{result['p99_ms']:>9.2f}  {calls}")
+    return "\n".join(lines)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--sites", type=int, default=20)
+    parser.add_argument("--rounds", type=int, default=50)
+    parser.add_argument("--burst-size", type=int, default=10,
+                        help="most newJob calls in one burst from the UI")
+    parser.add_argument("--latency-ms", type=float, default=0,
+                        help="simulated round trip time for each dynamodb request")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--json", action="store_true", help="print results as JSON")
+    args = parser.parse_args()
+
+    results = run_benchmark(args.sites, args.rounds, args.burst_size,
+                            args.latency_ms / 1000, args.seed)
+    print(json.dumps(results, indent=2) if args.json else format_report(results))
@@ -0,0 +1,129 @@
+"""Pushing new jobs to observatories over WebSocket connections.
+
+Observatories (or their device workers) open a WebSocket connection for a
+site, optionally limited to one device type or device instance, and it is
+recorded in the connections table. When a job becomes UNREAD, the table
+stream handler sends it to the matching connections, so an observatory
+hears about it straight away instead of on its next poll. Pushed jobs are
+only a notification: the observatory still claims them with getNewJobs, so
+each job is run once even with several connections open.
+
+Like datastream, this is kept apart from the other helpers so the api
+functions don't load the api gateway management client.
+"""
+import logging
+import os
+import time
+
+import boto3
+from boto3.dynamodb.conditions import Key
+from botocore.exceptions import ClientError
+
+from src.helpers import to_json, LOG_LEVEL
+from src.storage import get_connections_table
+
+logger = logging.getLogger("connections_logger")
+logger.setLevel(LOG_LEVEL)
+
+# Connections are recorded with an expiry slightly beyond api gateway's
+# two hour limit, in case the disconnect event is missed.
+CONNECTION_TTL_SECONDS = 2 * 60 * 60 + 5 * 60
+
+# Index of the connections table for finding a connection's site on
+# disconnect.
+CONNECTION_ID_INDEX = "ConnectionIds"
+
+WEBSOCKET_ENDPOINT = os.getenv('WEBSOCKET_ENDPOINT')
+
+# Reused across invocations while the lambda container stays warm.
+_management_client = None
+
+
+def get_management_client():
+    global _management_client
+    if _management_client is None:
+        _management_client = boto3.client(
+            "apigatewaymanagementapi", endpoint_url=WEBSOCKET_ENDPOINT)
+    return _management_client
+
+
+def add_connection(connection_id, site, device_type=None, device_instance=None):
+    """ Records a new connection for the site's jobs, or one device's. """
+    item = {
+        'site': site,
+        'connectionId': connection_id,
+        'expiresAt': int(time.time()) + CONNECTION_TTL_SECONDS,
+    }
+    if device_type is not None:
+        item['deviceType'] = device_type
+    if device_instance is not None:
+        item['deviceInstance'] = device_instance
+    get_connections_table().put_item(Item=item)
+
+
+def remove_connection(connection_id):
+    """ Forgets a connection that has been closed. """
+    table = get_connections_table()
+    connections = table.query(
+        IndexName=CONNECTION_ID_INDEX,
+        KeyConditionExpression=Key('connectionId').eq(connection_id),
+    )['Items']
+    for connection in connections:
+        table.delete_item(Key={'site': connection['site'], 'connectionId': connection_id})
+
+
+def site_connections(site):
+    """ The open connections for a site. """
+    response = get_connections_table().query(KeyConditionExpression=Key('site').eq(site))
+    return response['Items']
+
+
+def wants_job(connection, job):
+    """ Whether a connection's device filter matches a job. """
+    return all(connection.get(key) in (None, job.get(key))
+               for key in ('deviceType', 'deviceInstance'))
+
+
+def is_new_unread(record):
+    """Whether a stream record is a job becoming UNREAD on the primary queue:
+    a new job, or one put back in the queue."""
+    new_status = record['dynamodb'].get('NewImage', {}).get('statusId', {}).get('S', '')
+    old_status = record['dynamodb'].get('OldImage', {}).get('statusId', {}).get('S', '')
+    return new_status.startswith("UNREAD#") and not old_status.startswith("UNREAD#")
+
+
+def push_new_jobs(jobs):
+    """Sends each job to the open connections that want it.
+
+    Connections that have gone away are removed. Other failures are logged
+    and skipped, since observatories still poll for any job they miss.
+
+    Args:
+        jobs (list): Jobs that just became UNREAD, in stream order.
+
+    Returns:
+        int: Number of messages sent.
+    """
+    sent = 0
+    connections = {}
+    for job in jobs:
+        site = job['site']
+        if site not in connections:
+            connections[site] = site_connections(site)
+        for connection in list(connections[site]):
+            if not wants_job(connection, job):
+                continue
+            try:
+                get_management_client().post_to_connection(
+                    ConnectionId=connection['connectionId'],
+                    Data=to_json({"type": "newJob", "job": job}).encode(),
+                )
+                sent += 1
+            except ClientError as e:
+                if e.response['Error']['Code'] == 'GoneException':
+                    get_connections_table().delete_item(
+                        Key={'site': site, 'connectionId': connection['connectionId']})
+                    connections[site].remove(connection)
+                else:
+                    logger.warning(f"Failed to push job {job['ulid']} to {connection['connectionId']}: {e}")
+    return sent
@@ -0,0 +1,92 @@
+"""Named consumers that follow a site's jobs without changing them.
+
+The primary and alternate queues mark each job as it is read, which costs a
+write per job and an attribute and index per queue. A consumer instead keeps
+one small item per site in the consumers table, holding the ulid of the last
+job it was given (its watermark). Each read is a range query on the jobs
+table for the jobs after the watermark, followed by a single conditional
+write that moves the watermark forward, so a poll costs the same number of
+writes however many jobs it returns.
+
+A consumer's first poll of a site returns nothing, and starts its watermark
+CONSUMER_LAG_MS before the poll, so later polls return the jobs created from
+then on.
+"""
+import ulid
+from boto3.dynamodb.conditions import Attr, Key
+from botocore.exceptions import ClientError
+
+from src.dynamodb import query_page
+from src.helpers import now_ms
+from src.storage import get_consumers_table
+
+# Jobs are handed to consumers once they are this old, so a job whose ulid
+# came from a lambda with a slightly slow clock, or whose write isn't visible
+# to queries yet, isn't skipped by a watermark that has already moved on.
+CONSUMER_LAG_MS = 2000
+
+
+def lag_bound(now=None):
+    """ Largest ulid that is old enough to be handed to consumers. """
+    now = now_ms() if now is None else now
+    timestamp = ulid.from_timestamp((now - CONSUMER_LAG_MS - 1) / 1000).timestamp()
+    return timestamp.str + "Z" * 16
+
+
+def read_consumer_jobs(site, consumer, limit=None):
+    """Returns the jobs a consumer hasn't seen yet, and moves it past them.
+
+    If another read for the same consumer moves the watermark first, this
+    returns no jobs, so each job is given to a consumer at most once.
+
+    Args:
+        site (str): Sitecode to read jobs from.
+        consumer (str): Name of the consumer.
+        limit (int): Maximum number of jobs to return. None reads everything.
+
+    Returns:
+        list: Jobs in ulid order.
+    """
+    table = get_consumers_table()
+    key = {'site': site, 'consumer': consumer}
+    cursor = table.get_item(Key=key).get('Item')
+    if cursor is None:
+        try:
+            table.put_item(
+                Item={**key, 'watermark': lag_bound(), 'lastModified': now_ms()},
+                ConditionExpression=Attr('consumer').not_exists(),
+            )
+        except ClientError as e:
+            if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+                raise
+        return []
+
+    watermark, newest = cursor['watermark'], lag_bound()
+    if watermark >= newest:
+        return []
+    # Dynamodb can't filter on the sort key, so both bounds go in the key
+    # condition. Appending the lowest character gives the smallest string
+    # after the watermark, so every ulid after it is in the range.
+    jobs, _ = query_page(limit,
+        KeyConditionExpression=Key('site').eq(site)
+            & Key('ulid').between(watermark + "0", newest),
+    )
+    if not jobs:
+        return []
+
+    try:
+        table.update_item(
+            Key=key,
+            UpdateExpression="set watermark = :new, lastModified = :modified",
+            ConditionExpression=Attr('watermark').eq(watermark),
+            ExpressionAttributeValues={
+                ':new': jobs[-1]['ulid'],
+                ':modified': now_ms(),
+            },
+        )
+    except ClientError as e:
+        # An overlapping read for this consumer already took these jobs.
+        if e.response['Error']['Code'] == 'ConditionalCheckFailedException':
+            return []
+        raise
+    return jobs
@@ -0,0 +1,135 @@
+"""Publishing job updates to the datastream.
+
+Only the table stream handler sends to the datastream, so this lives apart
+from the other helpers to keep boto3 and SQS out of the api functions that
+don't need them.
+"""
+import logging
+
+import boto3
+
+from src.helpers import to_json, LOG_LEVEL
+from src.storage import NativeNumberDeserializer
+
+# SQS accepts at most 10 messages in a single send_message_batch call.
+SQS_BATCH_SIZE = 10
+
+DATASTREAM_QUEUE_NAME = 'datastreamIncomingQueue-dev'
+
+# Reused across invocations while the lambda container stays warm.
+_sqs_client = None
+_queue_urls = {}
+_deserializer = NativeNumberDeserializer()
+
+logger = logging.getLogger("datastream_logger")
+logger.setLevel(LOG_LEVEL)
+
+def get_sqs_client():
+    global _sqs_client
+    if _sqs_client is None:
+        _sqs_client = boto3.client("sqs", region_name="us-east-1")
+    return _sqs_client
+
+def get_queue_url(queueName):
+    if queueName not in _queue_urls:
+        response = get_sqs_client().get_queue_url(
+            QueueName=queueName,
+        )
+        _queue_urls[queueName] = response["QueueUrl"]
+    return _queue_urls[queueName]
+
+def deserialize_image(image):
+    """ Convert a dynamodb stream image into a regular python dict """
+    return {k: _deserializer.deserialize(v) for k, v in image.items()}
+
+# Job attributes shown in the UI. Updates that leave all of these unchanged
+# are not worth sending to the datastream.
+DATASTREAM_FIELDS = ('statusId', 'secondsUntilComplete')
+
+def coalesce_stream_records(records):
+    """Reduces a batch of stream records to the job updates worth publishing.
+
+    A single job is often written several times in quick succession, and each
+    write produces its own stream record. Only the latest image of each job
+    in the batch is kept, and it is dropped entirely if none of the
+    DATASTREAM_FIELDS differ from the job's state before the batch.
+
+    Args:
+        records (list): Records from a dynamodb stream event, in stream order.
+
+    Returns:
+        list: (sequence_number, site, job) tuples, one per job to publish.
+            The sequence number is that of the job's first record in the
+            batch, so a failed message is retried from the right place.
+    """
+    # (site, ulid) -> [first record, latest record]; dicts keep insert order.
+    jobs = {}
+    for record in records:
+        keys = record['dynamodb']['Keys']
+        job_key = (keys['site']['S'], keys['ulid']['S'])
+        if job_key in jobs:
+            jobs[job_key][1] = record
+        else:
+            jobs[job_key] = [record, record]
+
+    messages = []
+    for first, latest in jobs.values():
+        # Deleted jobs have no new image, so there is nothing to send.
+        new_image = latest['dynamodb'].get('NewImage')
+        if new_image is None:
+            continue
+
+        # New jobs have no old image and are always sent.
+        old_image = first['dynamodb'].get('OldImage')
+        if old_image is not None and all(
+                old_image.get(f) == new_image.get(f) for f in DATASTREAM_FIELDS):
+            continue
+
+        job = deserialize_image(new_image)
+        messages.append((first['dynamodb']['SequenceNumber'], job['site'], job))
+    return messages
+
+def datastream_payload(site, data):
+    payload = {
+        "topic": "jobs",
+        "site": site,
+        "data": data,
+    }
+    return to_json(payload)
+
+def send_batch_to_datastream(messages):
+    """Sends several jobs to the datastream using as few SQS calls as possible.
+
+    Args:
+        messages (list): (message_id, site, data) tuples. The message_id is
+            only used to report failures back to the caller.
+
+    Returns:
+        list: message_ids of the messages that could not be sent.
+    """
+    failed_ids = []
+    for i in range(0, len(messages), SQS_BATCH_SIZE):
+        chunk = messages[i:i + SQS_BATCH_SIZE]
+
+        # SQS entry ids only need to be unique within a single request.
+        entries = [
+            {
+                "Id": str(n),
+                "MessageBody": datastream_payload(site, data),
+            }
+            for n, (_, site, data) in enumerate(chunk)
+        ]
+        try:
+            response = get_sqs_client().send_message_batch(
+                QueueUrl=get_queue_url(DATASTREAM_QUEUE_NAME),
+                Entries=entries,
+            )
+        except Exception as e:
+            logger.warning(f"Failed to send batch to datastream: {e}")
+            failed_ids.extend(message_id for message_id, _, _ in chunk)
+            continue
+
+        for failure in response.get("Failed", []):
+            logger.warning(f"Failed to send message to datastream: {failure}")
+            failed_ids.append(chunk[int(failure["Id"])][0])
+    return failed_ids
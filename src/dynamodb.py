@@ -1,47 +1,602 @@
 
-import boto3
+import heapq
+import itertools
+import logging
 import os
 from boto3.dynamodb.conditions import Attr, Key
-import ulid
+from botocore.exceptions import BotoCoreError, ClientError
+from concurrent.futures import ThreadPoolExecutor
 import time
 
-dynamodb = boto3.resource('dynamodb')
-table = dynamodb.Table(os.getenv('DYNAMODB_JOBS', 'photonranch-jobs-dev'))
-#table = dynamodb.Table(os.environ['DYNAMODB_JOBS'])
+from src.helpers import encode_cursor, decode_cursor, now_ms, LOG_LEVEL
+from src.helpers import DEFAULT_PRIORITY, MAX_PRIORITY
+from src.archive import is_terminal_status, job_expiry, EXPIRY_ATTRIBUTE
+from src.sharding import SHARD_KEY, site_shards
+from src.storage import get_table
+from src.throttling import Throttled, backoff_delay
 
-def get_all_site_jobs(site: str, job_id: str) -> list:
-    # job_id will be excluded from the search
+logger = logging.getLogger("dynamodb_logger")
+logger.setLevel(LOG_LEVEL)
 
-    query = table.query(
-        ProjectionExpression="site, ulid, device",
-        KeyConditionExpression=Key('site').eq(site) & Key('ulid').lt(job_id),
-    )
-    site_jobs = query['Items']
-    return site_jobs
+# Upper bound on simultaneous write requests made by a single invocation.
+MAX_CONCURRENT_WRITES = 10
 
-def remove_jobs(jobs: list):
+# Upper bound on simultaneous queries made by a single invocation.
+MAX_CONCURRENT_QUERIES = 10
 
-    with table.batch_writer() as batch:
+# BatchWriteItem accepts at most 25 requests per call.
+BATCH_WRITE_SIZE = 25
+BATCH_WRITE_RETRIES = 5
+
+# Statuses of jobs that an observatory has not started yet.
+PENDING_STATUSES = ["UNREAD", "RECEIVED"]
+
+# Each queue's status attribute has a matching pending key,
+# "{status}#{lane}#{ulid}", which is set while the job is pending on that
+# queue and removed once it starts. The pending keys are the sort keys of
+# sparse indexes, so the queue indexes only hold jobs that haven't started.
+# The lane comes from the job's priority and sorts the most urgent first, so
+# a query returns jobs in the order they should be run.
+PENDING_KEYS = {
+    "statusId": "pendingId",
+    "replicaStatusId": "replicaPendingId",
+}
+
+# (index name, pending key) for the primary and alternate queues.
+QUEUE_INDEXES = [
+    ("PendingJobsByShard", "pendingId"),
+    ("ReplicaPendingJobsByShard", "replicaPendingId"),
+]
+
+# Jobs that are UNREAD on the primary queue also have a device pending key,
+# "UNREAD#{deviceType}#{deviceInstance}#{lane}#{ulid}", so that a worker for
+# one device can find its jobs with a key condition. It is removed once the
+# job has been read.
+DEVICE_PENDING_KEY = "devicePendingId"
+DEVICE_QUEUE_INDEX = "PendingDeviceJobsByShard"
+
+def priority_lane(priority: int) -> str:
+    """ Single digit for a priority that sorts the most urgent first. """
+    return str(MAX_PRIORITY - priority)
+
+def pending_id(status: str, job_id: str, priority: int) -> str:
+    return f"{status}#{priority_lane(priority)}#{job_id}"
+
+def pending_prefix(status: str, priority: int = None) -> str:
+    """ Pending key prefix shared by the jobs with a status, or by the jobs
+    with a status and priority if it is given. """
+    if priority is None:
+        return f"{status}#"
+    return f"{status}#{priority_lane(priority)}#"
+
+def device_pending_id(job_id: str, device_type: str, device_instance: str,
+                      priority: int) -> str:
+    return f"UNREAD#{device_type}#{device_instance}#{priority_lane(priority)}#{job_id}"
+
+def device_pending_prefix(device_type: str, device_instance: str = None,
+                          priority: int = None) -> str:
+    """ Device pending key prefix shared by a device type's UNREAD jobs, or
+    by one device instance's if it is given, optionally narrowed to the jobs
+    with one priority. A priority can't be given without an instance. """
+    if device_instance is None:
+        return f"UNREAD#{device_type}#"
+    if priority is None:
+        return f"UNREAD#{device_type}#{device_instance}#"
+    return f"UNREAD#{device_type}#{device_instance}#{priority_lane(priority)}#"
+
+def status_clauses(status_key: str, status: str, value: str = ":status",
+                   pending_value: str = ":pending") -> tuple:
+    """SET and REMOVE clauses that give a job a new status on one queue.
+
+    Setting a job back to UNREAD doesn't restore its device pending key,
+    which needs the job's device; callers add that themselves.
+
+    Args:
+        status_key (str): Either "statusId" or "replicaStatusId".
+        status (str): The new status, e.g. "STARTED".
+        value (str): Placeholder for the "{status}#{ulid}" expression value.
+        pending_value (str): Placeholder for the pending_id() expression
+            value. Only used if the new status is pending.
+
+    Returns:
+        tuple: (set clauses, remove clauses), as lists of strings.
+    """
+    pending_key = PENDING_KEYS[status_key]
+    set_clauses, remove_clauses = [f"{status_key} = {value}"], []
+    if status in PENDING_STATUSES:
+        set_clauses.append(f"{pending_key} = {pending_value}")
+    else:
+        remove_clauses.append(pending_key)
+    if status_key == "statusId" and status != "UNREAD":
+        remove_clauses.append(DEVICE_PENDING_KEY)
+    return set_clauses, remove_clauses
+
+def update_expression(set_clauses: list, remove_clauses: list = ()) -> str:
+    """ Joins SET and REMOVE clauses into an update expression. """
+    expression = "set " + ", ".join(set_clauses)
+    if remove_clauses:
+        expression += " remove " + ", ".join(remove_clauses)
+    return expression
+
+def query_page(limit: int = None, cursor: str = None, **query_kwargs) -> tuple:
+    """Runs a table query, following LastEvaluatedKey across dynamodb pages.
+
+    Dynamodb stops each query response at 1 MB, so a single call can silently
+    miss results. This keeps querying until `limit` items have been collected,
+    or until the results are exhausted if no limit is given.
+
+    Args:
+        limit (int): Maximum number of items to return. None reads everything.
+        cursor (str): Cursor returned by a previous call, to resume from.
+        **query_kwargs: Arguments passed through to table.query.
+
+    Returns:
+        tuple: (items, next_cursor). next_cursor is None if there is nothing
+        left to read.
+    """
+    table = get_table()
+    items = []
+    start_key = decode_cursor(cursor)
+    while True:
+        if start_key:
+            query_kwargs['ExclusiveStartKey'] = start_key
+        if limit is not None:
+            query_kwargs['Limit'] = limit - len(items)
+        # The low-level client is thread safe, unlike the table resource.
+        response = table.meta.client.query(TableName=table.name, **query_kwargs)
+        items.extend(response['Items'])
+        start_key = response.get('LastEvaluatedKey')
+        if not start_key or (limit is not None and len(items) >= limit):
+            break
+    return items, encode_cursor(start_key)
+
+def query_shards(shards: list, key_condition, sort_key: str,
+                 limit: int = None, cursor: str = None, **query_kwargs) -> tuple:
+    """Runs the same index query on each of a site's shards, and merges them.
+
+    The shards are queried in parallel, and the results merged into the
+    order a single partition would return them in: by the index sort key,
+    then ulid. With one shard this is just query_page. With several, each
+    shard is read for up to `limit` items, and the cursor records where each
+    shard's next page starts.
+
+    Args:
+        shards (list): Values of the index partition key to query.
+        key_condition: Function of a shard returning the key condition.
+        sort_key (str): The index's sort key attribute.
+        limit (int): Maximum number of items to return. None reads everything.
+        cursor (str): Cursor returned by a previous call, to resume from.
+        **query_kwargs: Arguments passed through to table.query.
+
+    Returns:
+        tuple: (items, next_cursor), as for query_page.
+    """
+    if len(shards) == 1:
+        return query_page(limit, cursor,
+                          KeyConditionExpression=key_condition(shards[0]), **query_kwargs)
+
+    if cursor:
+        starts = decode_cursor(cursor).get('shards')
+        if not isinstance(starts, dict) or not set(starts) <= set(shards):
+            raise ValueError("Invalid cursor.")
+    else:
+        starts = {shard: None for shard in shards}
+    shards = [shard for shard in shards if shard in starts]
+
+    def read(shard):
+        return query_page(limit, encode_cursor(starts[shard]),
+                          KeyConditionExpression=key_condition(shard), **query_kwargs)
+
+    workers = min(MAX_CONCURRENT_QUERIES, len(shards)) or 1
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        results = list(executor.map(read, shards))
+
+    merged = heapq.merge(*(items for items, _ in results),
+                         key=lambda item: (item[sort_key], item['ulid']))
+    items = list(merged if limit is None else itertools.islice(merged, limit))
+
+    # Each shard's next page starts after the last of its items that was
+    # returned, which is where its query stopped if they all were.
+    returned = {id(item) for item in items}
+    next_starts = {}
+    for shard, (shard_items, shard_cursor) in zip(shards, results):
+        taken = sum(1 for item in shard_items if id(item) in returned)
+        if taken == len(shard_items):
+            if shard_cursor:
+                next_starts[shard] = decode_cursor(shard_cursor)
+        elif taken:
+            last = shard_items[taken - 1]
+            next_starts[shard] = {key: last[key]
+                                  for key in ('site', 'ulid', SHARD_KEY, sort_key)}
+        else:
+            next_starts[shard] = starts[shard]
+    return items, encode_cursor({'shards': next_starts} if next_starts else None)
+
+def get_pending_site_jobs(site: str, job_id: str) -> list:
+    """Returns the keys of a site's jobs that have not been started yet.
+
+    A job counts as pending if it is UNREAD or RECEIVED on either queue. Only
+    jobs older than job_id are included. The pending indexes are queried in
+    parallel, and only hold jobs that haven't started, so the cost depends on
+    the number of pending jobs rather than the size of the site's history.
+    Each job also has the pending key of every queue it is pending on.
+    """
+
+    def pending_on(query):
+        index, pending_key, shard = query
+        # Pending keys are ordered by priority before ulid, so the age of
+        # the jobs is checked with a filter rather than the key condition.
+        jobs, _ = query_page(
+            IndexName=index,
+            ProjectionExpression=f"site, ulid, {pending_key}",
+            KeyConditionExpression=Key(SHARD_KEY).eq(shard),
+            FilterExpression=Attr('ulid').lt(job_id),
+        )
+        return jobs
+
+    queries = [(index, pending_key, shard)
+               for index, pending_key in QUEUE_INDEXES
+               for shard in site_shards(site)]
+    workers = min(MAX_CONCURRENT_QUERIES, len(queries))
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        results = executor.map(pending_on, queries)
+
+    # A job can be pending on both queues, but only needs to be listed once.
+    pending_jobs = {}
+    for jobs in results:
         for job in jobs:
-            key = {
-                'site': job['site'],
-                'ulid': job['ulid']
-            }
-            batch.delete_item(Key=key)
+            pending_jobs.setdefault(job['ulid'], {}).update(job)
+    return list(pending_jobs.values())
+
+def get_recent_jobs_for_sites(sites: list, earliest_ulid: str, limit: int) -> tuple:
+    """Returns the most recent jobs across several sites, in ulid order.
+
+    Each site's partition is queried newest first, in parallel, for at most
+    `limit` jobs, and the results are merged so that the newest `limit` jobs
+    overall are kept.
+
+    Args:
+        sites (list): Sitecodes to read from.
+        earliest_ulid (str): Jobs older than this are left out.
+        limit (int): Maximum number of jobs to return in total.
+
+    Returns:
+        tuple: (jobs, truncated). truncated is True if more jobs may have
+            matched than were returned.
+    """
+
+    def recent_on(site):
+        return query_page(limit,
+            KeyConditionExpression=Key('site').eq(site)
+                & Key('ulid').gte(earliest_ulid),
+            ScanIndexForward=False,
+        )
+
+    workers = min(MAX_CONCURRENT_QUERIES, len(sites))
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        results = list(executor.map(recent_on, sites))
+
+    # Each site's jobs are newest first, so merging keeps that order.
+    newest_first = heapq.merge(*(jobs for jobs, _ in results),
+                               key=lambda job: job['ulid'], reverse=True)
+    jobs = list(itertools.islice(newest_first, limit + 1))
+    truncated = len(jobs) > limit or any(cursor for _, cursor in results)
+    return jobs[:limit][::-1], truncated
+
+class UnprocessedWrites(Throttled):
+    """Some of the requests given to batch_write weren't written.
+
+    Attributes:
+        unprocessed (list): Positions of the requests that weren't written,
+            in ascending order. The others were.
+    """
+
+    def __init__(self, retry_after, unprocessed):
+        super().__init__(retry_after)
+        self.unprocessed = unprocessed
+
+class JobNotFound(Exception):
+    """ The job being updated isn't in the table, for example because its
+    retention period is over. """
+
+    def __init__(self, site, job_id):
+        super().__init__(f"Job {job_id} not found at site {site}")
+
+def _request_key(write_request: dict) -> tuple:
+    """ (site, ulid) of the job a PutRequest or DeleteRequest writes. """
+    if 'PutRequest' in write_request:
+        key = write_request['PutRequest']['Item']
+    else:
+        key = write_request['DeleteRequest']['Key']
+    return key['site'], key['ulid']
+
+def batch_write(write_requests: list, description: str):
+    """Sends write requests to the table in concurrent batches of 25.
+
+    Items dynamodb leaves unprocessed, usually because of throttling, are
+    retried with backoff. A batch that fails outright stops there, but the
+    other batches are still written.
+
+    Args:
+        write_requests (list): PutRequest or DeleteRequest dicts, each for a
+            different job.
+        description (str): What the requests do, for the error message.
+
+    Raises:
+        UnprocessedWrites: If some requests still weren't written, listing
+            which ones.
+    """
+    if not write_requests:
+        return
+    table = get_table()
+
+    def write_batch(positions):
+        request_items = {table.name: [write_requests[p] for p in positions]}
+        try:
+            for attempt in range(BATCH_WRITE_RETRIES):
+                response = table.meta.client.batch_write_item(RequestItems=request_items)
+                request_items = response.get('UnprocessedItems')
+                if not request_items:
+                    return []
+                # Back off before retrying items that were throttled.
+                time.sleep(backoff_delay(attempt))
+        except (ClientError, BotoCoreError, Throttled) as e:
+            logger.warning(f"Failed to {description} a batch of jobs: {e}")
+        remaining = {_request_key(request) for request in request_items[table.name]}
+        return [p for p in positions if _request_key(write_requests[p]) in remaining]
+
+    batches = [range(i, min(i + BATCH_WRITE_SIZE, len(write_requests)))
+               for i in range(0, len(write_requests), BATCH_WRITE_SIZE)]
+    workers = min(MAX_CONCURRENT_WRITES, len(batches))
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        unprocessed = sorted(itertools.chain.from_iterable(executor.map(write_batch, batches)))
+    if unprocessed:
+        logger.warning(f"Failed to {description} {len(unprocessed)} jobs")
+        raise UnprocessedWrites(1, unprocessed)
+
+def put_jobs(jobs: list):
+    """Adds new jobs to the table in concurrent batches of 25."""
+    batch_write([{'PutRequest': {'Item': job}} for job in jobs], "add")
+
+def claim_jobs(jobs: list, status_key: str) -> list:
+    """Marks a set of UNREAD jobs as RECEIVED and returns the ones we claimed.
+
+    Each job is updated with a conditional write that only succeeds if the job
+    is still UNREAD on the given queue, so when two polls overlap each job is
+    handed to exactly one of them. The writes are issued concurrently, so the
+    time taken stays roughly flat as the number of queued jobs grows.
+
+    A job whose write fails (throttled, for example) is left UNREAD for the
+    next poll, and the jobs that were claimed are still returned, since
+    they're no longer in the queue. The error is only raised if no job could
+    be claimed because of it.
+
+    Args:
+        jobs (list): Job items returned from the pending index query.
+        status_key (str): Either "statusId" or "replicaStatusId".
+
+    Returns:
+        list: The subset of jobs that were successfully marked RECEIVED.
+
+    Raises:
+        Throttled, ClientError: If every claim that wasn't lost to another
+            poll failed.
+    """
+    if not jobs:
+        return []
+    table = get_table()
+    set_clauses, remove_clauses = status_clauses(status_key, "RECEIVED", ":s", ":p")
+    set_clauses.append("lastModified = :modified")
+
+    errors = []
+
+    def claim(job):
+        try:
+            # The low-level client is thread safe, unlike the table resource.
+            table.meta.client.update_item(
+                TableName=table.name,
+                Key={
+                    'site': job['site'],
+                    'ulid': job['ulid']
+                },
+                UpdateExpression=update_expression(set_clauses, remove_clauses),
+                ConditionExpression=Attr(status_key).begins_with("UNREAD"),
+                ExpressionAttributeValues={
+                    ':s': f"RECEIVED#{job['ulid']}",
+                    ':p': pending_id("RECEIVED", job['ulid'],
+                                     job.get('priority', DEFAULT_PRIORITY)),
+                    ':modified': now_ms(),
+                }
+            )
+            return True
+        except ClientError as e:
+            # Another poller got to this job first.
+            if e.response['Error']['Code'] == 'ConditionalCheckFailedException':
+                return False
+            error = e
+        except (BotoCoreError, Throttled) as e:
+            error = e
+        logger.warning(f"Failed to claim job {job['ulid']}: {error}")
+        errors.append(error)
+        return False
+
+    workers = min(MAX_CONCURRENT_WRITES, len(jobs))
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        claimed = [job for job, ok in zip(jobs, executor.map(claim, jobs)) if ok]
+
+    if errors and not claimed:
+        raise errors[0]
+    return claimed
+
+def cancel_jobs(jobs: list):
+    """Marks pending jobs as CANCELLED on the queues they're pending on.
+
+    The jobs are kept rather than deleted, so that they show up in the
+    changes index like any other status change, and they expire along with
+    other finished jobs. Each write only succeeds if the job is still pending
+    on those queues, so a job that an observatory started in the meantime is
+    left alone. The writes are issued concurrently.
+
+    Args:
+        jobs (list): Jobs returned by get_pending_site_jobs.
+
+    Raises:
+        Throttled, ClientError: If any job couldn't be cancelled, after
+            trying all of them. Cancelling again is safe.
+    """
+    if not jobs:
+        return
+    table = get_table()
+    errors = []
+
+    def cancel(job):
+        status_keys = [key for key, pending_key in PENDING_KEYS.items() if pending_key in job]
+        set_clauses, remove_clauses = ["lastModified = :modified"], []
+        expression_values = {
+            ':status': f"CANCELLED#{job['ulid']}",
+            ':modified': now_ms(),
+        }
+        condition = None
+        for status_key in status_keys:
+            sets, removes = status_clauses(status_key, "CANCELLED")
+            set_clauses += sets
+            remove_clauses += removes
+            pending = Attr(PENDING_KEYS[status_key]).exists()
+            condition = pending if condition is None else condition & pending
+        if "statusId" in status_keys:
+            set_clauses.append(f"{EXPIRY_ATTRIBUTE} = :expires")
+            expression_values[':expires'] = job_expiry()
+        try:
+            # The low-level client is thread safe, unlike the table resource.
+            table.meta.client.update_item(
+                TableName=table.name,
+                Key={
+                    'site': job['site'],
+                    'ulid': job['ulid']
+                },
+                UpdateExpression=update_expression(set_clauses, remove_clauses),
+                ConditionExpression=condition,
+                ExpressionAttributeValues=expression_values,
+            )
+            return
+        except ClientError as e:
+            # The job was started since it was found.
+            if e.response['Error']['Code'] == 'ConditionalCheckFailedException':
+                return
+            error = e
+        except (BotoCoreError, Throttled) as e:
+            error = e
+        logger.warning(f"Failed to cancel job {job['ulid']}: {error}")
+        errors.append(error)
+
+    workers = min(MAX_CONCURRENT_WRITES, len(jobs))
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        list(executor.map(cancel, jobs))
+
+    if errors:
+        raise errors[0]
+
+def update_job_status(site: str, job_id: str, new_status: str,
+                      seconds_until_complete=-1, status_key: str = "statusId") -> dict:
+    """Gives a job a new status on one queue.
+
+    On the primary queue, finished jobs are also given an expiry time, so
+    they're removed from the table, and archived, once their retention
+    period is over. A job that is started again is kept. A job put back in
+    the queue keeps its priority, and is findable by its device again if it
+    is UNREAD, which takes an extra read. Jobs that aren't in the table are
+    left that way, rather than being recreated with just a status.
+
+    Args:
+        site (str): Sitecode of the job.
+        job_id (str): ulid of the job.
+        new_status (str): The new status, e.g. "STARTED".
+        seconds_until_complete: Estimate of the time until the job completes.
+        status_key (str): Either "statusId" or "replicaStatusId".
+
+    Returns:
+        dict: The update_item response.
+
+    Raises:
+        JobNotFound: If the job isn't in the table.
+    """
+    table = get_table()
+    set_clauses, remove_clauses = status_clauses(status_key, new_status, ":statId")
+    set_clauses += ["secondsUntilComplete = :eta", "lastModified = :modified"]
+    expression_values = {
+        ':statId': f"{new_status}#{job_id}",
+        ':eta': seconds_until_complete,
+        ':modified': now_ms(),
+    }
+    if status_key == "statusId":
+        if is_terminal_status(new_status):
+            set_clauses.append(f"{EXPIRY_ATTRIBUTE} = :expires")
+            expression_values[':expires'] = job_expiry()
+        else:
+            remove_clauses.append(EXPIRY_ATTRIBUTE)
+
+    if new_status in PENDING_STATUSES:
+        # The low-level client is thread safe, unlike the table resource.
+        job = table.meta.client.get_item(
+            TableName=table.name,
+            Key={'site': site, 'ulid': job_id},
+            ProjectionExpression="deviceType, deviceInstance, priority",
+        ).get('Item') or {}
+        priority = job.get('priority', DEFAULT_PRIORITY)
+        expression_values[':pending'] = pending_id(new_status, job_id, priority)
+        if status_key == "statusId" and new_status == "UNREAD" and job:
+            set_clauses.append(f"{DEVICE_PENDING_KEY} = :devicePending")
+            expression_values[':devicePending'] = device_pending_id(
+                job_id, job['deviceType'], job['deviceInstance'], priority)
+
+    try:
+        return table.meta.client.update_item(
+            TableName=table.name,
+            Key={'site': site, 'ulid': job_id},
+            UpdateExpression=update_expression(set_clauses, remove_clauses),
+            ConditionExpression=Attr('ulid').exists(),
+            ExpressionAttributeValues=expression_values,
+        )
+    except ClientError as e:
+        if e.response['Error']['Code'] == 'ConditionalCheckFailedException':
+            raise JobNotFound(site, job_id)
+        raise
+
+def update_job_statuses(site: str, updates: list) -> list:
+    """Applies a list of status updates to a site's jobs.
 
-if __name__ == "__main__":
-    site = 'tst'
-    ulid = ulid.new().str
-    all_jobs = get_all_site_jobs(site, ulid)
+    Updates to different jobs are applied concurrently. Updates to the same
+    job are applied one after another, in the order given, so a replayed
+    STARTED then COMPLETE ends up COMPLETE.
 
+    Args:
+        site (str): Sitecode of the jobs.
+        updates (list): Dicts with 'ulid' and 'newStatus', and optionally
+            'secondsUntilComplete' and 'alternateQueue'.
 
-    to_remove = all_jobs
-    print(to_remove, len(all_jobs))
+    Returns:
+        list: For each update in order, None if it was applied, or the
+            exception that stopped it.
+    """
+    if not updates:
+        return []
+    by_job = {}
+    for position, update in enumerate(updates):
+        by_job.setdefault(update['ulid'], []).append(position)
+    errors = [None] * len(updates)
 
-    #remove_jobs(to_remove)
+    def apply(positions):
+        for position in positions:
+            update = updates[position]
+            status_key = "replicaStatusId" if update.get('alternateQueue', False) else "statusId"
+            try:
+                update_job_status(site, update['ulid'], update['newStatus'],
+                                  update.get('secondsUntilComplete', -1), status_key)
+            except (BotoCoreError, ClientError, JobNotFound, Throttled) as e:
+                errors[position] = e
 
-    all_jobs = get_all_site_jobs(site, ulid)
-    print(len(all_jobs))
-    
-    
-     
+    workers = min(MAX_CONCURRENT_WRITES, len(by_job))
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        # Consume the results so that any other exception is raised here.
+        list(executor.map(apply, by_job.values()))
+    return errors
@@ -0,0 +1,200 @@
+"""Exports a range of job history as newline delimited JSON.
+
+Jobs are read a query page at a time and written out as they arrive, so
+memory use stays flat however many jobs are exported. Each site's time range
+is split into segments that are read in parallel, a few pages ahead of the
+writer, and the output is written in site then ulid order.
+
+Jobs that have already expired from the table are in the archive (see
+src.archive), which uses the same format.
+
+Example:
+    $ DYNAMODB_JOBS=photonranch-jobs-prod python -m src.export_jobs \\
+        --site saf --site mrc --start 2026-09-01 --end 2026-10-01 -o jobs.ndjson.gz
+"""
+import argparse
+import datetime
+import gzip
+import io
+import queue
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import ulid
+from boto3.dynamodb.conditions import Key
+
+from src.helpers import now_ms, to_json
+from src.storage import get_table
+
+# Time slices each site's range is split into, and how many are read at once.
+DEFAULT_SEGMENTS = 4
+DEFAULT_WORKERS = 8
+
+# Query pages each segment reads ahead of the writer.
+PREFETCH_PAGES = 2
+
+_DONE = object()
+
+
+def ulid_bound(ms, upper=False):
+    """ The smallest (or largest) ulid created in the given millisecond. """
+    timestamp = ulid.from_timestamp(ms / 1000).timestamp().str
+    return timestamp + ("Z" if upper else "0") * 16
+
+
+def time_segments(sites, start_ms, end_ms, segments=DEFAULT_SEGMENTS):
+    """Splits each site's [start_ms, end_ms) range into equal time slices.
+
+    Returns:
+        list: (site, first ulid, last ulid) tuples, in output order.
+    """
+    bounds = [start_ms + (end_ms - start_ms) * n // segments for n in range(segments + 1)]
+    return [(site, ulid_bound(lower), ulid_bound(upper - 1, upper=True))
+            for site in sites
+            for lower, upper in zip(bounds, bounds[1:]) if upper > lower]
+
+
+def oldest_job_ms(sites):
+    """ Creation time of the oldest job at any of the sites, or None if they
+    have no jobs. Reads one job per site. """
+    table = get_table()
+    oldest = []
+    for site in sites:
+        response = table.meta.client.query(
+            TableName=table.name,
+            KeyConditionExpression=Key('site').eq(site),
+            ProjectionExpression="ulid",
+            Limit=1,
+        )
+        oldest += [ulid.parse(job['ulid']).timestamp().int for job in response['Items']]
+    return min(oldest, default=None)
+
+
+def iter_pages(site, first_ulid, last_ulid):
+    """ Yields the pages of a site's jobs between two ulids, as they're read. """
+    table = get_table()
+    query_kwargs = {
+        'TableName': table.name,
+        'KeyConditionExpression': Key('site').eq(site)
+            & Key('ulid').between(first_ulid, last_ulid),
+    }
+    while True:
+        # The low-level client is thread safe, unlike the table resource.
+        response = table.meta.client.query(**query_kwargs)
+        yield response['Items']
+        if 'LastEvaluatedKey' not in response:
+            return
+        query_kwargs['ExclusiveStartKey'] = response['LastEvaluatedKey']
+
+
+def export_jobs(out, segments, workers=DEFAULT_WORKERS, prefetch=PREFETCH_PAGES):
+    """Writes the jobs in each segment to a text stream, one per line.
+
+    Segments are read in parallel, each up to `prefetch` pages ahead of the
+    writer, which takes them in order. Segments are started in order too, so
+    the one being written is always being read.
+
+    Args:
+        out: Text stream to write to.
+        segments (list): (site, first ulid, last ulid) tuples.
+        workers (int): Segments read at once.
+        prefetch (int): Pages each segment may read ahead.
+
+    Returns:
+        int: Number of jobs written.
+    """
+    pages = [queue.Queue(maxsize=prefetch) for _ in segments]
+    stopped = threading.Event()
+
+    def put(segment_pages, item):
+        while not stopped.is_set():
+            try:
+                segment_pages.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                continue
+
+    def read(position):
+        try:
+            for page in iter_pages(*segments[position]):
+                put(pages[position], page)
+                if stopped.is_set():
+                    return
+            put(pages[position], _DONE)
+        except Exception as e:
+            put(pages[position], e)
+
+    exported = 0
+    executor = ThreadPoolExecutor(max_workers=max(1, min(workers, len(segments))))
+    try:
+        for position in range(len(segments)):
+            executor.submit(read, position)
+        for segment_pages in pages:
+            while True:
+                page = segment_pages.get()
+                if page is _DONE:
+                    break
+                if isinstance(page, Exception):
+                    raise page
+                out.writelines(to_json(job) + "\n" for job in page)
+                exported += len(page)
+    finally:
+        stopped.set()
+        executor.shutdown(wait=True)
+    return exported
+
+
+def open_output(path, compress):
+    """ Text stream for the export, gzipped if asked, on stdout for '-'. """
+    if path == '-':
+        if compress:
+            return io.TextIOWrapper(gzip.GzipFile(fileobj=sys.stdout.buffer, mode='wb'))
+        return sys.stdout
+    if compress:
+        return gzip.open(path, 'wt')
+    return open(path, 'w')
+
+
+def parse_time_ms(value):
+    """ Epoch ms for an ISO date or datetime, taken as UTC if it has no zone. """
+    parsed = datetime.datetime.fromisoformat(value)
+    if parsed.tzinfo is None:
+        parsed = parsed.replace(tzinfo=datetime.timezone.utc)
+    return int(parsed.timestamp() * 1000)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--site", action="append", required=True,
+                        help="site to export, can be given more than once")
+    parser.add_argument("--start", type=parse_time_ms, default=None,
+                        help="earliest job creation time, as an ISO date or time (UTC), "
+                             "default the oldest job's")
+    parser.add_argument("--end", type=parse_time_ms, default=None,
+                        help="export jobs created before this time, default now")
+    parser.add_argument("-o", "--output", default="-",
+                        help="file to write, default stdout")
+    parser.add_argument("--gzip", action="store_true",
+                        help="gzip the output, the default for files ending in .gz")
+    parser.add_argument("--segments", type=int, default=DEFAULT_SEGMENTS,
+                        help="time slices to split each site's range into")
+    parser.add_argument("--workers", type=int, default=DEFAULT_WORKERS,
+                        help="segments to read in parallel")
+    args = parser.parse_args()
+
+    end_ms = now_ms() if args.end is None else args.end
+    # Splitting the range from the epoch would leave all but the last
+    # segment empty, so by default it starts at the oldest job.
+    start_ms = oldest_job_ms(args.site) if args.start is None else args.start
+    if start_ms is None:
+        start_ms = end_ms
+    compress = args.gzip or args.output.endswith(".gz")
+    out = open_output(args.output, compress)
+    try:
+        exported = export_jobs(out, time_segments(args.site, start_ms, end_ms, args.segments),
+                               args.workers)
+    finally:
+        if out is not sys.stdout:
+            out.close()
+    print(f"Exported {exported} jobs", file=sys.stderr)
@@ -4,46 +4,201 @@ from botocore.exceptions import ClientError
 from http import HTTPStatus
 
 from src.helpers import *
+from src.datastream import coalesce_stream_records, send_batch_to_datastream, deserialize_image
+from src.archive import archive_jobs, is_expiry_record, JOB_RETENTION_DAYS
 from src.authorizer import calendar_blocks_user_commands
-from src.dynamodb import get_all_site_jobs, remove_jobs
+from src.dynamodb import get_pending_site_jobs, cancel_jobs, put_jobs, claim_jobs, query_page, query_shards
+from src import connections
+from src.consumers import read_consumer_jobs
+from src.dynamodb import get_recent_jobs_for_sites, update_job_status, update_job_statuses
+from src.dynamodb import JobNotFound, UnprocessedWrites
+from src.dynamodb import pending_id, pending_prefix, PENDING_KEYS
+from src.dynamodb import device_pending_id, device_pending_prefix, DEVICE_QUEUE_INDEX, DEVICE_PENDING_KEY
+from src.sharding import SHARD_KEY, job_shard, site_shards
+from src.storage import get_table
+from src.metrics import instrumented, phase, set_site
+from src.throttling import Throttled, handle_throttling
 
 logger = logging.getLogger("handler_logger")
-logger.setLevel(logging.DEBUG)
-dynamodb = boto3.resource('dynamodb')
-table = dynamodb.Table(os.environ['DYNAMODB_JOBS'])
+logger.setLevel(LOG_LEVEL)
 
+# Keys every job request must include.
+# TODO: validation with something like cerberus
+REQUIRED_JOB_KEYS = ['site', 'device', 'instance', 'action', 'user_name',
+                     'user_id', 'optional_params', 'required_params']
+
+# Most sites read in one /getrecentjobsforsites request.
+MAX_SITES_PER_REQUEST = 50
+
+# Most jobs accepted in one /newjobs request, so the writes finish well within
+# the api gateway timeout.
+MAX_JOBS_PER_REQUEST = 100
+
+# Most status updates accepted in one /updatejobstatuses request.
+MAX_UPDATES_PER_REQUEST = 100
+
+def status_update_error(update):
+    """ Error message for the first problem with a requested status update, or None """
+    if not isinstance(update, dict) or not isinstance(update.get('ulid'), str) \
+            or not isinstance(update.get('newStatus'), str):
+        return "Error: each update requires 'ulid' and 'newStatus'"
+    seconds = update.get('secondsUntilComplete', -1)
+    if isinstance(seconds, bool) or not isinstance(seconds, int):
+        return "Error: 'secondsUntilComplete' must be an integer"
+    if not isinstance(update.get('alternateQueue', False), bool):
+        return "Error: 'alternateQueue' must be true or false"
+    return None
+
+def job_request_error(params):
+    """ Error message for the first problem with a requested job, or None """
+    for key in REQUIRED_JOB_KEYS:
+        if key not in params:
+            return f"Error: missing required key {key}"
+    try:
+        get_priority(params)
+    except ValueError as e:
+        return f"Error: {e}"
+    return None
+
+def sequential_ulids(count):
+    """Returns count new ulids that sort in the order they were created.
+
+    ulid.new() picks a random suffix each time, so ulids made within the same
+    millisecond sort randomly. Incrementing the first one keeps a sequence of
+    jobs in the order it was submitted.
+    """
+    first = ulid.new()
+    return [ulid.from_int(first.int + n) for n in range(count)]
+
+def job_entry(params, ulid_obj, user_roles):
+    """ The table item for a requested job. """
+    job_id = ulid_obj.str
+    priority = get_priority(params)
+    return {
+        "site": f"{params['site']}",            # PK
+        "ulid": job_id,                         # SK
+        "siteShard": job_shard(                 # GSI pk
+            params['site'], params['device'], params['instance']),
+        "statusId": f"UNREAD#{job_id}",
+        "replicaStatusId": f"UNREAD#{job_id}",
+        "priority": priority,
+        "pendingId": pending_id(                # GSI1 sk, removed once started
+            "UNREAD", job_id, priority),
+        "replicaPendingId": pending_id(         # GSI2 sk, removed once started
+            "UNREAD", job_id, priority),
+        "devicePendingId": device_pending_id(   # GSI3 sk, removed once read
+            job_id, params['device'], params['instance'], priority),
+        "user_name": params['user_name'],
+        "user_id": params['user_id'],
+        "user_roles": user_roles,
+        "timestamp_ms": ulid_obj.timestamp().int,
+        "lastModified": ulid_obj.timestamp().int,  # GSI4 sk
+        "deviceType": f"{params['device']}",
+        "deviceInstance": f"{params['instance']}",
+        "action": f"{params['action']}",
+        "optional_params": params.get('optional_params', {}),
+        "required_params": params.get('required_params', {}),
+    }
+
+
+@instrumented
 def streamHandler(event, context):
-    """Handles the job request data stream."""
-    print(json.dumps(event))
-    records = event.get('Records', [])
+    """Handles the job request data stream.
 
-    for item in records:
-        site = item['dynamodb']['Keys']['site']['S']
-        sk = item['dynamodb']['Keys']['ulid']['S']
-    
-        response = table.get_item(
-            Key={
-                "site": site,
-                "ulid": sk
-            }
-        )
+    Jobs that have just become UNREAD are first pushed to the observatories
+    connected over WebSocket, if that is enabled. Pushing is best effort,
+    since observatories still poll for their jobs, so it is never retried.
 
-        # If the response object doesn't have the key 'Item', there is nothing
-        # to return, so close the function.
-        # Note: using context.succeed() prevents the dynamodb stream from 
-        # continuously retrying a bad event (eg. an event that doesn't exist).
-        if response.get('Item', 'not here') == 'not here': context.succeed()
+    Jobs are read from the NewImage included in each stream record, and sent
+    to the datastream in batches. Repeated writes to the same job within a
+    batch are coalesced into one message. Records that fail to send are
+    reported back so that only those are retried.
+    """
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug(json.dumps(event))
+    records = event.get('Records', [])
+
+    if connections.WEBSOCKET_ENDPOINT:
+        unread_jobs = [deserialize_image(r['dynamodb']['NewImage'])
+                       for r in records if connections.is_new_unread(r)]
+        if unread_jobs:
+            with phase('push'):
+                try:
+                    connections.push_new_jobs(unread_jobs)
+                except Exception as e:
+                    logger.warning(f"Failed to push new jobs: {e}")
+
+    messages = coalesce_stream_records(records)
+    with phase('publish'):
+        failed_sequence_numbers = send_batch_to_datastream(messages)
+
+    return {
+        "batchItemFailures": [
+            {"itemIdentifier": sequence_number}
+            for sequence_number in failed_sequence_numbers
+        ]
+    }
 
-        print(json.dumps(response, indent=2, cls=DecimalEncoder))
-        send_to_datastream(site, response.get('Item', []))
 
-    return get_response(HTTPStatus.OK, "stream has activated this function")
+@instrumented
+def archiveHandler(event, context):
+    """Archives the jobs that time to live removes from the table.
 
+    Reads the same table stream as streamHandler. Only deletions made by
+    time to live are archived. If the archive write fails, the whole batch is
+    retried, and since archive objects are named after the jobs they hold,
+    the retry overwrites rather than duplicates anything already written.
+    """
+    records = [r for r in event.get('Records', []) if is_expiry_record(r)]
+    jobs = [deserialize_image(r['dynamodb']['OldImage']) for r in records]
+    if not jobs:
+        return {"archived": 0}
+    with phase('archive'):
+        keys = archive_jobs(jobs)
+    logger.info(f"Archived {len(jobs)} jobs to {len(keys)} objects")
+    return {"archived": len(jobs)}
+
+@instrumented
+@handle_throttling
+def connectHandler(event, context):
+    """Records a WebSocket connection that new jobs will be pushed to.
+
+    Query string parameters:
+        site (str): Sitecode to receive new jobs for (e.g. "saf").
+        deviceType (str): Optional. Only receive jobs for this device type.
+        deviceInstance (str): Optional. Only receive jobs for this device;
+            requires deviceType.
+    """
+    params = event.get('queryStringParameters') or {}
+    site = params.get('site')
+    try:
+        if not site:
+            raise ValueError("'site' is required.")
+        device_type, device_instance = get_device_filter(params)
+    except ValueError as e:
+        return get_response(HTTPStatus.BAD_REQUEST, str(e))
+    set_site(site)
+
+    with phase('writes'):
+        connections.add_connection(event['requestContext']['connectionId'],
+                                   site, device_type, device_instance)
+    return get_response(HTTPStatus.OK, "Connected")
+
+
+@instrumented
+@handle_throttling
+def disconnectHandler(event, context):
+    """Forgets a WebSocket connection once it has been closed."""
+    with phase('writes'):
+        connections.remove_connection(event['requestContext']['connectionId'])
+    return get_response(HTTPStatus.OK, "Disconnected")
 
 #=========================================#
 #=======       API Endpoints      ========#
 #=========================================#
 
+@instrumented
+@handle_throttling
 def newJob(event, context):
     """Requests a new job for an observatory and adds it to the jobs table.
     
@@ -66,6 +221,10 @@ def newJob(event, context):
             required_params (dict): 
                 Required parameters for the instrument
                 (e.g. {time: 60, image_type: 'light'}).
+            priority (int): Optional, from 0 to 9, default 5. Higher
+                priority jobs are handed to the observatory first. Safety
+                actions (stop, park, cancel, cancel_all_commands) are always
+                given priority 9.
     
     Returns:
         JSON body of table entry including:
@@ -77,6 +236,7 @@ def newJob(event, context):
             user_id (str): Same as above.
             user_roles (list): Same as above if 'user_roles' in params, else [].
             timestamp_ms (int): Timestamp of job in ms.
+            priority (int): Priority the job was queued with.
             deviceType (str): Same as "device" above.
             deviceInstance (str): Same as "instance" above.
             action (str): Same as above.
@@ -86,70 +246,141 @@ def newJob(event, context):
 
     params = json.loads(event.get("body", ""))
 
-    print("params:", params)  # for debugging
+    logger.debug(f"params: {params}")
 
     # Unique, lexicographically sortable ID based on server timestamp.
     # See: https://github.com/ulid/spec
     ulid_obj = ulid.new()
     job_id = ulid_obj.str
-    timestamp_ms = ulid_obj.timestamp().int
 
     # Get the user's roles from the authorizer function
     user_roles = event["requestContext"]["authorizer"]["userRoles"]
     user_is_admin = 'admin' in user_roles
 
-    # Check that all required keys are present.
-    # TODO: validation with something like cerberus
-    required_keys = ['site', 'device', 'instance', 'action', 'user_name', 
-                     'user_id', 'optional_params', 'required_params']
-    actual_keys = params.keys()
-    for key in required_keys:
-        if key not in actual_keys:
-            print(f"Error: missing required key {key}")
-            error = f"Error: missing required key {key}"
-            return get_response(HTTPStatus.BAD_REQUEST, error)
+    # Check that all required keys are present, and the priority is valid.
+    error = job_request_error(params)
+    if error:
+        logger.info(error)
+        return get_response(HTTPStatus.BAD_REQUEST, error)
 
     # Stop commands that are requested during someone else's reservation.
     # Admins are ok
     user_id = params['user_id']
     site = params['site']
-    if calendar_blocks_user_commands(user_id, site) and not user_is_admin:
-        print("Disabling commands because another user has a reservation now.")
+    set_site(site)
+    with phase('calendar'):
+        calendar_blocked = calendar_blocks_user_commands(user_id, site)
+    if calendar_blocked and not user_is_admin:
+        logger.info("Disabling commands because another user has a reservation now.")
         error = ("Someone else has a reservation right now. "
                  "Please see the calendar for details.")
         return get_response(HTTPStatus.UNAUTHORIZED, error)
 
-    # Remove all prior commands if a cancel command is issued
+    # Cancel all prior commands that haven't been started if a cancel command
+    # is issued
     if params['action'] == 'cancel_all_commands':
-        site_jobs = get_all_site_jobs(params['site'], job_id)
-        remove_jobs(site_jobs)
+        with phase('query'):
+            pending_jobs = get_pending_site_jobs(params['site'], job_id)
+        with phase('writes'):
+            cancel_jobs(pending_jobs)
 
     # Build the jobs description and send it to dynamodb
-    dynamodb_entry = {
-        "site": f"{params['site']}",            # PK, GSI1 pk
-        "ulid": job_id,                         # SK
-        "statusId": f"UNREAD#{job_id}",         # GSI1 sk
-        "replicaStatusId": f"UNREAD#{job_id}",  # GSI2 sk
-        "user_name": params['user_name'],
-        "user_id": params['user_id'],
-        "user_roles": user_roles,
-        "timestamp_ms": timestamp_ms,
-        "deviceType": f"{params['device']}",
-        "deviceInstance": f"{params['instance']}",
-        "action": f"{params['action']}",
-        "optional_params": params.get('optional_params', {}),
-        "required_params": params.get('required_params', {}),
-    }
-    table_response = table.put_item(Item=dynamodb_entry)
+    dynamodb_entry = job_entry(params, ulid_obj, user_roles)
+    with phase('writes'):
+        table_response = get_table().put_item(Item=dynamodb_entry)
+
+    # Return the dynamodb entry, and the response from the table entry if
+    # debugging.
+    return_obj = dynamodb_entry
+    if is_debug(params):
+        return_obj = {
+            **dynamodb_entry,
+            "table_response": table_response,
+        }
+    with phase('serialization'):
+        body = to_json(return_obj, is_debug(params))
+    return get_response(HTTPStatus.OK, body)
 
-    # Return the dynamodb entry and the response from the table entry. 
-    return_obj = {
-        **dynamodb_entry,
-        "table_response": table_response,
-    }
-    return get_response(HTTPStatus.OK, json.dumps(return_obj, indent=4, cls=DecimalEncoder))
 
+@instrumented
+@handle_throttling
+def newJobs(event, context):
+    """Adds a sequence of jobs for an observatory in a single request.
+
+    Each job is validated the same way as in newJob, but the reservation
+    check runs once per user and site, and the jobs are written with batch
+    writes. Jobs are given ulids in the order they appear in the request, so
+    the observatory receives them in that order.
+
+    Args:
+        JSON request body including:
+            jobs (list): Jobs with the same keys required by newJob. The
+                cancel_all_commands action isn't accepted here.
+
+    Returns:
+        JSON list of the table entries that were added, in request order.
+        If only some of the jobs could be written before being throttled,
+        a 429 response whose body lists the request positions that were
+        written under 'written', and their table entries under 'jobs', so
+        that only the rest need to be sent again.
+    """
+    params = json.loads(event.get("body", ""))
+    logger.debug(f"params: {params}")
+
+    jobs = params.get('jobs')
+    if not isinstance(jobs, list) or not jobs:
+        error = "Error: jobs must be a non-empty list"
+        return get_response(HTTPStatus.BAD_REQUEST, error)
+    if len(jobs) > MAX_JOBS_PER_REQUEST:
+        error = f"Error: at most {MAX_JOBS_PER_REQUEST} jobs can be added at once"
+        return get_response(HTTPStatus.BAD_REQUEST, error)
+    for index, job in enumerate(jobs):
+        error = job_request_error(job) if isinstance(job, dict) else "Error: job is not an object"
+        if error:
+            logger.info(f"{error} (job {index})")
+            return get_response(HTTPStatus.BAD_REQUEST, f"{error} (job {index})")
+        if job['action'] == 'cancel_all_commands':
+            error = f"Error: send cancel_all_commands with /newjob (job {index})"
+            return get_response(HTTPStatus.BAD_REQUEST, error)
+
+    user_roles = event["requestContext"]["authorizer"]["userRoles"]
+    user_is_admin = 'admin' in user_roles
 
+    # Stop commands that are requested during someone else's reservation.
+    # Admins are ok
+    requesters = {(job['user_id'], job['site']) for job in jobs}
+    if len({site for _, site in requesters}) == 1:
+        set_site(jobs[0]['site'])
+    if not user_is_admin:
+        with phase('calendar'):
+            calendar_blocked = any(calendar_blocks_user_commands(user_id, site)
+                                   for user_id, site in requesters)
+        if calendar_blocked:
+            logger.info("Disabling commands because another user has a reservation now.")
+            error = ("Someone else has a reservation right now. "
+                     "Please see the calendar for details.")
+            return get_response(HTTPStatus.UNAUTHORIZED, error)
+
+    entries = [job_entry(job, ulid_obj, user_roles)
+               for job, ulid_obj in zip(jobs, sequential_ulids(len(jobs)))]
+    with phase('writes'):
+        try:
+            put_jobs(entries)
+        except UnprocessedWrites as e:
+            unprocessed = set(e.unprocessed)
+            written = [index for index in range(len(entries)) if index not in unprocessed]
+            raise Throttled(e.retry_after, details={
+                "written": written,
+                "jobs": [entries[index] for index in written],
+            })
+
+    with phase('serialization'):
+        body = to_json(entries, is_debug(params))
+    return get_response(HTTPStatus.OK, body)
+
+
+@instrumented
+@handle_throttling
 def updateJobStatus(event, context):
     """Updates the status of a job.
     
@@ -173,9 +404,8 @@ def updateJobStatus(event, context):
 
     use_alternate_queue = params.get('alternateQueue', False)
     status_key = "replicaStatusId" if use_alternate_queue else "statusId"
-    index = secondary_index_name(event)
 
-    print('params:', params)  # for debugging
+    logger.debug(f"params: {params}")
 
     # TODO: add a check to see if the status update is a valid state change.
 
@@ -187,22 +417,91 @@ def updateJobStatus(event, context):
         jobId = params['ulid']
     except Exception as e:
         return get_response(HTTPStatus.BAD_REQUEST, "Requires 'site' and 'jobId' in the body payload.")
+    set_site(site)
+
+    with phase('writes'):
+        try:
+            response = update_job_status(site, jobId, params['newStatus'],
+                                         secondsUntilComplete, status_key)
+        except JobNotFound as e:
+            return get_response(HTTPStatus.NOT_FOUND, str(e))
+    logger.debug(f"update status response: {response}")
+
+    if is_debug(params):
+        return get_response(HTTPStatus.OK, to_json(response, debug=True))
+    updated_job = {
+        "site": site,
+        "ulid": jobId,
+        status_key: f"{params['newStatus']}#{params['ulid']}",
+        "secondsUntilComplete": secondsUntilComplete,
+    }
+    return get_response(HTTPStatus.OK, to_json(updated_job))
 
-    response = table.update_item(
-        Key={
-            'site': site,
-            'ulid': jobId,
-        },
-        UpdateExpression="set statusId = :statId, secondsUntilComplete = :eta ",
-        ExpressionAttributeValues={
-            ':statId': f"{params['newStatus']}#{params['ulid']}",
-            ':eta': secondsUntilComplete
-        }
-    )
-    print('update status response: ', response)
-    return get_response(HTTPStatus.OK, json.dumps(response, indent=4, cls=DecimalEncoder))
 
+@instrumented
+@handle_throttling
+def updateJobStatuses(event, context):
+    """Updates the status of several of a site's jobs in one request.
 
+    Lets an observatory catch up on the status updates it would otherwise
+    send one at a time with updateJobStatus or startJob, for example after
+    reconnecting. Updates to different jobs are applied concurrently, and
+    updates to the same job in the order they are listed.
+
+    Args:
+        JSON request body including:
+            site (str): Sitecode of the jobs (e.g. "saf").
+            updates (list): Up to 100 updates, each with:
+                ulid (str): Unique ID of the job.
+                newStatus (str): New job status (e.g. "STARTED").
+                secondsUntilComplete (int): Optional, default -1.
+                alternateQueue (bool): Optional, default false.
+
+    Returns:
+        JSON list with a result for each update, in request order: the
+        updated ulid, status and secondsUntilComplete, or the ulid and an
+        error if that update couldn't be applied.
+    """
+    params = json.loads(event.get("body", ""))
+    logger.debug(f"params: {params}")
+
+    site = params.get('site')
+    updates = params.get('updates')
+    if not isinstance(site, str) or not isinstance(updates, list) or not updates:
+        error = "Error: requires 'site' and a non-empty list of 'updates'"
+        return get_response(HTTPStatus.BAD_REQUEST, error)
+    if len(updates) > MAX_UPDATES_PER_REQUEST:
+        error = f"Error: at most {MAX_UPDATES_PER_REQUEST} updates can be applied at once"
+        return get_response(HTTPStatus.BAD_REQUEST, error)
+    # Every update is checked before any are applied.
+    for index, update in enumerate(updates):
+        error = status_update_error(update)
+        if error:
+            return get_response(HTTPStatus.BAD_REQUEST, f"{error} (update {index})")
+    set_site(site)
+
+    with phase('writes'):
+        errors = update_job_statuses(site, updates)
+
+    results = []
+    for update, error in zip(updates, errors):
+        if error is not None:
+            logger.info(f"Failed to update {update['ulid']}: {error}")
+            results.append({"ulid": update['ulid'], "error": str(error)})
+            continue
+        status_key = "replicaStatusId" if update.get('alternateQueue', False) else "statusId"
+        results.append({
+            "ulid": update['ulid'],
+            status_key: f"{update['newStatus']}#{update['ulid']}",
+            "secondsUntilComplete": update.get('secondsUntilComplete', -1),
+        })
+    with phase('serialization'):
+        body = to_json(results, is_debug(params))
+    return get_response(HTTPStatus.OK, body)
+
+
+@instrumented
+@handle_throttling
 def getNewJobs(event, context):
     """Gets list of jobs with 'UNREAD' status, changes status to 'RECEIVED'.
     
@@ -214,43 +513,122 @@ def getNewJobs(event, context):
             alternateQueue (bool): whether to get the job from the alternate
                 command queue. This additional queue provides a way to read 
                 commands without affecting the other queue. Default is false.
+            limit (int): Optional maximum number of jobs to return.
+            cursor (str): Optional cursor returned by a previous request.
+            waitSeconds (number): Optional time to wait for a new job to
+                arrive if there are none yet, up to 20 seconds. Default is 0,
+                which returns immediately.
+            deviceType (str): Optional. Only return jobs for this type of
+                device (e.g. "camera"). Primary queue only.
+            deviceInstance (str): Optional. Only return jobs for this device
+                (e.g. "camera1"); requires deviceType.
+            urgentOnly (bool): Optional. Only return jobs with the highest
+                priority, such as stop and park, leaving the rest queued.
+                Default is false.
+            consumer (str): Optional. Instead of taking jobs from a queue,
+                return the jobs created since this named consumer's last
+                read, without changing them. Can't be combined with
+                alternateQueue, device filters, urgentOnly or cursor.
 
     Returns:
-        List of updated job objects (JSON).
+        List of updated job objects (JSON), highest priority first and then
+        oldest first. If limit or cursor was provided, an object with the
+        list under 'jobs' and the next 'cursor'.
     """
 
     params = json.loads(event.get("body", ""))
 
-    print('params: ',params) # for debugging
+    logger.debug(f"params: {params}")
 
     site = params['site']
+    set_site(site)
     use_alternate_queue = params.get('alternateQueue', False)
     status_key = "replicaStatusId" if use_alternate_queue else "statusId"
+    pending_key = PENDING_KEYS[status_key]
     index = secondary_index_name(event)
+    urgent_only = params.get('urgentOnly', False)
+    priority = URGENT_PRIORITY if urgent_only else None
 
-    # Query for unread items    
-    table_response = table.query(
-        IndexName=index,
-        KeyConditionExpression=Key('site').eq(site) 
-            & Key(status_key).begins_with("UNREAD")
-    )
-
-    # Update the status to 'RECEIVED' for all items returned.
-    for job in table_response['Items']:
-        table.update_item(
-            Key={
-                'site': job['site'], 
-                'ulid': job['ulid'] 
-            },
-            UpdateExpression=f"set {status_key} = :s",
-            ExpressionAttributeValues={
-                ':s': f"RECEIVED#{job['ulid']}"
-            }
-        )
-
-    return get_response(HTTPStatus.OK, json.dumps(table_response['Items'], indent=4, cls=DecimalEncoder))
-
-
+    try:
+        limit, cursor = get_page_params(params)
+        wait_seconds = get_wait_seconds(params)
+        device_type, device_instance = get_device_filter(params)
+        consumer = get_consumer(params)
+    except ValueError as e:
+        return get_response(HTTPStatus.BAD_REQUEST, str(e))
+
+    # Device workers read from the device index, which only holds the jobs
+    # that are UNREAD on the primary queue.
+    if device_type is not None:
+        if use_alternate_queue:
+            error = "Device filters are only available on the primary queue."
+            return get_response(HTTPStatus.BAD_REQUEST, error)
+        index, sort_key = DEVICE_QUEUE_INDEX, DEVICE_PENDING_KEY
+        prefix = device_pending_prefix(device_type, device_instance,
+                                       priority if device_instance is not None else None)
+        query_kwargs = {}
+        # Priority comes after the instance in the key, so it's filtered on
+        # when reading all the instances of a device type.
+        if urgent_only and device_instance is None:
+            query_kwargs["FilterExpression"] = Attr('priority').eq(URGENT_PRIORITY)
+    else:
+        sort_key, prefix, query_kwargs = pending_key, pending_prefix("UNREAD", priority), {}
+
+    # A device's jobs are all in one shard of a sharded site.
+    if device_instance is not None:
+        shards = [job_shard(site, device_type, device_instance)]
+    else:
+        shards = site_shards(site)
+
+    def take_jobs():
+        # Consumers read the jobs after their watermark, and leave them as
+        # they are.
+        if consumer is not None:
+            with phase('query'):
+                return read_consumer_jobs(site, consumer, limit), None
+
+        # Query for unread items
+        with phase('query'):
+            jobs, next_cursor = query_shards(shards,
+                lambda shard: Key(SHARD_KEY).eq(shard) & Key(sort_key).begins_with(prefix),
+                sort_key, limit, cursor,
+                IndexName=index,
+                **query_kwargs,
+            )
+
+        # Update the status to 'RECEIVED' for all items returned. Jobs that
+        # were claimed by an overlapping poll in the meantime are left out.
+        with phase('writes'):
+            return claim_jobs(jobs, status_key), next_cursor
+
+    deadline = long_poll_deadline(wait_seconds, context)
+    poll_interval = LONG_POLL_MIN_INTERVAL
+    while True:
+        try:
+            new_jobs, next_cursor = take_jobs()
+        except ValueError as e:
+            return get_response(HTTPStatus.BAD_REQUEST, str(e))
+
+        # Long polling: keep checking the queue until something arrives.
+        time_left = deadline - time.time()
+        if new_jobs or time_left <= 0:
+            break
+        time.sleep(min(poll_interval, time_left))
+        poll_interval = min(poll_interval * 2, LONG_POLL_MAX_INTERVAL)
+
+    # The pending indexes are already in this order, except across the
+    # instances of a device type. Consumers get jobs in the order they were
+    # created.
+    if consumer is None:
+        new_jobs.sort(key=lambda job: (-job.get('priority', DEFAULT_PRIORITY), job['ulid']))
+
+    with phase('serialization'):
+        body = to_json(page_body(new_jobs, next_cursor, params), is_debug(params))
+    return get_response(HTTPStatus.OK, body)
+
+
+@instrumented
+@handle_throttling
 def getRecentJobs(event, context):
     """Returns list of jobs that are no older than the provided length of time.
 
@@ -258,13 +636,22 @@ def getRecentJobs(event, context):
         JSON request body including:
             site (str): Site to retrieve job list from (e.g. "saf").
             timeRange (int): Maximum age of jobs returned in milliseconds.
+            limit (int): Optional maximum number of jobs to return.
+            cursor (str): Optional cursor returned by a previous request.
+            syncToken (str): Optional. null to get the jobs in timeRange
+                along with a token, or a token from a previous response to
+                get only the jobs written since that response.
 
     Returns:
-        List of job objects (JSON) younger than maximum age.
+        List of job objects (JSON) younger than maximum age. If limit or
+        cursor was provided, an object with the list under 'jobs' and the
+        next 'cursor'. If syncToken was provided, an object with the list
+        under 'jobs' and the next 'syncToken'.
     """
 
     params = json.loads(event.get("body", ""))
     site = params['site']
+    set_site(site)
 
     aDay = 24*3600*1000 # ms in a day (default value)
     timeRange = params.get('timeRange', aDay) / 1000 # convert to seconds
@@ -273,13 +660,92 @@ def getRecentJobs(event, context):
     earliest = now-timeRange
     earliestUlid = ulid.from_timestamp(earliest)
 
-    table_response = table.query(
-        KeyConditionExpression=Key('site').eq(site)
-            & Key('ulid').gte(earliestUlid.str)
-    )
-    return get_response(HTTPStatus.OK, json.dumps(table_response['Items'], indent=4, cls=DecimalEncoder))
+    try:
+        limit, cursor = get_page_params(params)
+        # Finished jobs are deleted once their retention period is over, so
+        # an older token could miss jobs that finished and expired since.
+        syncing, since_ms = get_sync_params(params,
+            now_ms() - JOB_RETENTION_DAYS * 24 * 3600 * 1000)
+        # Taken before querying, so the next sync covers anything written
+        # while this one runs.
+        next_sync_token = encode_sync_token(now_ms() - SYNC_OVERLAP_MS)
+        with phase('query'):
+            if since_ms is not None:
+                # Only the jobs written since the last sync.
+                jobs, next_cursor = query_shards(site_shards(site),
+                    lambda shard: Key(SHARD_KEY).eq(shard)
+                        & Key('lastModified').gte(since_ms),
+                    'lastModified',
+                    IndexName="SiteChangesByShard",
+                )
+            else:
+                jobs, next_cursor = query_page(limit, cursor,
+                    KeyConditionExpression=Key('site').eq(site)
+                        & Key('ulid').gte(earliestUlid.str)
+                )
+    except ValueError as e:
+        return get_response(HTTPStatus.BAD_REQUEST, str(e))
+
+    if syncing:
+        body = {"jobs": jobs, "syncToken": next_sync_token}
+    else:
+        body = page_body(jobs, next_cursor, params)
+    with phase('serialization'):
+        body = to_json(body, is_debug(params))
+    return get_response(HTTPStatus.OK, body)
+
+
+@instrumented
+@handle_throttling
+def getRecentJobsForSites(event, context):
+    """Returns the recent jobs of several sites in one request.
+
+    Intended for dashboards that show the whole network. The sites are
+    queried concurrently and the results merged in ulid order.
+
+    Args:
+        JSON request body including:
+            sites (list): Sites to retrieve jobs from (e.g. ["saf", "mrc"]).
+            timeRange (int): Maximum age of jobs returned in milliseconds.
+            limit (int): Optional maximum number of jobs to return in total,
+                up to and by default 1000. The most recent jobs are kept.
+
+    Returns:
+        JSON body with the list of jobs under 'jobs', oldest first, and
+        'truncated', which is true if more jobs matched than were returned.
+    """
+    params = json.loads(event.get("body", ""))
+
+    sites = params.get('sites')
+    if not isinstance(sites, list) or not sites \
+            or not all(isinstance(site, str) and site for site in sites):
+        error = "Error: sites must be a non-empty list of sitecodes"
+        return get_response(HTTPStatus.BAD_REQUEST, error)
+    if len(sites) > MAX_SITES_PER_REQUEST:
+        error = f"Error: at most {MAX_SITES_PER_REQUEST} sites can be read at once"
+        return get_response(HTTPStatus.BAD_REQUEST, error)
+    if 'cursor' in params:
+        return get_response(HTTPStatus.BAD_REQUEST, "'cursor' is not supported here.")
+    try:
+        limit, _ = get_page_params(params)
+    except ValueError as e:
+        return get_response(HTTPStatus.BAD_REQUEST, str(e))
+
+    aDay = 24*3600*1000 # ms in a day (default value)
+    timeRange = params.get('timeRange', aDay) / 1000 # convert to seconds
+    earliestUlid = ulid.from_timestamp(time.time() - timeRange)
 
+    with phase('query'):
+        jobs, truncated = get_recent_jobs_for_sites(
+            list(dict.fromkeys(sites)), earliestUlid.str, limit or MAX_PAGE_LIMIT)
 
+    with phase('serialization'):
+        body = to_json({"jobs": jobs, "truncated": truncated}, is_debug(params))
+    return get_response(HTTPStatus.OK, body)
+
+
+@instrumented
+@handle_throttling
 def startJob(event, context):
     """Begins a job request from the jobs DnyamoDB table.
 
@@ -305,30 +771,34 @@ def startJob(event, context):
 
     params = json.loads(event.get("body", ""))
 
-    print('params:', params)  # for debugging
+    logger.debug(f"params: {params}")
 
     try:
         site = params['site']
         jobId = params['ulid']
         use_alternate_queue = params.get('alternateQueue', False)
         status_key = "replicaStatusId" if use_alternate_queue else "statusId"
-        index = secondary_index_name(event)
     except Exception as e:
         return get_response(HTTPStatus.BAD_REQUEST, "Requires 'site' and 'jobId' in the body payload.")
+    set_site(site)
 
     # Time estimate for task that is starting. Empty value gets default of -1.
     secondsUntilComplete = params.get('secondsUntilComplete', -1)
 
-    response = table.update_item(
-        Key={
-            'site': site,
-            'ulid': jobId,
-        },
-        UpdateExpression=f"set {status_key} = :statId, secondsUntilComplete = :eta ",
-        ExpressionAttributeValues={
-            ':statId': f"STARTED#{jobId}",
-            ':eta': secondsUntilComplete
-        }
-    )
-
-    return get_response(HTTPStatus.OK, json.dumps(response, indent=4, cls=DecimalEncoder))
+    # Starting the job also takes it out of the queue's pending index.
+    with phase('writes'):
+        try:
+            response = update_job_status(site, jobId, "STARTED",
+                                         secondsUntilComplete, status_key)
+        except JobNotFound as e:
+            return get_response(HTTPStatus.NOT_FOUND, str(e))
+
+    if is_debug(params):
+        return get_response(HTTPStatus.OK, to_json(response, debug=True))
+    updated_job = {
+        "site": site,
+        "ulid": jobId,
+        status_key: f"STARTED#{jobId}",
+        "secondsUntilComplete": secondsUntilComplete,
+    }
+    return get_response(HTTPStatus.OK, to_json(updated_job))
@@ -2,16 +2,20 @@ import json
 import os 
 import decimal 
 import sys
+import time
+import base64
+import binascii
 import datetime
-import requests
-import boto3
 
 
+# Verbose output, such as full request payloads, is logged at DEBUG level.
+LOG_LEVEL = os.getenv('LOG_LEVEL', 'INFO').upper()
+
 #=========================================#
 #=======     Helper Functions     ========#
 #=========================================#
 
-def get_response(status_code, body):
+def get_response(status_code, body, headers=None):
     if not isinstance(body, str):
         body = json.dumps(body)
     return {
@@ -21,6 +25,7 @@ def get_response(status_code, body):
             "Access-Control-Allow-Origin": "*",
             # Required for cookies, authorization headers with HTTPS
             "Access-Control-Allow-Credentials": "true",
+            **(headers or {}),
         },
         "body": body
     }
@@ -35,14 +40,234 @@ class DecimalEncoder(json.JSONEncoder):
                 return int(o)
         return super(DecimalEncoder, self).default(o)
 
+def is_debug(params):
+    """ Whether the request asked for a verbose, pretty-printed response. """
+    return params.get('debug', False) is True
+
+def to_json(body, debug=False):
+    """Serialize a response body.
+
+    Responses are compact by default. Debug responses are indented to make
+    them easier to read.
+    """
+    if debug:
+        return json.dumps(body, indent=4, cls=DecimalEncoder)
+    return json.dumps(body, separators=(',', ':'), cls=DecimalEncoder)
+
 # Return the dynamodb index to use based on the request body
 def secondary_index_name(event):
     params = json.loads(event.get("body"))
     use_alternate_queue = params.get("alternateQueue", False)
     if use_alternate_queue:
-        return "ReplicaReadStatus"
+        return "ReplicaPendingJobsByShard"
     else:
-        return "StatusId"
+        return "PendingJobsByShard"
+
+# Largest page size a client may request from a paginated endpoint.
+MAX_PAGE_LIMIT = 1000
+
+def encode_cursor(last_evaluated_key):
+    """ Turn a dynamodb LastEvaluatedKey into an opaque, url-safe cursor """
+    if not last_evaluated_key:
+        return None
+    key_json = json.dumps(last_evaluated_key, cls=DecimalEncoder)
+    return base64.urlsafe_b64encode(key_json.encode()).decode()
+
+def decode_cursor(cursor):
+    """ Inverse of encode_cursor. Raises ValueError for a malformed cursor. """
+    if not cursor:
+        return None
+    try:
+        start_key = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    except (binascii.Error, UnicodeError, ValueError):
+        raise ValueError("Invalid cursor.")
+    if not isinstance(start_key, dict):
+        raise ValueError("Invalid cursor.")
+    return start_key
+
+def get_page_params(params):
+    """Read the optional 'limit' and 'cursor' pagination values from a request.
+
+    Args:
+        params (dict): Parsed request body.
+
+    Returns:
+        tuple: (limit, cursor) where limit is an int or None.
+
+    Raises:
+        ValueError: If limit is not a positive integer.
+    """
+    limit = params.get('limit')
+    if limit is not None:
+        if isinstance(limit, bool) or not isinstance(limit, int) or limit < 1:
+            raise ValueError("'limit' must be a positive integer.")
+        limit = min(limit, MAX_PAGE_LIMIT)
+    return limit, params.get('cursor')
+
+def page_body(items, next_cursor, params):
+    """Build the response body for a paginated endpoint.
+
+    Requests that don't use pagination get the plain list of items, as they
+    always have. Requests with a 'limit' or 'cursor' get the items along with
+    the cursor for the following page (None once everything has been read).
+    """
+    if 'limit' not in params and 'cursor' not in params:
+        return items
+    return {
+        "jobs": items,
+        "cursor": next_cursor,
+    }
+
+def get_device_filter(params):
+    """Read the optional 'deviceType' and 'deviceInstance' values from a request.
+
+    Returns:
+        tuple: (device_type, device_instance), either of which may be None.
+
+    Raises:
+        ValueError: If a value is not a non-empty string without '#', or an
+            instance is given without its device type.
+    """
+    device_type = params.get('deviceType')
+    device_instance = params.get('deviceInstance')
+    for name, value in [('deviceType', device_type), ('deviceInstance', device_instance)]:
+        if value is not None and (not isinstance(value, str) or not value or '#' in value):
+            raise ValueError(f"'{name}' must be a non-empty string without '#'.")
+    if device_instance is not None and device_type is None:
+        raise ValueError("'deviceInstance' requires 'deviceType'.")
+    return device_type, device_instance
+
+# Longest consumer name accepted by getNewJobs.
+MAX_CONSUMER_NAME_LENGTH = 64
+
+def get_consumer(params):
+    """Read the optional 'consumer' name from a getNewJobs request.
+
+    A consumer reads the jobs after its own watermark instead of taking them
+    from a queue, so it can't be combined with the queue options.
+
+    Returns:
+        str: The consumer name, or None.
+
+    Raises:
+        ValueError: If the name is not a non-empty string of at most 64
+            characters, or is combined with a queue option.
+    """
+    consumer = params.get('consumer')
+    if consumer is None:
+        return None
+    if not isinstance(consumer, str) or not 0 < len(consumer) <= MAX_CONSUMER_NAME_LENGTH:
+        raise ValueError(f"'consumer' must be a string of 1 to {MAX_CONSUMER_NAME_LENGTH} characters.")
+    for option in ['alternateQueue', 'deviceType', 'deviceInstance', 'urgentOnly', 'cursor']:
+        if params.get(option):
+            raise ValueError(f"'consumer' can't be combined with '{option}'.")
+    return consumer
+
+# Job priorities, from 0 (lowest) to 9 (most urgent). Jobs in the queue are
+# handed out most urgent first, then oldest first.
+MIN_PRIORITY = 0
+MAX_PRIORITY = 9
+DEFAULT_PRIORITY = 5
+URGENT_PRIORITY = MAX_PRIORITY
+
+# Actions that make the observatory safe are always urgent, so that they
+# aren't stuck behind a long queue of other jobs.
+SAFETY_ACTIONS = {'stop', 'park', 'cancel', 'cancel_all_commands'}
+
+def get_priority(params):
+    """Read the priority of a requested job.
+
+    Safety actions are always given URGENT_PRIORITY, whatever was requested.
+    Otherwise the optional 'priority' value is used, or DEFAULT_PRIORITY.
+
+    Raises:
+        ValueError: If 'priority' is not an integer from 0 to 9.
+    """
+    if params.get('action') in SAFETY_ACTIONS:
+        return URGENT_PRIORITY
+    priority = params.get('priority', DEFAULT_PRIORITY)
+    if isinstance(priority, bool) or not isinstance(priority, int) \
+            or not MIN_PRIORITY <= priority <= MAX_PRIORITY:
+        raise ValueError(f"'priority' must be an integer from {MIN_PRIORITY} to {MAX_PRIORITY}.")
+    return priority
+
+# Changes are reported from this long before the previous sync, so writes
+# that were still reaching the changes index at the time aren't missed.
+SYNC_OVERLAP_MS = 2000
+
+def now_ms():
+    """ Current time as integer milliseconds since the epoch. """
+    return int(time.time() * 1000)
+
+def encode_sync_token(since_ms):
+    """ Opaque token for the jobs changed at or after the given time. """
+    return encode_cursor({"since": since_ms})
+
+def get_sync_params(params, oldest_ms=None):
+    """Read the optional 'syncToken' value from a request.
+
+    A request with "syncToken": null starts syncing, and one with a token
+    from a previous response asks for the changes since then.
+
+    Args:
+        params (dict): The request body.
+        oldest_ms (int): Tokens for changes before this time are rejected.
+
+    Returns:
+        tuple: (syncing, since_ms) where since_ms is None for a first sync.
+
+    Raises:
+        ValueError: If the token is malformed, expired, or used with
+            pagination.
+    """
+    if 'syncToken' not in params:
+        return False, None
+    if 'limit' in params or 'cursor' in params:
+        raise ValueError("'syncToken' can't be combined with 'limit' or 'cursor'.")
+    token = params['syncToken']
+    if token is None:
+        return True, None
+    try:
+        since_ms = decode_cursor(token).get("since")
+    except (ValueError, AttributeError):
+        since_ms = None
+    if isinstance(since_ms, bool) or not isinstance(since_ms, int):
+        raise ValueError("Invalid syncToken.")
+    if oldest_ms is not None and since_ms < oldest_ms:
+        raise ValueError("syncToken has expired, send null to sync again.")
+    return True, since_ms
+
+# Limits for long polling in getNewJobs, in seconds. The maximum wait has to
+# fit within the function timeout and the api gateway timeout (29s).
+LONG_POLL_MAX_WAIT = 20
+# The queue is checked again after 2, 4, then every 5 seconds: 6 queries for
+# a 20 second wait that finds nothing. Each query of a pending index costs at
+# least 0.5 read capacity units (times the number of shards of a sharded
+# site), so an idle long poll uses about 0.15 RCU/s of an index provisioned
+# with 1 RCU, and around 6 observatories can wait at once before polls are
+# throttled. Observatories that need new jobs sooner can use push delivery.
+LONG_POLL_MIN_INTERVAL = 2
+LONG_POLL_MAX_INTERVAL = 5
+
+def get_wait_seconds(params):
+    """Read the optional 'waitSeconds' long polling value from a request.
+
+    Raises:
+        ValueError: If waitSeconds is not a non-negative number.
+    """
+    wait_seconds = params.get('waitSeconds', 0)
+    if isinstance(wait_seconds, bool) or not isinstance(wait_seconds, (int, float)) \
+            or wait_seconds < 0:
+        raise ValueError("'waitSeconds' must be a non-negative number.")
+    return min(wait_seconds, LONG_POLL_MAX_WAIT)
+
+def long_poll_deadline(wait_seconds, context):
+    """ Returns the time to stop waiting, leaving room to build a response """
+    deadline = time.time() + wait_seconds
+    if context is not None and hasattr(context, 'get_remaining_time_in_millis'):
+        time_remaining = context.get_remaining_time_in_millis() / 1000 - 2
+        deadline = min(deadline, time.time() + time_remaining)
+    return deadline
 
 def get_calendar_url(subdirectory: str) -> str:
     """ Return the url for the photonranch-calendar api """
@@ -62,9 +287,61 @@ def get_calendar_url(subdirectory: str) -> str:
 #=======    External API Calls    ========#
 #=========================================#
 
+# How long to trust a calendar lookup. With no reservation in progress, a new
+# one could be created at any moment, so that result is only kept briefly.
+RESERVATION_CACHE_TTL_EMPTY = 30  # seconds
+RESERVATION_CACHE_TTL_MAX = 300  # seconds
+
+# (connect, read) timeouts for calls to the calendar api, in seconds.
+CALENDAR_TIMEOUT = (3.05, 5)
+
+# Reused across invocations while the lambda container stays warm.
+_http_session = None
+_reservations_cache = {}  # site -> (expires_at, reservations)
+
+def get_http_session():
+    global _http_session
+    if _http_session is None:
+        # Imported here so functions that never call the calendar don't pay
+        # for loading requests on a cold start.
+        import requests
+        _http_session = requests.Session()
+    return _http_session
+
+def _parse_iso_datetime(value):
+    """ Parse an ISO 8601 string (e.g. '2022-01-01T04:30:00Z') as UTC """
+    parsed = datetime.datetime.fromisoformat(value.replace('Z', '+00:00'))
+    if parsed.tzinfo is None:
+        parsed = parsed.replace(tzinfo=datetime.timezone.utc)
+    return parsed
+
+def reservations_cache_expiry(reservations, now):
+    """Returns the unix time until which a calendar lookup can be reused.
+
+    A lookup stays valid until the first of the current reservations ends,
+    since that's the next time the answer can change without the calendar
+    being edited. Edits are picked up after RESERVATION_CACHE_TTL_MAX.
+    """
+    if not reservations:
+        return now + RESERVATION_CACHE_TTL_EMPTY
+
+    expires_at = now + RESERVATION_CACHE_TTL_MAX
+    for reservation in reservations:
+        try:
+            end = _parse_iso_datetime(reservation['end']).timestamp()
+        except (KeyError, TypeError, ValueError):
+            return now + RESERVATION_CACHE_TTL_EMPTY
+        expires_at = min(expires_at, end)
+    return expires_at
+
 def get_current_reservations(site):
     """ Call the calendar api to get any current reservations """
 
+    now = time.time()
+    cached = _reservations_cache.get(site)
+    if cached is not None and now < cached[0]:
+        return cached[1]
+
     # Current time in ISO 8601 format
     iso_datestring = datetime.datetime.utcnow() \
             .strftime('%Y-%m-%dT%H:%M:%S.%f')[:-7] + 'Z'
@@ -74,32 +351,11 @@ def get_current_reservations(site):
         "site": site,
         "time": iso_datestring,
     })
-    active_reservations = requests.post(url, body).json()
-    return active_reservations
-
-
-#=========================================#
-#======= Datastreamer Connection  ========#
-#=========================================#
-
-def get_queue_url(queueName):
-    sqs_client = boto3.client("sqs", region_name="us-east-1")
-    response = sqs_client.get_queue_url(
-        QueueName=queueName,
-    )
-    return response["QueueUrl"]
-
-def send_to_datastream(site, data):
-    sqs = boto3.client('sqs')
-    queue_url = get_queue_url('datastreamIncomingQueue-dev')
+    response = get_http_session().post(url, body, timeout=CALENDAR_TIMEOUT)
+    active_reservations = response.json()
 
-    payload = {
-        "topic": "jobs",
-        "site": site,
-        "data": data,
-    }
-    response = sqs.send_message(
-        QueueUrl=queue_url,
-        MessageBody=json.dumps(payload, cls=DecimalEncoder),
-    )
-    return response
\ No newline at end of file
+    # Error responses come back as a dict; only cache real results.
+    if isinstance(active_reservations, list):
+        expires_at = reservations_cache_expiry(active_reservations, now)
+        _reservations_cache[site] = (expires_at, active_reservations)
+    return active_reservations
@@ -0,0 +1,83 @@
+"""Cold start import cost of each lambda function.
+
+Imports each function's handler in a fresh interpreter, the way a new lambda
+container would, and reports how long the import took and which of the heavy
+optional libraries were loaded along the way.
+
+Example:
+    $ python -m src.import_benchmark --repeat 5
+"""
+import argparse
+import json
+import statistics
+import subprocess
+import sys
+
+# Function name -> handler, as configured in serverless.yml.
+FUNCTIONS = {
+    'newJob': 'src.handler.newJob',
+    'newJobs': 'src.handler.newJobs',
+    'updateJobStatus': 'src.handler.updateJobStatus',
+    'updateJobStatuses': 'src.handler.updateJobStatuses',
+    'getNewJobs': 'src.handler.getNewJobs',
+    'getRecentJobs': 'src.handler.getRecentJobs',
+    'getRecentJobsForSites': 'src.handler.getRecentJobsForSites',
+    'startJob': 'src.handler.startJob',
+    'authorizerFunc': 'src.authorizer.auth',
+    'connectHandler': 'src.handler.connectHandler',
+    'disconnectHandler': 'src.handler.disconnectHandler',
+    'streamFunction': 'src.handler.streamHandler',
+    'archiveFunction': 'src.handler.archiveHandler',
+}
+
+# Libraries that only some of the functions need at runtime.
+HEAVY_MODULES = ['boto3', 'ulid', 'requests', 'jwt', 'cryptography']
+
+_MEASURE = """
+import importlib, json, sys, time
+module_name, attribute = sys.argv[1].rsplit('.', 1)
+start = time.perf_counter()
+getattr(importlib.import_module(module_name), attribute)
+elapsed = time.perf_counter() - start
+print(json.dumps({
+    "import_ms": elapsed * 1000,
+    "loaded": [m for m in json.loads(sys.argv[2]) if m in sys.modules],
+}))
+"""
+
+
+def measure(handler_path):
+    """ Import a handler in a new python process and return the results. """
+    output = subprocess.check_output(
+        [sys.executable, "-c", _MEASURE, handler_path, json.dumps(HEAVY_MODULES)],
+        env={"AWS_DEFAULT_REGION": "us-east-1", "DYNAMODB_JOBS": "benchmark"},
+    )
+    return json.loads(output)
+
+
+def run_benchmark(repeat=5):
+    results = {}
+    for function, handler_path in FUNCTIONS.items():
+        runs = [measure(handler_path) for _ in range(repeat)]
+        results[function] = {
+            "handler": handler_path,
+            "import_ms": statistics.median(run["import_ms"] for run in runs),
+            "loaded": runs[0]["loaded"],
+        }
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--repeat", type=int, default=5,
+                        help="imports per function; the median is reported")
+    parser.add_argument("--json", action="store_true", help="print results as JSON")
+    args = parser.parse_args()
+
+    results = run_benchmark(args.repeat)
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        print(f"{'function':<24}{'import ms':>10}  heavy modules loaded")
+        for function, result in results.items():
+            print(f"{function:<24}{result['import_ms']:>10.1f}  {', '.join(result['loaded'])}")
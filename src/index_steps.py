@@ -0,0 +1,81 @@
+"""Picks the step of table_indexes.yml to deploy to a stage's jobs table.
+
+CloudFormation can only create or delete one global secondary index per
+deploy. This compares the indexes the jobs table has now with each step in
+table_indexes.yml, and prints the step after the one they match, so a stage
+reaches the current indexes one index at a time. A table that doesn't exist
+yet is created with the current indexes. The deploy workflow deploys the
+printed step until it prints "current", and stops if the table's indexes
+don't match any step.
+
+Example:
+    $ python -m src.index_steps photonranch-jobs-dev
+    addReplicaPendingJobs
+"""
+import argparse
+import os
+import sys
+
+import boto3
+import yaml
+from botocore.exceptions import ClientError
+
+STEPS_FILE = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                          'table_indexes.yml')
+
+# The step serverless.yml deploys when no indexStep is given.
+CURRENT_STEP = 'current'
+
+
+def load_steps(path=STEPS_FILE) -> list:
+    """ (step name, set of index names) for each step, in deploy order. """
+    with open(path) as f:
+        steps = yaml.safe_load(f)['steps']
+    return [(name, {index['IndexName'] for index in step['GlobalSecondaryIndexes']})
+            for name, step in steps.items()]
+
+
+def next_step(index_names, steps: list) -> str:
+    """Returns the step to deploy to a table with the given indexes.
+
+    Args:
+        index_names: Names of the table's indexes, or None if there is no
+            table yet.
+        steps (list): As returned by load_steps, ending with the current step.
+
+    Returns:
+        str: The step after the one that matches the table, or the current
+            step if the table is already there or doesn't exist.
+
+    Raises:
+        ValueError: If the table's indexes don't match any step.
+    """
+    if index_names is None:
+        return CURRENT_STEP
+    for position, (_, indexes) in enumerate(steps):
+        if indexes == set(index_names):
+            return steps[min(position + 1, len(steps) - 1)][0]
+    raise ValueError(f"The table's indexes {sorted(index_names)} don't match any step "
+                     f"of table_indexes.yml")
+
+
+def table_index_names(table_name: str):
+    """ Names of a table's global secondary indexes, or None if it doesn't exist. """
+    try:
+        table = boto3.client('dynamodb').describe_table(TableName=table_name)['Table']
+    except ClientError as e:
+        if e.response['Error']['Code'] == 'ResourceNotFoundException':
+            return None
+        raise
+    return [index['IndexName'] for index in table.get('GlobalSecondaryIndexes', [])]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("table", help="name of the jobs table, e.g. photonranch-jobs-dev")
+    args = parser.parse_args()
+
+    try:
+        print(next_step(table_index_names(args.table), load_steps()))
+    except ValueError as e:
+        sys.exit(str(e))
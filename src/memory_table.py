@@ -0,0 +1,626 @@
+"""In-memory stand-in for the jobs DynamoDB table.
+
+Implements the parts of the boto3 Table resource (and of its low-level
+client) that this service uses, including the secondary indexes and the
+table stream, so the handlers can be run and benchmarked without AWS.
+
+Items are stored in their serialized dynamodb form, so anything boto3 would
+refuse to write (floats, for example) is refused here too.
+"""
+import json
+import math
+import re
+import threading
+import time
+from collections import Counter
+from types import SimpleNamespace
+
+from boto3.dynamodb.types import TypeDeserializer, TypeSerializer
+from botocore.exceptions import ClientError
+
+from src.storage import NativeNumberDeserializer
+
+# Mirrors the jobsTable definition in serverless.yml, with the current step of
+# table_indexes.yml.
+JOBS_KEY_SCHEMA = ('site', 'ulid')
+JOBS_INDEXES = {
+    'PendingJobsByShard': ('siteShard', 'pendingId'),
+    'ReplicaPendingJobsByShard': ('siteShard', 'replicaPendingId'),
+    'PendingDeviceJobsByShard': ('siteShard', 'devicePendingId'),
+    'SiteChangesByShard': ('siteShard', 'lastModified'),
+}
+
+# Splits an update expression into its SET/REMOVE/ADD clauses.
+_UPDATE_ACTION_RE = re.compile(r'\b(set|remove|add)\b', re.IGNORECASE)
+_IF_NOT_EXISTS_RE = re.compile(r'^if_not_exists\s*\((.+),(.+)\)$', re.IGNORECASE)
+
+_serializer = TypeSerializer()
+_deserializer = TypeDeserializer()
+_native_deserializer = NativeNumberDeserializer()
+
+
+def _serialize(item):
+    return {k: _serializer.serialize(v) for k, v in item.items()}
+
+
+def _deserialize(raw_item, deserializer=_deserializer):
+    return {k: deserializer.deserialize(v) for k, v in raw_item.items()}
+
+
+def _client_error(code, operation, message=""):
+    error = {'Error': {'Code': code, 'Message': message}}
+    return ClientError(error, operation)
+
+
+def _split_top_level(expression):
+    """ Split on commas that aren't inside parentheses. """
+    parts, depth, current = [], 0, ''
+    for char in expression:
+        if char == '(':
+            depth += 1
+        elif char == ')':
+            depth -= 1
+        if char == ',' and depth == 0:
+            parts.append(current.strip())
+            current = ''
+        else:
+            current += char
+    if current.strip():
+        parts.append(current.strip())
+    return parts
+
+
+def evaluate_condition(condition, item):
+    """Evaluates a boto3 Key/Attr condition against a (deserialized) item."""
+    expression = condition.get_expression()
+    operator = expression['operator']
+    values = expression['values']
+
+    if operator == 'AND':
+        return all(evaluate_condition(v, item) for v in values)
+    if operator == 'OR':
+        return any(evaluate_condition(v, item) for v in values)
+    if operator == 'NOT':
+        return not evaluate_condition(values[0], item)
+
+    name = values[0].name
+    if operator == 'attribute_exists':
+        return name in item
+    if operator == 'attribute_not_exists':
+        return name not in item
+    if name not in item:
+        return False
+
+    actual = item[name]
+    operands = values[1:]
+    try:
+        if operator == '=':
+            return actual == operands[0]
+        if operator == '<>':
+            return actual != operands[0]
+        if operator == '<':
+            return actual < operands[0]
+        if operator == '<=':
+            return actual <= operands[0]
+        if operator == '>':
+            return actual > operands[0]
+        if operator == '>=':
+            return actual >= operands[0]
+        if operator == 'BETWEEN':
+            return operands[0] <= actual <= operands[1]
+        if operator == 'IN':
+            return actual in operands[0]
+    except TypeError:
+        # Dynamodb treats comparisons between different types as false.
+        return False
+    if operator == 'begins_with':
+        return isinstance(actual, str) and actual.startswith(operands[0])
+    if operator == 'contains':
+        return operands[0] in actual
+    raise NotImplementedError(f"Unsupported condition operator: {operator}")
+
+
+def _partition_value(condition, hash_key):
+    """ Find the value the partition key is compared to in a key condition. """
+    expression = condition.get_expression()
+    if expression['operator'] == 'AND':
+        for value in expression['values']:
+            found = _partition_value(value, hash_key)
+            if found is not None:
+                return found
+        return None
+    if expression['operator'] == '=' and expression['values'][0].name == hash_key:
+        return expression['values'][1]
+    return None
+
+
+def _condition_attributes(condition):
+    """ Names of the attributes a boto3 Key/Attr condition refers to. """
+    names = set()
+    for value in condition.get_expression()['values']:
+        if hasattr(value, 'get_expression'):
+            names |= _condition_attributes(value)
+        elif hasattr(value, 'name'):
+            names.add(value.name)
+    return names
+
+
+def _check_key_ranges(condition):
+    """ Dynamodb rejects a BETWEEN key condition whose bounds are reversed. """
+    expression = condition.get_expression()
+    if expression['operator'] == 'AND':
+        for value in expression['values']:
+            _check_key_ranges(value)
+    elif expression['operator'] == 'BETWEEN':
+        low, high = expression['values'][1:]
+        if low > high:
+            raise _client_error('ValidationException', 'Query',
+                                'Invalid KeyConditionExpression: The BETWEEN operator '
+                                'requires upper bound to be greater than or equal to '
+                                'lower bound')
+
+
+class _BatchWriter:
+    """ Counterpart of the boto3 batch_writer context manager. """
+
+    def __init__(self, table):
+        self._table = table
+        self._requests = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        for i in range(0, len(self._requests), 25):
+            chunk = self._requests[i:i + 25]
+            self._table.meta.client.batch_write_item(
+                RequestItems={self._table.name: chunk})
+        self._requests = []
+
+    def put_item(self, Item):
+        self._requests.append({'PutRequest': {'Item': Item}})
+
+    def delete_item(self, Key):
+        self._requests.append({'DeleteRequest': {'Key': Key}})
+
+
+class InMemoryClient:
+    """Counterpart of the low-level dynamodb client for in-memory tables."""
+
+    def __init__(self):
+        self._tables = {}
+
+    def register(self, table):
+        self._tables[table.name] = table
+
+    def query(self, TableName, **kwargs):
+        return self._tables[TableName].query(**kwargs)
+
+    def scan(self, TableName, **kwargs):
+        return self._tables[TableName].scan(**kwargs)
+
+    def get_item(self, TableName, **kwargs):
+        return self._tables[TableName].get_item(**kwargs)
+
+    def put_item(self, TableName, **kwargs):
+        return self._tables[TableName].put_item(**kwargs)
+
+    def update_item(self, TableName, **kwargs):
+        return self._tables[TableName].update_item(**kwargs)
+
+    def delete_item(self, TableName, **kwargs):
+        return self._tables[TableName].delete_item(**kwargs)
+
+    def batch_write_item(self, RequestItems, **kwargs):
+        consumed_capacity = []
+        for table_name, requests in RequestItems.items():
+            table = self._tables[table_name]
+            table._request('batch_write_item')
+            units = 0
+            for request in requests:
+                if 'PutRequest' in request:
+                    item = request['PutRequest']['Item']
+                    old_raw = table._write(item)
+                    units += table._write_units(old_raw, _serialize(item))
+                else:
+                    old_raw = table._remove(request['DeleteRequest']['Key'])
+                    units += table._write_units(old_raw, None)
+            consumed_capacity.append({'TableName': table_name, 'CapacityUnits': units})
+
+        response = {'UnprocessedItems': {}}
+        if kwargs.get('ReturnConsumedCapacity', 'NONE') != 'NONE':
+            response['ConsumedCapacity'] = consumed_capacity
+        return response
+
+
+class InMemoryTable:
+    """A dynamodb table held in memory.
+
+    Args:
+        name (str): Table name, as used by the low-level client calls.
+        key_schema (tuple): (partition key, sort key) of the table.
+        indexes (dict): Global secondary indexes as
+            {index name: (partition key, sort key)}. All are projected ALL.
+        page_size (int): Maximum number of items per query response, to
+            exercise pagination the way the 1 MB response limit would.
+        latency (float): Seconds each request takes, to stand in for the
+            network round trip to dynamodb.
+
+    Attributes:
+        calls (Counter): Number of requests made, by operation name.
+        stream (list): Stream records (NEW_AND_OLD_IMAGES) not yet consumed.
+    """
+
+    def __init__(self, name='photonranch-jobs-dev', key_schema=JOBS_KEY_SCHEMA,
+                 indexes=None, page_size=None, latency=0):
+        self.name = name
+        self.key_schema = key_schema
+        self.indexes = dict(JOBS_INDEXES if indexes is None else indexes)
+        self.page_size = page_size
+        self.latency = latency
+        self.calls = Counter()
+        self.stream = []
+
+        self._items = {}  # partition value -> {sort value: serialized item}
+        self._lock = threading.RLock()
+        self._sequence_number = 0
+
+        client = InMemoryClient()
+        client.register(self)
+        self.meta = SimpleNamespace(client=client)
+
+    #=======  Stream  ========#
+
+    def drain_stream(self):
+        """Returns the pending stream records and clears them."""
+        with self._lock:
+            records, self.stream = self.stream, []
+        return records
+
+    def _record(self, old_raw, new_raw, user_identity=None):
+        self._sequence_number += 1
+        raw = new_raw if new_raw is not None else old_raw
+        if old_raw is None:
+            event_name = 'INSERT'
+        elif new_raw is None:
+            event_name = 'REMOVE'
+        else:
+            event_name = 'MODIFY'
+        record = {
+            'eventID': str(self._sequence_number),
+            'eventName': event_name,
+            'eventSource': 'aws:dynamodb',
+            'dynamodb': {
+                'Keys': {k: raw[k] for k in self.key_schema},
+                'SequenceNumber': str(self._sequence_number).zfill(21),
+                'StreamViewType': 'NEW_AND_OLD_IMAGES',
+            },
+        }
+        if new_raw is not None:
+            record['dynamodb']['NewImage'] = new_raw
+        if old_raw is not None:
+            record['dynamodb']['OldImage'] = old_raw
+        if user_identity is not None:
+            record['userIdentity'] = user_identity
+        self.stream.append(record)
+
+    def expire_items(self, attribute, now=None):
+        """Deletes items whose time to live has passed, like dynamodb would.
+
+        Args:
+            attribute (str): The time to live attribute, in epoch seconds.
+            now (float): Current time, defaulting to time.time().
+
+        Returns:
+            int: Number of items deleted.
+        """
+        now = time.time() if now is None else now
+        identity = {'type': 'Service', 'principalId': 'dynamodb.amazonaws.com'}
+        expired = 0
+        with self._lock:
+            for partition in self._items.values():
+                for sort, raw in list(partition.items()):
+                    if attribute in raw and float(raw[attribute]['N']) <= now:
+                        del partition[sort]
+                        self._record(raw, None, identity)
+                        expired += 1
+        return expired
+
+    #=======  Storage  ========#
+
+    def _request(self, operation):
+        """ Count a request and wait out the simulated round trip. """
+        with self._lock:
+            self.calls[operation] += 1
+        if self.latency:
+            time.sleep(self.latency)
+
+    def _key_values(self, key):
+        hash_key, range_key = self.key_schema
+        return key[hash_key], key[range_key]
+
+    def _get_raw(self, key):
+        partition, sort = self._key_values(key)
+        return self._items.get(partition, {}).get(sort)
+
+    def _write(self, item):
+        """ Store an item, returning its previous serialized form. """
+        raw = _serialize(item)
+        partition, sort = self._key_values(item)
+        with self._lock:
+            old_raw = self._items.setdefault(partition, {}).get(sort)
+            self._items[partition][sort] = raw
+            self._record(old_raw, raw)
+        return old_raw
+
+    def _remove(self, key):
+        partition, sort = self._key_values(key)
+        with self._lock:
+            old_raw = self._items.get(partition, {}).pop(sort, None)
+            if old_raw is not None:
+                self._record(old_raw, None)
+        return old_raw
+
+    def _check_condition(self, condition, raw, operation):
+        if condition is None:
+            return
+        if isinstance(condition, str):
+            raise NotImplementedError("Use boto3 condition objects.")
+        item = _deserialize(raw) if raw is not None else {}
+        if not evaluate_condition(condition, item):
+            raise _client_error('ConditionalCheckFailedException', operation,
+                                "The conditional request failed")
+
+    def _capacity(self, response, kwargs, units):
+        """ Report roughly what dynamodb would charge, if asked to. """
+        if kwargs.get('ReturnConsumedCapacity', 'NONE') != 'NONE':
+            response['ConsumedCapacity'] = {
+                'TableName': self.name,
+                'CapacityUnits': units,
+            }
+        return response
+
+    def _write_units(self, old_raw, new_raw):
+        """ 1 WCU per KB written, to the table and each index with the item. """
+        raws = [raw for raw in (old_raw, new_raw) if raw is not None]
+        if not raws:
+            return 1
+        size_units = max(math.ceil(len(json.dumps(raw)) / 1024) for raw in raws)
+        indexes = sum(
+            1 for hash_key, range_key in self.indexes.values()
+            if any(hash_key in raw and range_key in raw for raw in raws)
+        )
+        return size_units * (1 + indexes)
+
+    def _response(self, raw, **response):
+        if raw is not None:
+            response['Attributes'] = _deserialize(raw, _native_deserializer)
+        return response
+
+    #=======  Table methods  ========#
+
+    def batch_writer(self, overwrite_by_pkeys=None):
+        return _BatchWriter(self)
+
+    def get_item(self, Key, ProjectionExpression=None,
+                 ExpressionAttributeNames=None, **kwargs):
+        self._request('get_item')
+        with self._lock:
+            raw = self._get_raw(Key)
+        if raw is None:
+            return self._capacity({}, kwargs, 0.5)
+        item = _deserialize(raw, _native_deserializer)
+        if ProjectionExpression:
+            item = self._project(item, ProjectionExpression, ExpressionAttributeNames)
+        return self._capacity({'Item': item}, kwargs, 0.5)
+
+    def put_item(self, Item, ConditionExpression=None, ReturnValues='NONE',
+                 **kwargs):
+        self._request('put_item')
+        with self._lock:
+            self._check_condition(ConditionExpression, self._get_raw(Item),
+                                  'PutItem')
+            old_raw = self._write(Item)
+        response = self._response(old_raw if ReturnValues == 'ALL_OLD' else None)
+        return self._capacity(response, kwargs,
+                              self._write_units(old_raw, _serialize(Item)))
+
+    def delete_item(self, Key, ConditionExpression=None, ReturnValues='NONE',
+                    **kwargs):
+        self._request('delete_item')
+        with self._lock:
+            self._check_condition(ConditionExpression, self._get_raw(Key),
+                                  'DeleteItem')
+            old_raw = self._remove(Key)
+        response = self._response(old_raw if ReturnValues == 'ALL_OLD' else None)
+        return self._capacity(response, kwargs, self._write_units(old_raw, None))
+
+    def update_item(self, Key, UpdateExpression, ExpressionAttributeValues=None,
+                    ExpressionAttributeNames=None, ConditionExpression=None,
+                    ReturnValues='NONE', **kwargs):
+        self._request('update_item')
+        values = ExpressionAttributeValues or {}
+        names = ExpressionAttributeNames or {}
+        with self._lock:
+            old_raw = self._get_raw(Key)
+            self._check_condition(ConditionExpression, old_raw, 'UpdateItem')
+
+            item = _deserialize(old_raw) if old_raw is not None else dict(Key)
+            updated = self._apply_update(item, UpdateExpression, values, names)
+            new_raw = _serialize(item)
+            partition, sort = self._key_values(Key)
+            self._items.setdefault(partition, {})[sort] = new_raw
+            self._record(old_raw, new_raw)
+
+        if ReturnValues == 'ALL_NEW':
+            response = self._response(new_raw)
+        elif ReturnValues == 'ALL_OLD':
+            response = self._response(old_raw)
+        elif ReturnValues == 'UPDATED_NEW':
+            response = self._response({k: new_raw[k] for k in updated if k in new_raw})
+        else:
+            response = {}
+        return self._capacity(response, kwargs, self._write_units(old_raw, new_raw))
+
+    def query(self, KeyConditionExpression, IndexName=None,
+              ExclusiveStartKey=None, Limit=None, ScanIndexForward=True,
+              FilterExpression=None, ProjectionExpression=None,
+              ExpressionAttributeNames=None, **kwargs):
+        self._request('query')
+        if IndexName is None:
+            hash_key, range_key = self.key_schema
+        else:
+            hash_key, range_key = self.indexes[IndexName]
+        partition = _partition_value(KeyConditionExpression, hash_key)
+        table_sort_key = self.key_schema[1]
+        _check_key_ranges(KeyConditionExpression)
+        if FilterExpression is not None:
+            keys = _condition_attributes(FilterExpression) & {hash_key, range_key}
+            if keys:
+                raise _client_error('ValidationException', 'Query',
+                                    'Filter Expression can only contain non-primary key '
+                                    f'attributes: Primary key attribute: {min(keys)}')
+
+        with self._lock:
+            if hash_key == self.key_schema[0]:
+                candidates = list(self._items.get(partition, {}).values())
+            else:
+                candidates = [raw for items in self._items.values()
+                              for raw in items.values()]
+
+        # Sort by the index's sort key, then the table's (which makes the
+        # order total for indexes whose sort keys can repeat).
+        def position(item):
+            return (item[range_key], item[table_sort_key])
+
+        matches = []
+        for raw in candidates:
+            item = _deserialize(raw)
+            if range_key in item and item.get(hash_key) == partition \
+                    and evaluate_condition(KeyConditionExpression, item):
+                matches.append((position(item), raw, item))
+        matches.sort(key=lambda match: match[0], reverse=not ScanIndexForward)
+
+        if ExclusiveStartKey:
+            start = position(ExclusiveStartKey)
+            if ScanIndexForward:
+                matches = [m for m in matches if m[0] > start]
+            else:
+                matches = [m for m in matches if m[0] < start]
+
+        page_limit = min(filter(None, [Limit, self.page_size]), default=None)
+        response = {}
+        if page_limit is not None and len(matches) > page_limit:
+            matches = matches[:page_limit]
+            last_item = matches[-1][2]
+            key_names = set(self.key_schema) | {hash_key, range_key}
+            response['LastEvaluatedKey'] = {k: last_item[k] for k in key_names}
+
+        items = []
+        for _, raw, item in matches:
+            if FilterExpression is not None \
+                    and not evaluate_condition(FilterExpression, item):
+                continue
+            item = _deserialize(raw, _native_deserializer)
+            if ProjectionExpression:
+                item = self._project(item, ProjectionExpression, ExpressionAttributeNames)
+            items.append(item)
+
+        response.update({
+            'Items': items,
+            'Count': len(items),
+            'ScannedCount': len(matches),
+        })
+        # 0.5 RCU per 4 KB read, for eventually consistent reads.
+        read_bytes = sum(len(json.dumps(raw)) for _, raw, _ in matches)
+        return self._capacity(response, kwargs,
+                              0.5 * max(1, math.ceil(read_bytes / 4096)))
+
+    def scan(self, ExclusiveStartKey=None, Limit=None, FilterExpression=None,
+             ProjectionExpression=None, ExpressionAttributeNames=None, **kwargs):
+        """ Reads every item in key order; pages the same way as query. """
+        self._request('scan')
+        with self._lock:
+            raws = [raw for items in self._items.values() for raw in items.values()]
+        matches = sorted(
+            ((self._key_values(_deserialize(raw)), raw) for raw in raws),
+            key=lambda match: match[0],
+        )
+        if ExclusiveStartKey:
+            start = self._key_values(ExclusiveStartKey)
+            matches = [m for m in matches if m[0] > start]
+
+        page_limit = min(filter(None, [Limit, self.page_size]), default=None)
+        response = {}
+        if page_limit is not None and len(matches) > page_limit:
+            matches = matches[:page_limit]
+            response['LastEvaluatedKey'] = dict(zip(self.key_schema, matches[-1][0]))
+
+        items = []
+        for _, raw in matches:
+            if FilterExpression is not None \
+                    and not evaluate_condition(FilterExpression, _deserialize(raw)):
+                continue
+            item = _deserialize(raw, _native_deserializer)
+            if ProjectionExpression:
+                item = self._project(item, ProjectionExpression, ExpressionAttributeNames)
+            items.append(item)
+
+        response.update({
+            'Items': items,
+            'Count': len(items),
+            'ScannedCount': len(matches),
+        })
+        read_bytes = sum(len(json.dumps(raw)) for _, raw in matches)
+        return self._capacity(response, kwargs,
+                              0.5 * max(1, math.ceil(read_bytes / 4096)))
+
+    #=======  Expressions  ========#
+
+    @staticmethod
+    def _project(item, projection, names):
+        names = names or {}
+        attributes = [names.get(a.strip(), a.strip()) for a in projection.split(',')]
+        return {k: v for k, v in item.items() if k in attributes}
+
+    @staticmethod
+    def _apply_update(item, expression, values, names):
+        """ Apply SET/REMOVE/ADD clauses to an item, returning changed names. """
+        def name(path):
+            path = path.strip()
+            return names.get(path, path)
+
+        def operand(text):
+            text = text.strip()
+            if text.startswith(':'):
+                return values[text]
+            match = _IF_NOT_EXISTS_RE.match(text)
+            if match:
+                attribute = name(match.group(1))
+                if attribute in item:
+                    return item[attribute]
+                return operand(match.group(2))
+            return item[name(text)]
+
+        updated = []
+        parts = _UPDATE_ACTION_RE.split(expression)
+        for action, body in zip(parts[1::2], parts[2::2]):
+            action = action.lower()
+            for clause in _split_top_level(body):
+                if action == 'set':
+                    path, value = clause.split('=', 1)
+                    if re.search(r'\s[+-]\s', value) and '(' not in value:
+                        left, sign, right = re.split(r'\s([+-])\s', value.strip())
+                        result = operand(left) + operand(right) if sign == '+' \
+                            else operand(left) - operand(right)
+                    else:
+                        result = operand(value)
+                    item[name(path)] = result
+                    updated.append(name(path))
+                elif action == 'remove':
+                    item.pop(name(clause), None)
+                elif action == 'add':
+                    path, value = clause.split(None, 1)
+                    item[name(path)] = item.get(name(path), 0) + operand(value)
+                    updated.append(name(path))
+        return updated
@@ -0,0 +1,167 @@
+"""Per-invocation timing and dynamodb capacity metrics.
+
+Each instrumented function prints one structured line per invocation in
+CloudWatch embedded metric format, so the values are available as CloudWatch
+metrics without any extra api calls. A line includes:
+    - total wall time, and wall time per phase (auth, calendar, query, ...)
+    - dynamodb requests made and read/write capacity units consumed
+    - the site the request was for, when there is one
+"""
+import functools
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+from types import SimpleNamespace
+
+METRICS_NAMESPACE = 'photonranch-jobs'
+METRICS_ENABLED = os.getenv('METRICS_ENABLED', 'true').lower() == 'true'
+
+READ_OPERATIONS = {'get_item', 'query', 'scan', 'batch_get_item'}
+WRITE_OPERATIONS = {'put_item', 'update_item', 'delete_item',
+                    'batch_write_item', 'transact_write_items'}
+
+# The invocation being measured. Lambda handles one request at a time per
+# container, but worker threads within a request record into it too.
+_current = None
+
+
+class Invocation:
+    """Measurements collected during a single function invocation."""
+
+    def __init__(self, function_name):
+        self.function_name = function_name
+        self.start = time.perf_counter()
+        self.phases = {}  # phase name -> seconds
+        self.dynamodb_requests = 0
+        self.read_units = 0.0
+        self.write_units = 0.0
+        self.site = None
+        self._lock = threading.Lock()
+
+    def add_phase(self, name, seconds):
+        with self._lock:
+            self.phases[name] = self.phases.get(name, 0) + seconds
+
+    def add_request(self, kind, consumed_capacity):
+        # Batch and transaction calls report capacity as a list, per table.
+        if isinstance(consumed_capacity, dict):
+            consumed_capacity = [consumed_capacity]
+        units = sum(c.get('CapacityUnits', 0) for c in consumed_capacity or [])
+        with self._lock:
+            self.dynamodb_requests += 1
+            if kind == 'read':
+                self.read_units += units
+            else:
+                self.write_units += units
+
+    def metric_line(self, status_code):
+        """ The invocation's measurements in CloudWatch embedded metric format """
+        values = {
+            "duration_ms": (time.perf_counter() - self.start) * 1000,
+            "dynamodb_requests": self.dynamodb_requests,
+            "consumed_rcu": self.read_units,
+            "consumed_wcu": self.write_units,
+        }
+        for name, seconds in self.phases.items():
+            values[f"{name}_ms"] = seconds * 1000
+
+        dimensions = [["function"]]
+        if self.site is not None:
+            dimensions.append(["function", "site"])
+        metrics = [
+            {"Name": name, "Unit": "Milliseconds" if name.endswith("_ms") else "Count"}
+            for name in values
+        ]
+        line = {
+            "_aws": {
+                "Timestamp": int(time.time() * 1000),
+                "CloudWatchMetrics": [{
+                    "Namespace": METRICS_NAMESPACE,
+                    "Dimensions": dimensions,
+                    "Metrics": metrics,
+                }],
+            },
+            "function": self.function_name,
+            "statusCode": status_code,
+            **values,
+        }
+        if self.site is not None:
+            line["site"] = self.site
+        return json.dumps(line, separators=(',', ':'))
+
+
+def instrumented(function):
+    """Decorator for lambda handlers that emits a metric line per invocation."""
+
+    @functools.wraps(function)
+    def wrapper(event, context):
+        global _current
+        _current = Invocation(function.__name__)
+        status_code = 500
+        try:
+            response = function(event, context)
+            if isinstance(response, dict):
+                status_code = response.get('statusCode', 200)
+            return response
+        finally:
+            invocation, _current = _current, None
+            if METRICS_ENABLED:
+                print(invocation.metric_line(status_code))
+
+    return wrapper
+
+
+@contextmanager
+def phase(name):
+    """Adds the time spent inside the block to the named phase."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        invocation = _current
+        if invocation is not None:
+            invocation.add_phase(name, time.perf_counter() - start)
+
+
+def set_site(site):
+    """Records which site the current invocation is for."""
+    if _current is not None:
+        _current.site = site
+
+
+class _CapacityRecorder:
+    """Wraps a dynamodb table or client so requests report consumed capacity."""
+
+    def __init__(self, target):
+        self._target = target
+
+    def __getattr__(self, name):
+        attribute = getattr(self._target, name)
+        if name in READ_OPERATIONS:
+            kind = 'read'
+        elif name in WRITE_OPERATIONS:
+            kind = 'write'
+        else:
+            return attribute
+
+        @functools.wraps(attribute)
+        def request(**kwargs):
+            kwargs.setdefault('ReturnConsumedCapacity', 'TOTAL')
+            response = attribute(**kwargs)
+            invocation = _current
+            if invocation is not None:
+                invocation.add_request(kind, response.get('ConsumedCapacity'))
+            return response
+
+        return request
+
+
+class InstrumentedTable(_CapacityRecorder):
+    """A jobs table whose requests, including those made through its
+    low-level client, are counted against the current invocation."""
+
+    def __init__(self, table):
+        super().__init__(table)
+        self.meta = SimpleNamespace(client=_CapacityRecorder(table.meta.client))
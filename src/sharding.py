@@ -0,0 +1,59 @@
+"""Spreads a busy site's queue across several index partitions.
+
+The queue and change indexes (PendingJobsByShard,
+ReplicaPendingJobsByShard, PendingDeviceJobsByShard and SiteChangesByShard)
+are partitioned by each job's siteShard rather than its site. For most
+sites the shard is just the sitecode, so they keep a single partition. Sites listed in SITE_SHARDS instead spread
+their jobs over "{site}#0" to "{site}#{n-1}", picked from the job's device,
+so each device's jobs stay together in one shard and a device worker's
+poll only reads one partition. Reads that cover the whole site query every
+shard and merge the results.
+
+SITE_SHARDS is a comma separated list of sitecodes and shard counts:
+
+    SITE_SHARDS=saf:4,mrc:2
+
+The shard count of a site should only be changed together with a run of
+src.backfill_pending, which moves queued jobs to their new shards.
+"""
+import os
+import zlib
+
+# Attribute holding the partition key of the queue and change indexes.
+SHARD_KEY = 'siteShard'
+
+
+def parse_site_shards(value):
+    """Reads a SITE_SHARDS value into a dict of sitecode to shard count.
+
+    Raises:
+        ValueError: If an entry isn't "site:count" with a count of at least 1.
+    """
+    counts = {}
+    for entry in filter(None, (part.strip() for part in value.split(','))):
+        site, _, count = entry.partition(':')
+        if not site or not count.isdigit() or int(count) < 1:
+            raise ValueError(f"Invalid SITE_SHARDS entry: '{entry}'")
+        counts[site] = int(count)
+    return counts
+
+
+SITE_SHARDS = parse_site_shards(os.getenv('SITE_SHARDS', ''))
+
+
+def site_shards(site):
+    """ Every shard of a site, which is [site] for sites that aren't sharded. """
+    count = SITE_SHARDS.get(site, 1)
+    if count == 1:
+        return [site]
+    return [f"{site}#{n}" for n in range(count)]
+
+
+def job_shard(site, device_type, device_instance):
+    """ The shard that holds a site's jobs for one device. """
+    shards = site_shards(site)
+    if len(shards) == 1:
+        return shards[0]
+    # crc32 is stable across processes, unlike hash().
+    device = f"{device_type}#{device_instance}".encode()
+    return shards[zlib.crc32(device) % len(shards)]
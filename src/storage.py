@@ -0,0 +1,111 @@
+"""Access to the jobs table.
+
+The table is built the first time it's needed rather than at import time, and
+can be replaced with another implementation that supports the same calls,
+such as the in-memory table used by the tests and benchmarks.
+"""
+import os
+
+import boto3
+from botocore.config import Config
+from boto3.dynamodb.transform import TransformationInjector
+from boto3.dynamodb.types import TypeDeserializer
+
+from src.metrics import InstrumentedTable
+from src.throttling import throttled_table
+
+# Set JOBS_STORAGE=memory to run against in-memory tables instead of AWS.
+STORAGE_BACKEND = os.getenv('JOBS_STORAGE', 'dynamodb')
+
+# Environment variable and default name of each table, and the key schema and
+# indexes the in-memory stand-in uses for it (None for the jobs indexes).
+TABLES = {
+    'jobs': ('DYNAMODB_JOBS', 'photonranch-jobs-dev', ('site', 'ulid'), None),
+    'consumers': ('DYNAMODB_CONSUMERS', 'photonranch-jobs-consumers-dev',
+                  ('site', 'consumer'), {}),
+    'connections': ('DYNAMODB_CONNECTIONS', 'photonranch-jobs-connections-dev',
+                    ('site', 'connectionId'), {'ConnectionIds': ('connectionId', 'site')}),
+}
+
+_tables = {}
+_wrapped_tables = {}
+
+
+class NativeNumberDeserializer(TypeDeserializer):
+    """Deserializes dynamodb numbers straight to int or float.
+
+    The default deserializer produces Decimal, which the json module can't
+    encode without calling back into python for every value. Items read this
+    way are meant for building responses: boto3 refuses to write floats, so
+    convert any back to Decimal before storing them again.
+    """
+    def _deserialize_n(self, value):
+        if '.' in value or 'e' in value or 'E' in value:
+            return float(value)
+        return int(value)
+
+
+def use_native_numbers(dynamodb_resource):
+    """ Make a boto3 dynamodb resource return numbers as int and float. """
+    injector = TransformationInjector(deserializer=NativeNumberDeserializer())
+    events = dynamodb_resource.meta.client.meta.events
+    events.unregister('after-call.dynamodb',
+                      unique_id='dynamodb-attr-value-output')
+    events.register('after-call.dynamodb',
+                    injector.inject_attribute_value_output,
+                    unique_id='dynamodb-attr-value-output')
+    return dynamodb_resource
+
+
+def _get_table(role):
+    if role not in _tables:
+        variable, default_name, key_schema, indexes = TABLES[role]
+        table_name = os.getenv(variable, default_name)
+        if STORAGE_BACKEND == 'memory':
+            from src.memory_table import InMemoryTable
+            _tables[role] = InMemoryTable(table_name, key_schema, indexes)
+        else:
+            # Items read here are returned to clients, so skip the Decimal
+            # conversion.
+            # Throttled requests are retried by throttled_table instead.
+            config = Config(retries={'max_attempts': 0})
+            dynamodb = use_native_numbers(boto3.resource('dynamodb', config=config))
+            _tables[role] = dynamodb.Table(table_name)
+    if role not in _wrapped_tables:
+        _wrapped_tables[role] = throttled_table(InstrumentedTable(_tables[role]))
+    return _wrapped_tables[role]
+
+
+def get_table():
+    """Returns the jobs table, creating it on first use.
+
+    Requests made through the returned table are included in the metrics for
+    the current invocation, and kept within the table's capacity (see
+    src.throttling).
+    """
+    return _get_table('jobs')
+
+
+def get_consumers_table():
+    """Returns the table of consumer watermarks (see src.consumers)."""
+    return _get_table('consumers')
+
+
+def get_connections_table():
+    """Returns the table of open WebSocket connections (see src.connections)."""
+    return _get_table('connections')
+
+
+def set_table(table, role='jobs'):
+    """Use the given table for all job storage, or for another of TABLES.
+
+    Args:
+        table: Any object with the boto3 Table methods used by this service,
+            or None to go back to the default on the next get_table() call.
+        role (str): Which table to replace, e.g. 'consumers'.
+    """
+    if table is None:
+        _tables.pop(role, None)
+    else:
+        _tables[role] = table
+    _wrapped_tables.pop(role, None)
@@ -0,0 +1,49 @@
+from src.archive import LocalArchive, archive_jobs, decode_jobs, encode_jobs
+from src.archive import is_expiry_record, partition_key
+
+
+def _job(ulid, site="saf", timestamp_ms=1585248855359):
+    return {"site": site, "ulid": ulid, "timestamp_ms": timestamp_ms,
+            "statusId": f"COMPLETE#{ulid}", "secondsUntilComplete": -1}
+
+
+def test_encode_jobs_round_trip():
+    jobs = [_job("01E4C33S9ZFGS8P0K31FH9FDTN"), _job("01E4C33S9ZFGS8P0K31FH9FDTP")]
+    assert decode_jobs(encode_jobs(jobs)) == jobs
+
+
+def test_partition_key():
+    assert partition_key(_job("a")) == "jobs/site=saf/date=2020-03-26"
+
+    # Items without a timestamp are dated by their ulid.
+    stub = {"site": "saf", "ulid": "01E4C33S9ZFGS8P0K31FH9FDTN", "statusId": "COMPLETE"}
+    assert partition_key(stub) == "jobs/site=saf/date=2020-03-26"
+
+
+def test_archive_jobs_partitions_by_site_and_day(tmp_path):
+    archive = LocalArchive(str(tmp_path))
+    next_day = 1585248855359 + 24 * 60 * 60 * 1000
+    jobs = [_job("c"), _job("a"), _job("b", site="mrc"), _job("d", timestamp_ms=next_day)]
+
+    keys = archive_jobs(jobs, archive)
+
+    assert keys == [
+        "jobs/site=mrc/date=2020-03-26/b-b.ndjson.gz",
+        "jobs/site=saf/date=2020-03-26/a-c.ndjson.gz",
+        "jobs/site=saf/date=2020-03-27/d-d.ndjson.gz",
+    ]
+    assert archive.keys() == keys
+    assert [job["ulid"] for job in decode_jobs(archive.get(keys[1]))] == ["a", "c"]
+
+    # Archiving the same batch again replaces the objects.
+    assert archive_jobs(jobs, archive) == keys
+    assert archive.keys() == keys
+
+
+def test_is_expiry_record():
+    removed = {"eventName": "REMOVE", "dynamodb": {}}
+    expired = {**removed, "userIdentity": {
+        "type": "Service", "principalId": "dynamodb.amazonaws.com"}}
+    assert is_expiry_record(expired)
+    assert not is_expiry_record(removed)
+    assert not is_expiry_record({**expired, "eventName": "MODIFY"})
@@ -1,6 +1,6 @@
 import pytest
 
-from src.authorizer import calendar_blocks_user_commands
+from src.authorizer import calendar_blocks_user_commands, get_cached_user_roles, getUserInfo
 
 
 def test_calendar_blocks_user_commands_1(mocker):
@@ -73,3 +73,51 @@ def test_calendar_blocks_user_commands_2(mocker):
     user_blocked = calendar_blocks_user_commands(user_with_reservation, site)
 
     assert user_blocked == expected_result
+
+def test_get_cached_user_roles(mocker):
+    """ Test that repeated requests with a token only call auth0 once. """
+
+    user_info = {'https://photonranch.org/user_metadata': {'roles': ['admin']}}
+    mock_user_info = mocker.patch(
+        'src.authorizer.getUserInfo',
+        return_value=user_info
+    )
+    mocker.patch('src.authorizer.time.time', return_value=1000)
+
+    token_expiry = 1000 + 60
+    for _ in range(3):
+        roles = get_cached_user_roles('token_1', token_expiry)
+        assert roles == ['admin']
+    assert mock_user_info.call_count == 1
+
+    # A different token is looked up separately.
+    get_cached_user_roles('token_2', token_expiry)
+    assert mock_user_info.call_count == 2
+
+def test_get_cached_user_roles_expires_with_token(mocker):
+    """ Test that cached roles are not used after the token expires. """
+
+    user_info = {'https://photonranch.org/user_metadata': {'roles': []}}
+    mock_user_info = mocker.patch(
+        'src.authorizer.getUserInfo',
+        return_value=user_info
+    )
+    mock_time = mocker.patch('src.authorizer.time.time', return_value=2000)
+
+    token_expiry = 2000 + 10
+    get_cached_user_roles('token_3', token_expiry)
+
+    # Still within the cache TTL, but past the token's own expiry.
+    mock_time.return_value = token_expiry + 1
+    get_cached_user_roles('token_3', token_expiry)
+    assert mock_user_info.call_count == 2
+
+def test_get_user_info_has_a_timeout(mocker):
+    """ Test that a slow auth0 can't hold the authorizer until it times out. """
+
+    session = mocker.Mock()
+    session.get.return_value.content = b'{"sub": "user_id_1"}'
+    mocker.patch('src.authorizer.get_http_session', return_value=session)
+
+    assert getUserInfo('token_4') == {"sub": "user_id_1"}
+    assert "timeout" in session.get.call_args[1]
@@ -0,0 +1,86 @@
+from src.datastream import deserialize_image, send_batch_to_datastream
+from src.datastream import coalesce_stream_records
+from src.storage import NativeNumberDeserializer
+
+def test_deserialize_image():
+    image = {
+        "site": {"S": "saf"},
+        "secondsUntilComplete": {"N": "60"},
+        "optional_params": {"M": {"count": {"S": "3"}}},
+    }
+    job = deserialize_image(image)
+    assert job == {
+        "site": "saf",
+        "secondsUntilComplete": 60,
+        "optional_params": {"count": "3"},
+    }
+
+def test_send_batch_to_datastream(mocker):
+    """ Messages go out in chunks of 10 and failures are reported by id. """
+    sqs = mocker.Mock()
+    sqs.send_message_batch.side_effect = [
+        {"Successful": [], "Failed": [{"Id": "3"}]},
+        {"Successful": [], "Failed": []},
+        Exception("network error"),
+    ]
+    mocker.patch('src.datastream.get_sqs_client', return_value=sqs)
+    mocker.patch('src.datastream.get_queue_url', return_value="queue-url")
+
+    messages = [(f"seq{n}", "saf", {"ulid": str(n)}) for n in range(25)]
+    failed = send_batch_to_datastream(messages)
+
+    assert sqs.send_message_batch.call_count == 3
+    sent_entries = sqs.send_message_batch.call_args_list[0][1]["Entries"]
+    assert len(sent_entries) == 10
+    assert failed == ["seq3"] + [f"seq{n}" for n in range(20, 25)]
+
+def _stream_record(sequence_number, ulid, old_status=None, new_status=None):
+    """ Build a minimal dynamodb stream record for a job in site 'saf'. """
+    def image(status):
+        return {
+            "site": {"S": "saf"},
+            "ulid": {"S": ulid},
+            "statusId": {"S": f"{status}#{ulid}"},
+            "secondsUntilComplete": {"N": "-1"},
+        }
+    record = {
+        "SequenceNumber": sequence_number,
+        "Keys": {"site": {"S": "saf"}, "ulid": {"S": ulid}},
+    }
+    if old_status:
+        record["OldImage"] = image(old_status)
+    if new_status:
+        record["NewImage"] = image(new_status)
+    return {"dynamodb": record}
+
+def test_coalesce_stream_records_keeps_latest_image():
+    records = [
+        _stream_record("1", "job_a", None, "UNREAD"),
+        _stream_record("2", "job_a", "UNREAD", "RECEIVED"),
+        _stream_record("3", "job_b", "UNREAD", "RECEIVED"),
+        _stream_record("4", "job_a", "RECEIVED", "STARTED"),
+    ]
+    messages = coalesce_stream_records(records)
+    assert [(seq, job["statusId"]) for seq, _, job in messages] == [
+        ("1", "STARTED#job_a"),
+        ("3", "RECEIVED#job_b"),
+    ]
+
+def test_coalesce_stream_records_drops_unchanged_and_removed_jobs():
+    records = [
+        # Only an attribute the UI doesn't show changed
+        _stream_record("1", "job_a", "RECEIVED", "RECEIVED"),
+        # Status changed, then changed back within the batch
+        _stream_record("2", "job_b", "RECEIVED", "STARTED"),
+        _stream_record("3", "job_b", "STARTED", "RECEIVED"),
+        # Deleted job
+        _stream_record("4", "job_c", "UNREAD", None),
+    ]
+    assert coalesce_stream_records(records) == []
+
+def test_native_number_deserializer():
+    deserializer = NativeNumberDeserializer()
+    assert deserializer.deserialize({"N": "60"}) == 60
+    assert type(deserializer.deserialize({"N": "60"})) is int
+    assert deserializer.deserialize({"N": "-1.5"}) == -1.5
+    assert deserializer.deserialize({"N": "1E+3"}) == 1000.0
@@ -0,0 +1,72 @@
+import gzip
+import io
+import json
+
+import pytest
+import ulid
+
+from src.export_jobs import export_jobs, oldest_job_ms, open_output, time_segments, ulid_bound
+from src.memory_table import InMemoryTable
+from src.storage import set_table
+
+START_MS = 1585248855359
+
+
+@pytest.fixture
+def table():
+    table = InMemoryTable(page_size=3)
+    set_table(table)
+    yield table
+    set_table(None)
+
+
+def add_jobs(table, site, count, spacing_ms=1000):
+    job_ids = []
+    for n in range(count):
+        job_id = ulid.from_timestamp((START_MS + n * spacing_ms) / 1000).str
+        table.put_item(Item={"site": site, "ulid": job_id, "statusId": f"COMPLETE#{job_id}"})
+        job_ids.append(job_id)
+    return job_ids
+
+
+def test_time_segments_cover_the_range():
+    segments = time_segments(["saf"], START_MS, START_MS + 10, segments=3)
+    assert segments[0][1] == ulid_bound(START_MS)
+    assert segments[-1][2] == ulid_bound(START_MS + 9, upper=True)
+    # Each segment starts right after the previous one ends.
+    for (_, _, last), (_, first, _) in zip(segments, segments[1:]):
+        assert ulid.parse(first).timestamp().int == ulid.parse(last).timestamp().int + 1
+
+
+def test_export_jobs_in_site_and_ulid_order(table):
+    saf = add_jobs(table, "saf", 10)
+    mrc = add_jobs(table, "mrc", 4)
+    add_jobs(table, "tst", 2)
+
+    out = io.StringIO()
+    segments = time_segments(["saf", "mrc"], START_MS, START_MS + 10000, segments=4)
+    exported = export_jobs(out, segments, workers=3, prefetch=1)
+
+    lines = out.getvalue().splitlines()
+    assert exported == len(lines) == 14
+    assert [json.loads(line)["ulid"] for line in lines] == saf + mrc
+
+
+def test_export_jobs_gzipped(table, tmp_path):
+    saf = add_jobs(table, "saf", 5)
+    path = str(tmp_path / "jobs.ndjson.gz")
+
+    with open_output(path, compress=True) as out:
+        export_jobs(out, time_segments(["saf"], START_MS, START_MS + 5000))
+
+    with gzip.open(path, "rt") as f:
+        assert [json.loads(line)["ulid"] for line in f] == saf
+
+
+def test_oldest_job_ms(table):
+    add_jobs(table, "saf", 3)
+    table.put_item(Item={"site": "mrc", "ulid": ulid_bound(START_MS - 5000)})
+
+    assert oldest_job_ms(["saf"]) == START_MS
+    assert oldest_job_ms(["saf", "mrc"]) == START_MS - 5000
+    assert oldest_job_ms(["tst"]) is None
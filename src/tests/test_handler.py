@@ -0,0 +1,625 @@
+import json
+import time
+import pytest
+from boto3.dynamodb.conditions import Attr, Key
+from http import HTTPStatus
+
+from src import handler
+from src.dynamodb import claim_jobs, get_pending_site_jobs
+from src.memory_table import InMemoryTable
+from src.storage import set_table
+from src.archive import LocalArchive, decode_jobs, set_archive, JOB_RETENTION_DAYS
+from src.backfill_pending import backfill_pending_keys
+from src.helpers import encode_sync_token, now_ms
+from src.throttling import Throttled
+from src import connections
+from botocore.exceptions import ClientError
+
+
+@pytest.fixture
+def table(mocker):
+    """ Run the handlers against an in-memory jobs table. """
+    table = InMemoryTable()
+    set_table(table)
+    mocker.patch('src.handler.calendar_blocks_user_commands', return_value=False)
+    yield table
+    set_table(None)
+
+
+def call(endpoint, body):
+    event = {
+        "body": json.dumps(body),
+        "requestContext": {"authorizer": {"userRoles": json.dumps(["admin"])}},
+    }
+    response = endpoint(event, None)
+    return response['statusCode'], json.loads(response['body'])
+
+
+def call_status(endpoint, body):
+    """ Like call, for responses whose body isn't JSON. """
+    event = {
+        "body": json.dumps(body),
+        "requestContext": {"authorizer": {"userRoles": json.dumps(["admin"])}},
+    }
+    response = endpoint(event, None)
+    return response['statusCode'], response['body']
+
+
+def ulids(jobs):
+    """ Job ids in the order they are stored (jobs created in the same
+    millisecond aren't guaranteed to sort in creation order). """
+    return sorted(job["ulid"] for job in jobs)
+
+
+def job_body(site="saf", action="expose", device="camera"):
+    return {
+        "site": site,
+        "device": device,
+        "instance": f"{device}1",
+        "action": action,
+        "user_name": "Firstname Lastname",
+        "user_id": "user-id-1234",
+        "optional_params": {},
+        "required_params": {"time": 1},
+    }
+
+
+def new_job(site="saf", action="expose", device="camera"):
+    status, job = call(handler.newJob, job_body(site, action, device))
+    assert status == HTTPStatus.OK
+    return job
+
+
+def test_get_new_jobs_claims_each_job_once(table):
+    jobs = [new_job() for _ in range(3)]
+    new_job(site="other")
+
+    status, received = call(handler.getNewJobs, {"site": "saf"})
+    assert status == HTTPStatus.OK
+    assert [j["ulid"] for j in received] == ulids(jobs)
+
+    # Everything has been received, and the alternate queue is unaffected.
+    assert call(handler.getNewJobs, {"site": "saf"})[1] == []
+    alternate = call(handler.getNewJobs, {"site": "saf", "alternateQueue": True})[1]
+    assert len(alternate) == 3
+
+
+def test_claim_jobs_skips_jobs_already_claimed(table):
+    jobs = [new_job() for _ in range(2)]
+    _, page = call(handler.getNewJobs, {"site": "saf", "limit": 1})
+    already_claimed = page["jobs"][0]["ulid"]
+
+    # Only the job that the poll above didn't receive can still be claimed.
+    claimed = claim_jobs(jobs, "statusId")
+    assert [j["ulid"] for j in claimed] == \
+        [j["ulid"] for j in jobs if j["ulid"] != already_claimed]
+
+
+def test_get_new_jobs_keeps_claims_when_another_claim_fails(table, mocker):
+    jobs = ulids([new_job() for _ in range(3)])
+    update_item = table.update_item
+
+    def update_item_throttled_for(job_id):
+        def fake_update_item(**kwargs):
+            if kwargs["Key"]["ulid"] == job_id:
+                raise Throttled(1)
+            return update_item(**kwargs)
+        return fake_update_item
+
+    mocker.patch.object(table, "update_item", side_effect=update_item_throttled_for(jobs[1]))
+
+    # The jobs that were claimed are delivered, and the other is left queued.
+    status, received = call(handler.getNewJobs, {"site": "saf"})
+    assert status == HTTPStatus.OK
+    assert [j["ulid"] for j in received] == [jobs[0], jobs[2]]
+
+    # With nothing claimed, the poll is throttled.
+    status, _ = call(handler.getNewJobs, {"site": "saf"})
+    assert status == HTTPStatus.TOO_MANY_REQUESTS
+
+    mocker.patch.object(table, "update_item", side_effect=update_item)
+    assert [j["ulid"] for j in call(handler.getNewJobs, {"site": "saf"})[1]] == [jobs[1]]
+
+
+def test_get_recent_jobs_follows_pages(table):
+    table.page_size = 2
+    jobs = [new_job() for _ in range(5)]
+
+    _, recent = call(handler.getRecentJobs, {"site": "saf"})
+    assert [j["ulid"] for j in recent] == ulids(jobs)
+
+    _, page = call(handler.getRecentJobs, {"site": "saf", "limit": 3})
+    assert len(page["jobs"]) == 3
+    _, page = call(handler.getRecentJobs, {"site": "saf", "cursor": page["cursor"]})
+    assert [j["ulid"] for j in page["jobs"]] == ulids(jobs)[3:]
+    assert page["cursor"] is None
+
+
+def test_get_recent_jobs_sync_returns_only_changes(table, mocker):
+    mocker.patch('src.handler.SYNC_OVERLAP_MS', 0)
+    first, second = new_job(), new_job()
+    time.sleep(0.002)
+
+    status, snapshot = call(handler.getRecentJobs, {"site": "saf", "syncToken": None})
+    assert status == HTTPStatus.OK
+    assert ulids(snapshot["jobs"]) == ulids([first, second])
+
+    time.sleep(0.002)
+    call(handler.updateJobStatus, {"site": "saf", "ulid": second["ulid"], "newStatus": "EXPOSING"})
+    third = new_job()
+
+    _, changes = call(handler.getRecentJobs, {"site": "saf", "syncToken": snapshot["syncToken"]})
+    assert ulids(changes["jobs"]) == ulids([second, third])
+    assert changes["syncToken"] != snapshot["syncToken"]
+
+
+def test_get_recent_jobs_for_sites_merges_in_ulid_order(table):
+    jobs = [new_job(site=site) for site in ["saf", "mrc", "saf", "tst", "mrc"]]
+    new_job(site="other")
+
+    status, body = call(handler.getRecentJobsForSites, {"sites": ["saf", "mrc", "tst"]})
+    assert status == HTTPStatus.OK
+    assert [job["ulid"] for job in body["jobs"]] == ulids(jobs)
+    assert body["truncated"] is False
+
+    # Only the most recent jobs are kept when there are too many.
+    _, body = call(handler.getRecentJobsForSites, {"sites": ["saf", "mrc", "tst"], "limit": 2})
+    assert [job["ulid"] for job in body["jobs"]] == ulids(jobs)[-2:]
+    assert body["truncated"] is True
+    assert table.calls["query"] == 6
+
+
+def test_cancel_all_commands_cancels_only_pending_jobs(table):
+    started, replica_started, unread = new_job(), new_job(), new_job()
+    for alternate_queue in [False, True]:
+        call(handler.startJob, {
+            "site": "saf", "ulid": started["ulid"], "alternateQueue": alternate_queue,
+        })
+    call(handler.startJob, {"site": "saf", "ulid": replica_started["ulid"], "alternateQueue": True})
+
+    # Only jobs created before the cancel command are cancelled, and only on
+    # the queues they were pending on.
+    time.sleep(0.002)
+    cancel = new_job(action="cancel_all_commands")
+
+    _, jobs = call(handler.getRecentJobs, {"site": "saf"})
+    statuses = {j["ulid"]: (j["statusId"].split("#")[0], j["replicaStatusId"].split("#")[0])
+                for j in jobs}
+    assert statuses == {
+        started["ulid"]: ("STARTED", "STARTED"),
+        replica_started["ulid"]: ("CANCELLED", "STARTED"),
+        unread["ulid"]: ("CANCELLED", "CANCELLED"),
+        cancel["ulid"]: ("UNREAD", "UNREAD"),
+    }
+    stored = table.get_item(Key={"site": "saf", "ulid": unread["ulid"]})["Item"]
+    assert "expiresAt" in stored
+    assert not {"pendingId", "replicaPendingId", "devicePendingId"} & set(stored)
+    _, received = call(handler.getNewJobs, {"site": "saf"})
+    assert ulids(received) == [cancel["ulid"]]
+
+
+def test_get_recent_jobs_sync_reports_cancelled_jobs(table, mocker):
+    mocker.patch('src.handler.SYNC_OVERLAP_MS', 0)
+    pending = [new_job(), new_job()]
+    time.sleep(0.002)
+    _, snapshot = call(handler.getRecentJobs, {"site": "saf", "syncToken": None})
+
+    time.sleep(0.002)
+    cancel = new_job(action="cancel_all_commands")
+
+    _, changes = call(handler.getRecentJobs, {"site": "saf", "syncToken": snapshot["syncToken"]})
+    assert ulids(changes["jobs"]) == ulids(pending + [cancel])
+    cancelled = [job for job in changes["jobs"] if job["ulid"] != cancel["ulid"]]
+    assert [job["statusId"] for job in cancelled] == [f"CANCELLED#{job['ulid']}" for job in cancelled]
+
+    # Tokens older than the retention period could miss expired jobs.
+    expired = encode_sync_token(now_ms() - (JOB_RETENTION_DAYS + 1) * 24 * 3600 * 1000)
+    status, _ = call_status(handler.getRecentJobs, {"site": "saf", "syncToken": expired})
+    assert status == HTTPStatus.BAD_REQUEST
+
+
+def test_pending_site_jobs_come_from_the_pending_indexes(table):
+    started, replica_started, unread = new_job(), new_job(), new_job()
+    call(handler.startJob, {"site": "saf", "ulid": started["ulid"]})
+    call(handler.startJob, {"site": "saf", "ulid": started["ulid"], "alternateQueue": True})
+    call(handler.startJob, {"site": "saf", "ulid": replica_started["ulid"], "alternateQueue": True})
+    time.sleep(0.002)
+    newer = new_job()
+    new_job(site="other")
+
+    # Jobs pending on either queue are listed once, and newer jobs left out.
+    table.calls.clear()
+    pending = get_pending_site_jobs("saf", newer["ulid"])
+    assert ulids(pending) == ulids([replica_started, unread])
+    assert table.calls["query"] == 2
+    assert table.calls["scan"] == 0
+
+
+def test_status_updates_for_removed_jobs_are_not_found(table):
+    removed = new_job()
+    # As time to live does once a job's retention period is over.
+    table.delete_item(Key={"site": "saf", "ulid": removed["ulid"]})
+
+    status, _ = call_status(handler.updateJobStatus,
+                            {"site": "saf", "ulid": removed["ulid"], "newStatus": "COMPLETE"})
+    assert status == HTTPStatus.NOT_FOUND
+    status, _ = call_status(handler.startJob, {"site": "saf", "ulid": removed["ulid"]})
+    assert status == HTTPStatus.NOT_FOUND
+    _, results = call(handler.updateJobStatuses, {"site": "saf", "updates": [
+        {"ulid": removed["ulid"], "newStatus": "COMPLETE"}]})
+    assert "not found" in results[0]["error"]
+    assert "Item" not in table.get_item(Key={"site": "saf", "ulid": removed["ulid"]})
+
+
+def test_new_jobs_keeps_sequence_order(table):
+    sequence = [job_body(action=f"expose_{n}") for n in range(30)]
+
+    status, added = call(handler.newJobs, {"jobs": sequence})
+
+    assert status == HTTPStatus.OK
+    assert [job["action"] for job in added] == [f"expose_{n}" for n in range(30)]
+    assert [job["ulid"] for job in added] == ulids(added)
+    assert table.calls["batch_write_item"] == 2
+    status, received = call(handler.getNewJobs, {"site": "saf"})
+    assert [job["action"] for job in received] == [f"expose_{n}" for n in range(30)]
+
+
+def test_new_jobs_reports_which_jobs_were_written(table, mocker):
+    mocker.patch("src.dynamodb.backoff_delay", return_value=0)
+    batch_write_item = table.meta.client.batch_write_item
+
+    def fake_batch_write_item(RequestItems, **kwargs):
+        # The job with the "unlucky" action is throttled every time.
+        requests = RequestItems[table.name]
+        unlucky = [r for r in requests if r["PutRequest"]["Item"]["action"] == "unlucky"]
+        batch_write_item({table.name: [r for r in requests if r not in unlucky]}, **kwargs)
+        return {"UnprocessedItems": {table.name: unlucky} if unlucky else {}}
+
+    mocker.patch.object(table.meta.client, "batch_write_item", side_effect=fake_batch_write_item)
+    sequence = [job_body(action="unlucky" if n == 27 else f"expose_{n}") for n in range(30)]
+
+    status, body = call(handler.newJobs, {"jobs": sequence})
+
+    assert status == HTTPStatus.TOO_MANY_REQUESTS
+    assert body["written"] == [n for n in range(30) if n != 27]
+    assert [job["action"] for job in body["jobs"]] == [f"expose_{n}" for n in body["written"]]
+    _, stored = call(handler.getRecentJobs, {"site": "saf"})
+    assert ulids(stored) == ulids(body["jobs"])
+
+
+def test_new_jobs_rejects_invalid_sequences(table, mocker):
+    def new_jobs_status(jobs, roles=("admin",)):
+        event = {
+            "body": json.dumps({"jobs": jobs}),
+            "requestContext": {"authorizer": {"userRoles": json.dumps(roles)}},
+        }
+        return handler.newJobs(event, None)["statusCode"]
+
+    missing_key = job_body()
+    del missing_key["action"]
+    for jobs in [[], [job_body(), missing_key], [job_body(action="cancel_all_commands")]]:
+        assert new_jobs_status(jobs) == HTTPStatus.BAD_REQUEST
+
+    # Non-admins are checked against the calendar once for the whole sequence.
+    blocked = mocker.patch('src.handler.calendar_blocks_user_commands', return_value=True)
+    assert new_jobs_status([job_body(), job_body()], roles=[]) == HTTPStatus.UNAUTHORIZED
+    assert blocked.call_count == 1
+    assert table.calls["batch_write_item"] == 0
+
+
+def test_update_job_statuses_applies_each_jobs_updates_in_order(table):
+    first, second = new_job(), new_job()
+
+    status, results = call(handler.updateJobStatuses, {"site": "saf", "updates": [
+        {"ulid": first["ulid"], "newStatus": "STARTED", "secondsUntilComplete": 30},
+        {"ulid": second["ulid"], "newStatus": "STARTED", "alternateQueue": True},
+        {"ulid": first["ulid"], "newStatus": "COMPLETE", "secondsUntilComplete": 0},
+    ]})
+
+    assert status == HTTPStatus.OK
+    assert results == [
+        {"ulid": first["ulid"], "statusId": f"STARTED#{first['ulid']}", "secondsUntilComplete": 30},
+        {"ulid": second["ulid"], "replicaStatusId": f"STARTED#{second['ulid']}",
+         "secondsUntilComplete": -1},
+        {"ulid": first["ulid"], "statusId": f"COMPLETE#{first['ulid']}", "secondsUntilComplete": 0},
+    ]
+    stored = table.get_item(Key={"site": "saf", "ulid": first["ulid"]})["Item"]
+    assert stored["statusId"] == f"COMPLETE#{first['ulid']}"
+    assert "expiresAt" in stored
+    # The second job was only started on the alternate queue.
+    _, received = call(handler.getNewJobs, {"site": "saf"})
+    assert [job["ulid"] for job in received] == [second["ulid"]]
+
+    for bad_updates in [[], [{"ulid": first["ulid"]}], "STARTED"]:
+        status, _ = call_status(handler.updateJobStatuses, {"site": "saf", "updates": bad_updates})
+        assert status == HTTPStatus.BAD_REQUEST
+
+
+def test_update_job_statuses_rejects_the_batch_if_any_update_is_invalid(table):
+    first, second = new_job(), new_job()
+    for invalid in [{"secondsUntilComplete": 1.5}, {"secondsUntilComplete": True},
+                    {"alternateQueue": "yes"}]:
+        status, error = call_status(handler.updateJobStatuses, {"site": "saf", "updates": [
+            {"ulid": first["ulid"], "newStatus": "STARTED"},
+            {"ulid": second["ulid"], "newStatus": "STARTED", **invalid},
+        ]})
+        assert status == HTTPStatus.BAD_REQUEST
+        assert "(update 1)" in error
+
+    # Neither update was applied.
+    _, received = call(handler.getNewJobs, {"site": "saf"})
+    assert ulids(received) == ulids([first, second])
+
+
+def test_pending_index_only_holds_jobs_not_started(table):
+    started, received, unread = new_job(), new_job(), new_job()
+    call(handler.startJob, {"site": "saf", "ulid": started["ulid"]})
+    call(handler.updateJobStatus, {"site": "saf", "ulid": received["ulid"], "newStatus": "RECEIVED"})
+
+    jobs = table.query(IndexName="PendingJobsByShard",
+                       KeyConditionExpression=Key("siteShard").eq("saf"))["Items"]
+    assert {job["ulid"]: job["pendingId"] for job in jobs} == {
+        received["ulid"]: f"RECEIVED#4#{received['ulid']}",
+        unread["ulid"]: f"UNREAD#4#{unread['ulid']}",
+    }
+    # The alternate queue wasn't touched.
+    jobs = table.query(IndexName="ReplicaPendingJobsByShard",
+                       KeyConditionExpression=Key("siteShard").eq("saf"))["Items"]
+    assert len(jobs) == 3
+
+
+def test_get_new_jobs_by_device(table):
+    camera1 = new_job(device="camera")
+    mount = new_job(device="mount")
+    camera2 = new_job(device="camera")
+    call(handler.updateJobStatus, {"site": "saf", "ulid": camera2["ulid"], "newStatus": "RECEIVED"})
+
+    _, received = call(handler.getNewJobs, {"site": "saf", "deviceType": "camera"})
+    assert [job["ulid"] for job in received] == [camera1["ulid"]]
+    _, received = call(handler.getNewJobs, {"site": "saf", "deviceType": "camera"})
+    assert received == []
+
+    # Jobs put back in the queue can be read by device again.
+    call(handler.updateJobStatus, {"site": "saf", "ulid": camera2["ulid"], "newStatus": "UNREAD"})
+    _, received = call(handler.getNewJobs, {
+        "site": "saf", "deviceType": "camera", "deviceInstance": "camera1"})
+    assert [job["ulid"] for job in received] == [camera2["ulid"]]
+
+    # A site wide poll only gets what the device workers left.
+    _, received = call(handler.getNewJobs, {"site": "saf"})
+    assert [job["ulid"] for job in received] == [mount["ulid"]]
+    _, received = call(handler.getNewJobs, {"site": "saf", "deviceType": "mount"})
+    assert received == []
+
+
+def test_urgent_jobs_jump_the_queue(table):
+    exposures = [new_job() for _ in range(3)]
+    low = call(handler.newJob, {**job_body(), "priority": 1})[1]
+    stop = new_job(action="stop", device="mount")
+    park = call(handler.newJob, {**job_body(action="park", device="dome"), "priority": 0})[1]
+    assert stop["priority"] == park["priority"] == 9
+
+    # Express polls only take the urgent jobs, for the site or one device.
+    _, received = call(handler.getNewJobs, {"site": "saf", "urgentOnly": True,
+                                            "deviceType": "mount", "deviceInstance": "mount1"})
+    assert [job["ulid"] for job in received] == [stop["ulid"]]
+    _, received = call(handler.getNewJobs, {"site": "saf", "urgentOnly": True})
+    assert [job["ulid"] for job in received] == [park["ulid"]]
+
+    # Everything else comes back highest priority first, then oldest first.
+    _, received = call(handler.getNewJobs, {"site": "saf"})
+    assert [job["ulid"] for job in received] == ulids(exposures) + [low["ulid"]]
+
+    status, _ = call_status(handler.newJob, {**job_body(), "priority": 10})
+    assert status == HTTPStatus.BAD_REQUEST
+
+
+def test_sharded_site_reads_merge_shards_in_order(table, mocker):
+    mocker.patch.dict("src.sharding.SITE_SHARDS", {"saf": 3})
+    devices = ["camera", "mount", "focuser", "filter_wheel", "rotator"]
+    jobs = [new_job(device=device) for device in devices for _ in range(2)]
+    assert len({job["siteShard"] for job in jobs}) > 1
+    # Small sites keep their single partition.
+    assert new_job(site="mrc")["siteShard"] == "mrc"
+
+    # Pages are read across all the shards, in queue order.
+    received, cursor = [], None
+    while True:
+        body = {"site": "saf", "limit": 3, **({"cursor": cursor} if cursor else {})}
+        _, page = call(handler.getNewJobs, body)
+        received += page["jobs"]
+        cursor = page["cursor"]
+        if not cursor:
+            break
+    assert [job["ulid"] for job in received] == ulids(jobs)
+
+    since = encode_sync_token(now_ms() - 60 * 1000)
+    _, changes = call(handler.getRecentJobs, {"site": "saf", "syncToken": since})
+    assert [job["ulid"] for job in changes["jobs"]] == ulids(jobs)
+
+    # cancel_all_commands finds pending jobs in every shard.
+    call(handler.updateJobStatus, {"site": "saf", "ulid": jobs[0]["ulid"], "newStatus": "UNREAD"})
+    time.sleep(0.002)
+    cancel = new_job(action="cancel_all_commands")
+    _, remaining = call(handler.getRecentJobs, {"site": "saf"})
+    assert {job["ulid"] for job in remaining if job["statusId"].startswith("CANCELLED")} \
+        == set(ulids(jobs))
+
+
+def test_consumers_read_jobs_after_their_watermark(table, mocker):
+    consumers = InMemoryTable("consumers", ("site", "consumer"), indexes={})
+    set_table(consumers, role="consumers")
+    mocker.patch("src.consumers.CONSUMER_LAG_MS", 0)
+    try:
+        # A new consumer starts from its first read.
+        new_job()
+        time.sleep(0.002)
+        assert call(handler.getNewJobs, {"site": "saf", "consumer": "logger"})[1] == []
+
+        time.sleep(0.002)
+        jobs = [new_job() for _ in range(3)]
+        time.sleep(0.002)
+        consumers.calls.clear()
+        _, received = call(handler.getNewJobs, {"site": "saf", "consumer": "logger"})
+        assert [job["ulid"] for job in received] == ulids(jobs)
+        assert all(job["statusId"].startswith("UNREAD#") for job in received)
+        assert consumers.calls["update_item"] == 1
+        assert call(handler.getNewJobs, {"site": "saf", "consumer": "logger"})[1] == []
+
+        # The queue itself isn't affected.
+        _, received = call(handler.getNewJobs, {"site": "saf"})
+        assert len(received) == 4
+
+        status, _ = call_status(handler.getNewJobs,
+                                {"site": "saf", "consumer": "logger", "alternateQueue": True})
+        assert status == HTTPStatus.BAD_REQUEST
+    finally:
+        set_table(None, role="consumers")
+
+
+def test_consumers_wait_for_the_lag_before_reading_jobs(table, mocker):
+    consumers = InMemoryTable("consumers", ("site", "consumer"), indexes={})
+    set_table(consumers, role="consumers")
+    mocker.patch("src.consumers.CONSUMER_LAG_MS", 60 * 1000)
+    try:
+        assert call(handler.getNewJobs, {"site": "saf", "consumer": "logger"})[1] == []
+        new_job()
+        assert call(handler.getNewJobs, {"site": "saf", "consumer": "logger"})[1] == []
+    finally:
+        set_table(None, role="consumers")
+
+
+def test_queries_reject_what_dynamodb_rejects(table):
+    new_job()
+    with pytest.raises(ClientError, match="ValidationException"):
+        table.query(KeyConditionExpression=Key("site").eq("saf"),
+                    FilterExpression=Attr("ulid").lt("1"))
+    with pytest.raises(ClientError, match="ValidationException"):
+        table.query(KeyConditionExpression=Key("site").eq("saf") & Key("ulid").between("1", "0"))
+
+
+def test_backfill_pending_keys(table):
+    # Jobs written before the pending indexes existed, and one written after
+    # them but before priorities.
+    for job_id, status in [("01", "UNREAD"), ("02", "RECEIVED"), ("03", "COMPLETE")]:
+        table.put_item(Item={"site": "saf", "ulid": job_id,
+                             "statusId": f"{status}#{job_id}",
+                             "replicaStatusId": f"STARTED#{job_id}",
+                             "deviceType": "camera", "deviceInstance": "camera1",
+                             "action": "expose"})
+    table.update_item(Key={"site": "saf", "ulid": "02"},
+                      UpdateExpression="set pendingId = :p",
+                      ExpressionAttributeValues={":p": "RECEIVED#02"})
+
+    # A shard for every job, a priority and pending key for jobs 01 and 02,
+    # and a device pending key for 01.
+    assert backfill_pending_keys(dry_run=True) == 8
+    assert call(handler.getNewJobs, {"site": "saf"})[1] == []
+    assert backfill_pending_keys() == 8
+    assert backfill_pending_keys() == 0
+    assert table.get_item(Key={"site": "saf", "ulid": "02"})["Item"]["pendingId"] == "RECEIVED#4#02"
+
+    _, received = call(handler.getNewJobs, {"site": "saf", "deviceType": "camera"})
+    assert [job["ulid"] for job in received] == ["01"]
+
+
+def test_stream_handler_publishes_table_changes(table, mocker):
+    send = mocker.patch('src.handler.send_batch_to_datastream', return_value=[])
+    job = new_job()
+    call(handler.updateJobStatus, {
+        "site": "saf", "ulid": job["ulid"], "newStatus": "EXPOSING",
+    })
+
+    response = handler.streamHandler({"Records": table.drain_stream()}, None)
+
+    assert response == {"batchItemFailures": []}
+    messages = send.call_args[0][0]
+    assert [data["statusId"] for _, _, data in messages] == [f"EXPOSING#{job['ulid']}"]
+
+
+def test_stream_handler_pushes_new_jobs_to_connections(table, mocker):
+    set_table(InMemoryTable("connections", ("site", "connectionId"),
+                            indexes={"ConnectionIds": ("connectionId", "site")}), role="connections")
+    mocker.patch("src.connections.WEBSOCKET_ENDPOINT", "https://example.com/dev")
+    mocker.patch("src.handler.send_batch_to_datastream", return_value=[])
+
+    def post_to_connection(ConnectionId, Data):
+        if ConnectionId == "closed":
+            raise ClientError({"Error": {"Code": "GoneException"}}, "PostToConnection")
+
+    client = mocker.Mock()
+    client.post_to_connection.side_effect = post_to_connection
+    mocker.patch("src.connections.get_management_client", return_value=client)
+
+    def connect(connection_id, **params):
+        event = {"requestContext": {"connectionId": connection_id},
+                 "queryStringParameters": {"site": "saf", **params}}
+        return handler.connectHandler(event, None)["statusCode"]
+
+    try:
+        assert connect("observatory") == HTTPStatus.OK
+        assert connect("mount-worker", deviceType="mount") == HTTPStatus.OK
+        assert connect("closed") == HTTPStatus.OK
+        assert connect("bad", deviceInstance="camera1") == HTTPStatus.BAD_REQUEST
+
+        job = new_job(device="camera")
+        handler.streamHandler({"Records": table.drain_stream()}, None)
+
+        # The new job is pushed, but not to the mount worker.
+        pushed = [(c[1]["ConnectionId"], json.loads(c[1]["Data"])["job"]["ulid"])
+                  for c in client.post_to_connection.call_args_list]
+        assert sorted(pushed) == [("closed", job["ulid"]), ("observatory", job["ulid"])]
+
+        # Being pushed doesn't claim the job, and claiming it isn't pushed.
+        assert [j["ulid"] for j in call(handler.getNewJobs, {"site": "saf"})[1]] == [job["ulid"]]
+        handler.streamHandler({"Records": table.drain_stream()}, None)
+        assert client.post_to_connection.call_count == 2
+
+        # Closed connections are forgotten, on push or on disconnect.
+        handler.disconnectHandler({"requestContext": {"connectionId": "mount-worker"}}, None)
+        assert [c["connectionId"] for c in connections.site_connections("saf")] == ["observatory"]
+    finally:
+        set_table(None, role="connections")
+
+
+def test_finished_jobs_expire_into_the_archive(table, tmp_path):
+    archive = LocalArchive(str(tmp_path))
+    set_archive(archive)
+    finished, running = new_job(), new_job()
+    call(handler.updateJobStatus, {"site": "saf", "ulid": finished["ulid"], "newStatus": "COMPLETE"})
+    call(handler.updateJobStatus, {"site": "saf", "ulid": running["ulid"], "newStatus": "EXPOSING"})
+    table.drain_stream()
+
+    # Nothing has expired yet.
+    assert table.expire_items("expiresAt") == 0
+    assert table.expire_items("expiresAt", now=time.time() + 31 * 24 * 60 * 60) == 1
+
+    try:
+        response = handler.archiveHandler({"Records": table.drain_stream()}, None)
+    finally:
+        set_archive(None)
+    assert response == {"archived": 1}
+    [key] = archive.keys()
+    [archived] = decode_jobs(archive.get(key))
+    assert archived["ulid"] == finished["ulid"]
+    assert archived["statusId"] == f"COMPLETE#{finished['ulid']}"
+    _, recent = call(handler.getRecentJobs, {"site": "saf"})
+    assert [job["ulid"] for job in recent] == [running["ulid"]]
+
+
+def test_handlers_emit_metric_lines(table, capsys):
+    new_job()
+    capsys.readouterr()
+
+    call(handler.getNewJobs, {"site": "saf"})
+
+    lines = [json.loads(line) for line in capsys.readouterr().out.splitlines()
+             if line.startswith('{"_aws"')]
+    assert len(lines) == 1
+    metrics = lines[0]
+    assert metrics["function"] == "getNewJobs"
+    assert metrics["site"] == "saf"
+    assert metrics["statusCode"] == HTTPStatus.OK
+    assert metrics["dynamodb_requests"] == 2  # one query, one claim
+    assert metrics["consumed_rcu"] > 0 and metrics["consumed_wcu"] > 0
+    assert {"query_ms", "writes_ms", "serialization_ms"} <= metrics.keys()
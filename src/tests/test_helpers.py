@@ -1,7 +1,16 @@
+import decimal
 import pytest
 from http import HTTPStatus
 
 from src.helpers import get_response, get_current_reservations
+from src.helpers import encode_cursor, decode_cursor, get_page_params
+from src.helpers import MAX_PAGE_LIMIT
+from src.helpers import reservations_cache_expiry
+from src.helpers import RESERVATION_CACHE_TTL_EMPTY, RESERVATION_CACHE_TTL_MAX
+from src.helpers import get_wait_seconds, LONG_POLL_MAX_WAIT
+from src.helpers import to_json, get_sync_params, encode_sync_token
+from src.helpers import get_device_filter, get_priority, DEFAULT_PRIORITY, URGENT_PRIORITY
+from src.helpers import get_consumer
 
 def test_get_response():
     message = "test result"
@@ -22,3 +31,100 @@ def test_current_reservations():
     except Exception as e:
         print(e)
         assert False
+
+def test_cursor_round_trip():
+    last_key = {"site": "saf", "ulid": "01E4C33S9ZFGS8P0K31FH9FDTN"}
+    cursor = encode_cursor(last_key)
+    assert isinstance(cursor, str)
+    assert decode_cursor(cursor) == last_key
+    assert encode_cursor(None) is None
+    assert decode_cursor(None) is None
+
+def test_decode_cursor_rejects_garbage():
+    with pytest.raises(ValueError):
+        decode_cursor("not a cursor")
+
+def test_get_page_params():
+    assert get_page_params({}) == (None, None)
+    assert get_page_params({"limit": 5, "cursor": "abc"}) == (5, "abc")
+    assert get_page_params({"limit": 10**6})[0] == MAX_PAGE_LIMIT
+    for bad_limit in [0, -1, "10", True]:
+        with pytest.raises(ValueError):
+            get_page_params({"limit": bad_limit})
+
+def test_get_current_reservations_is_cached(mocker):
+    """ Repeated lookups for a site reuse the first calendar response. """
+    reservations = [{"creator_id": "user_id_1", "end": "2030-01-01T00:00:00Z"}]
+    session = mocker.Mock()
+    session.post.return_value.json.return_value = reservations
+    mocker.patch('src.helpers.get_http_session', return_value=session)
+    mocker.patch.dict('src.helpers._reservations_cache', clear=True)
+
+    assert get_current_reservations("tst") == reservations
+    assert get_current_reservations("tst") == reservations
+    assert session.post.call_count == 1
+    assert "timeout" in session.post.call_args[1]
+
+def test_reservations_cache_expiry():
+    now = 1000.0
+    assert reservations_cache_expiry([], now) == now + RESERVATION_CACHE_TTL_EMPTY
+
+    # Valid until the reservation ends...
+    ending_soon = [{"end": "1970-01-01T00:17:00Z"}]  # 1020 seconds
+    assert reservations_cache_expiry(ending_soon, now) == 1020
+
+    # ...but never for longer than the maximum.
+    ending_later = [{"end": "2030-01-01T00:00:00Z"}]
+    assert reservations_cache_expiry(ending_later, now) == now + RESERVATION_CACHE_TTL_MAX
+
+def test_get_wait_seconds():
+    assert get_wait_seconds({}) == 0
+    assert get_wait_seconds({"waitSeconds": 2.5}) == 2.5
+    assert get_wait_seconds({"waitSeconds": 3600}) == LONG_POLL_MAX_WAIT
+    for bad_wait in [-1, "10", None, True]:
+        with pytest.raises(ValueError):
+            get_wait_seconds({"waitSeconds": bad_wait})
+
+def test_to_json():
+    body = {"ulid": "01E4C33S9ZFGS8P0K31FH9FDTN", "secondsUntilComplete": decimal.Decimal("5")}
+    assert to_json(body) == '{"ulid":"01E4C33S9ZFGS8P0K31FH9FDTN","secondsUntilComplete":5}'
+    assert "\n" in to_json(body, debug=True)
+
+def test_get_sync_params():
+    assert get_sync_params({}) == (False, None)
+    assert get_sync_params({"syncToken": None}) == (True, None)
+    assert get_sync_params({"syncToken": encode_sync_token(1585248855359)}) == (True, 1585248855359)
+    for bad_params in [{"syncToken": "not a token"}, {"syncToken": 5},
+                       {"syncToken": encode_cursor({"site": "saf"})},
+                       {"syncToken": None, "limit": 10}]:
+        with pytest.raises(ValueError):
+            get_sync_params(bad_params)
+    with pytest.raises(ValueError):
+        get_sync_params({"syncToken": encode_sync_token(1585248855359)}, 1585248855360)
+
+def test_get_device_filter():
+    assert get_device_filter({}) == (None, None)
+    assert get_device_filter({"deviceType": "camera"}) == ("camera", None)
+    assert get_device_filter({"deviceType": "camera", "deviceInstance": "camera1"}) \
+        == ("camera", "camera1")
+    for bad_params in [{"deviceInstance": "camera1"}, {"deviceType": ""},
+                       {"deviceType": "a#b"}, {"deviceType": 5}]:
+        with pytest.raises(ValueError):
+            get_device_filter(bad_params)
+
+def test_get_priority():
+    assert get_priority({"action": "expose"}) == DEFAULT_PRIORITY
+    assert get_priority({"action": "expose", "priority": 0}) == 0
+    # Safety actions are urgent whatever was asked for.
+    assert get_priority({"action": "stop", "priority": 1}) == URGENT_PRIORITY
+    for bad_priority in [10, -1, "9", 2.5, True]:
+        with pytest.raises(ValueError):
+            get_priority({"action": "expose", "priority": bad_priority})
+
+def test_get_consumer():
+    assert get_consumer({}) is None
+    assert get_consumer({"consumer": "logger", "limit": 10}) == "logger"
+    for bad_params in [{"consumer": ""}, {"consumer": 5}, {"consumer": "x" * 65},
+                       {"consumer": "logger", "deviceType": "camera"}]:
+        with pytest.raises(ValueError):
+            get_consumer(bad_params)
@@ -0,0 +1,49 @@
+import pytest
+import yaml
+
+from src.index_steps import load_steps, next_step, STEPS_FILE, CURRENT_STEP
+from src.memory_table import JOBS_INDEXES, JOBS_KEY_SCHEMA
+
+
+def test_each_step_changes_one_index():
+    steps = load_steps()
+    assert steps[0][1] == {"StatusId", "ReplicaReadStatus"}
+    assert steps[-1][0] == CURRENT_STEP
+    for (_, before), (_, after) in zip(steps, steps[1:]):
+        assert len(before ^ after) == 1
+
+
+def test_steps_define_their_key_attributes():
+    with open(STEPS_FILE) as f:
+        steps = yaml.safe_load(f)["steps"]
+    for step in steps.values():
+        key_attributes = set(JOBS_KEY_SCHEMA)
+        for index in step["GlobalSecondaryIndexes"]:
+            key_attributes |= {key["AttributeName"] for key in index["KeySchema"]}
+        # CloudFormation rejects definitions of attributes that aren't keys.
+        assert sorted(a["AttributeName"] for a in step["AttributeDefinitions"]) \
+            == sorted(key_attributes)
+
+    # The in-memory table mirrors the current indexes.
+    current = {index["IndexName"]: tuple(key["AttributeName"] for key in index["KeySchema"])
+               for index in steps[CURRENT_STEP]["GlobalSecondaryIndexes"]}
+    assert current == JOBS_INDEXES
+
+
+def test_next_step_moves_one_step_at_a_time():
+    steps = load_steps()
+    indexes = ["StatusId", "ReplicaReadStatus"]
+    deployed = []
+    while True:
+        step = next_step(indexes, steps)
+        deployed.append(step)
+        if step == CURRENT_STEP:
+            break
+        indexes = dict(steps)[step]
+    assert deployed == [name for name, _ in steps[1:]]
+
+    assert next_step(dict(steps)[CURRENT_STEP], steps) == CURRENT_STEP
+    # A new stage is created with the current indexes.
+    assert next_step(None, steps) == CURRENT_STEP
+    with pytest.raises(ValueError):
+        next_step(["StatusId"], steps)
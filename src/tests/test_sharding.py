@@ -0,0 +1,22 @@
+import pytest
+
+from src.sharding import job_shard, parse_site_shards, site_shards
+
+
+def test_parse_site_shards():
+    assert parse_site_shards("") == {}
+    assert parse_site_shards("saf:4, mrc:2") == {"saf": 4, "mrc": 2}
+    for bad_value in ["saf", "saf:0", ":2", "saf:two"]:
+        with pytest.raises(ValueError):
+            parse_site_shards(bad_value)
+
+
+def test_job_shard(mocker):
+    mocker.patch.dict("src.sharding.SITE_SHARDS", {"saf": 4})
+    assert site_shards("mrc") == ["mrc"]
+    assert job_shard("mrc", "camera", "camera1") == "mrc"
+    assert site_shards("saf") == ["saf#0", "saf#1", "saf#2", "saf#3"]
+    # Each device's jobs always go to the same shard.
+    shard = job_shard("saf", "camera", "camera1")
+    assert shard in site_shards("saf")
+    assert all(job_shard("saf", "camera", "camera1") == shard for _ in range(5))
@@ -0,0 +1,79 @@
+import json
+import pytest
+from botocore.exceptions import ClientError
+from http import HTTPStatus
+
+from src import handler
+from src.memory_table import InMemoryTable
+from src.storage import set_table
+from src.throttling import ThrottledTable, Throttled, TokenBucket, consumed_units
+
+
+def _throttle_error():
+    return ClientError({"Error": {"Code": "ProvisionedThroughputExceededException"}}, "Query")
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_token_bucket_spreads_out_bursts():
+    clock = FakeClock()
+    bucket = TokenBucket(rate=2, capacity=2, clock=clock)
+    assert bucket.reserve(1, max_wait=1) == 0
+    assert bucket.reserve(1, max_wait=1) == 0
+    assert bucket.reserve(1, max_wait=1) == 0.5
+
+    # An expensive request puts the bucket into debt, but the next request
+    # can still go ahead within the longest wait.
+    bucket.settle(100)
+    with pytest.raises(Throttled) as e:
+        bucket.reserve(1, max_wait=1)
+    assert e.value.retry_after == 2
+    assert bucket.reserve(1, max_wait=2) == 2
+
+    clock.now += 10
+    assert bucket.reserve(1, max_wait=1) == 0
+
+
+def test_consumed_units_uses_the_busiest_index():
+    assert consumed_units(None) == 0
+    assert consumed_units({"CapacityUnits": 3.0}) == 3.0
+    assert consumed_units({
+        "CapacityUnits": 4.0,
+        "Table": {"CapacityUnits": 1.0},
+        "GlobalSecondaryIndexes": {"PendingJobsByShard": {"CapacityUnits": 2.0},
+                                   "SiteChangesByShard": {"CapacityUnits": 1.0}},
+    }) == 2.0
+
+
+def test_throttled_requests_are_retried(mocker):
+    mocker.patch('src.throttling.backoff_delay', return_value=0)
+    table = InMemoryTable()
+    query = mocker.patch.object(table, 'query', side_effect=[
+        _throttle_error(), _throttle_error(), {"Items": [], "Count": 0},
+    ])
+
+    response = ThrottledTable(table).meta.client.query(TableName=table.name)
+
+    assert response["Items"] == []
+    assert query.call_count == 3
+
+
+def test_handlers_respond_429_when_throttled(mocker):
+    mocker.patch('src.throttling.backoff_delay', return_value=0)
+    table = InMemoryTable()
+    mocker.patch.object(table, 'query', side_effect=_throttle_error())
+    set_table(table)
+    try:
+        response = handler.getRecentJobs({"body": json.dumps({"site": "saf"})}, None)
+    finally:
+        set_table(None)
+
+    assert response["statusCode"] == HTTPStatus.TOO_MANY_REQUESTS
+    assert response["headers"]["Retry-After"] == "1"
+    assert json.loads(response["body"])["retryAfter"] == 1
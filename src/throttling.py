@@ -0,0 +1,225 @@
+"""Keeps dynamodb requests within the table's provisioned capacity.
+
+The jobs table and its indexes are provisioned with very little capacity, so
+bursts of requests (a cancel_all_commands, or an observatory draining a long
+queue) get throttled. Requests made through ThrottledTable:
+    - wait for a client-side token bucket sized from the provisioned
+      capacity, so a burst is spread out instead of being rejected
+    - are retried with exponential backoff and jitter when dynamodb throttles
+      them anyway
+    - raise Throttled, with a suggested retry time, if they still can't be
+      served, which the api handlers turn into a 429 response.
+"""
+import functools
+import logging
+import math
+import os
+import random
+import threading
+import time
+from http import HTTPStatus
+from types import SimpleNamespace
+
+from botocore.exceptions import ClientError
+
+from src.helpers import get_response, to_json, LOG_LEVEL
+from src.metrics import READ_OPERATIONS, WRITE_OPERATIONS, phase
+
+logger = logging.getLogger("throttling_logger")
+logger.setLevel(LOG_LEVEL)
+
+# Provisioned capacity units per second. Unset means no client-side limit.
+READ_CAPACITY = os.getenv('DYNAMODB_READ_CAPACITY')
+WRITE_CAPACITY = os.getenv('DYNAMODB_WRITE_CAPACITY')
+
+# Dynamodb lets a table burst using up to 300 seconds of unused capacity,
+# and the bucket allows the same.
+BURST_SECONDS = 300
+
+# Longest a request waits for the token bucket before giving up.
+MAX_BUCKET_WAIT = 2
+
+# Retries for requests that dynamodb throttles, with full jitter backoff.
+THROTTLE_RETRIES = 5
+BACKOFF_BASE = 0.05
+BACKOFF_MAX = 1
+
+RETRYABLE_ERRORS = {
+    'ProvisionedThroughputExceededException',
+    'ThrottlingException',
+    'RequestLimitExceeded',
+    'InternalServerError',
+    'ServiceUnavailable',
+}
+
+
+class Throttled(Exception):
+    """A request couldn't be served within the table's capacity.
+
+    Attributes:
+        retry_after (int): Suggested seconds to wait before trying again.
+        details (dict): Extra values for the 429 response body, such as what
+            was done before the request was throttled.
+    """
+
+    def __init__(self, retry_after, details=None):
+        super().__init__(f"DynamoDB capacity exceeded, retry after {retry_after}s")
+        self.retry_after = retry_after
+        self.details = details or {}
+
+
+def backoff_delay(attempt):
+    """ Seconds to wait before retry number `attempt` (0 based), with jitter. """
+    return random.uniform(0, min(BACKOFF_MAX, BACKOFF_BASE * 2 ** attempt))
+
+
+class TokenBucket:
+    """Allows `rate` capacity units per second, with bursts up to `capacity`.
+
+    Units are taken before a request using an estimate, and the difference
+    from what the request actually consumed is settled afterwards, so the
+    bucket can go into debt after an expensive request. The debt is capped
+    so that the next request waits at most max_wait, rather than every
+    request being refused for as long as an expensive one (a
+    cancel_all_commands, say) would take to pay back, stop and park
+    included. Dynamodb's own throttling covers anything beyond that.
+    """
+
+    def __init__(self, rate, capacity=None, clock=time.monotonic, max_wait=MAX_BUCKET_WAIT):
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else max(1, rate * BURST_SECONDS)
+        self.min_tokens = 1 - rate * max_wait
+        self.tokens = self.capacity
+        self._clock = clock
+        self._updated = clock()
+        self._lock = threading.Lock()
+
+    def _refill(self):
+        now = self._clock()
+        self.tokens = min(self.capacity, self.tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def reserve(self, units, max_wait):
+        """Takes units from the bucket if they'll be available within max_wait.
+
+        Returns:
+            float: Seconds to wait before using the units.
+
+        Raises:
+            Throttled: If the units won't be available in time.
+        """
+        with self._lock:
+            self._refill()
+            wait = max(0, (units - self.tokens) / self.rate)
+            if wait > max_wait:
+                raise Throttled(math.ceil(wait))
+            self.tokens -= units
+            return wait
+
+    def settle(self, units):
+        """ Adjusts the bucket by the units used beyond the reserved amount. """
+        with self._lock:
+            self._refill()
+            self.tokens = max(self.min_tokens, self.tokens - units)
+
+
+def consumed_units(consumed_capacity):
+    """Capacity used by the busiest of the table and its indexes.
+
+    Each index has its own provisioned capacity, so a write that touches the
+    table and two indexes is limited by the busiest one, not their total.
+    """
+    if isinstance(consumed_capacity, dict):
+        consumed_capacity = [consumed_capacity]
+    busiest = 0
+    for capacity in consumed_capacity or []:
+        parts = [capacity.get('Table', {}).get('CapacityUnits', 0)]
+        parts += [index.get('CapacityUnits', 0)
+                  for index in capacity.get('GlobalSecondaryIndexes', {}).values()]
+        busiest = max(busiest, max(parts) or capacity.get('CapacityUnits', 0))
+    return busiest
+
+
+class _Throttler:
+    """Wraps a dynamodb table or client so requests stay within capacity."""
+
+    def __init__(self, target, read_bucket, write_bucket):
+        self._target = target
+        self._buckets = {'read': read_bucket, 'write': write_bucket}
+
+    def __getattr__(self, name):
+        attribute = getattr(self._target, name)
+        if name in READ_OPERATIONS:
+            bucket = self._buckets['read']
+        elif name in WRITE_OPERATIONS:
+            bucket = self._buckets['write']
+        else:
+            return attribute
+
+        @functools.wraps(attribute)
+        def request(**kwargs):
+            # INDEXES includes the total as well, for the metrics.
+            kwargs.setdefault('ReturnConsumedCapacity', 'INDEXES')
+            for attempt in range(THROTTLE_RETRIES + 1):
+                if bucket is not None:
+                    wait = bucket.reserve(1, MAX_BUCKET_WAIT)
+                    if wait:
+                        with phase('throttle'):
+                            time.sleep(wait)
+                try:
+                    response = attribute(**kwargs)
+                except ClientError as e:
+                    if e.response['Error']['Code'] not in RETRYABLE_ERRORS:
+                        raise
+                    if attempt == THROTTLE_RETRIES:
+                        raise Throttled(1) from e
+                    with phase('throttle'):
+                        time.sleep(backoff_delay(attempt))
+                    continue
+                if bucket is not None:
+                    bucket.settle(consumed_units(response.get('ConsumedCapacity')) - 1)
+                return response
+
+        return request
+
+
+class ThrottledTable(_Throttler):
+    """A jobs table whose requests, including those made through its
+    low-level client, share the same capacity limits and retries."""
+
+    def __init__(self, table, read_rate=None, write_rate=None):
+        read_bucket = TokenBucket(read_rate) if read_rate else None
+        write_bucket = TokenBucket(write_rate) if write_rate else None
+        super().__init__(table, read_bucket, write_bucket)
+        self.meta = SimpleNamespace(
+            client=_Throttler(table.meta.client, read_bucket, write_bucket))
+
+
+def throttled_table(table):
+    """ Wraps a table using the capacity configured in the environment. """
+    return ThrottledTable(
+        table,
+        read_rate=float(READ_CAPACITY) if READ_CAPACITY else None,
+        write_rate=float(WRITE_CAPACITY) if WRITE_CAPACITY else None,
+    )
+
+
+def handle_throttling(function):
+    """Decorator for api handlers that turns Throttled into a 429 response
+    with a Retry-After header, instead of a 500."""
+
+    @functools.wraps(function)
+    def wrapper(event, context):
+        try:
+            return function(event, context)
+        except Throttled as e:
+            logger.info(f"Throttled: {e}")
+            return get_response(
+                HTTPStatus.TOO_MANY_REQUESTS,
+                to_json({"error": "Too many requests, please retry later.",
+                         "retryAfter": e.retry_after,
+                         **e.details}),
+                headers={"Retry-After": str(e.retry_after)},
+            )
+
+    return wrapper